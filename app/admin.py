@@ -0,0 +1,47 @@
+""" Maintenance commands for the bot database
+
+Usage: python -m app.admin <command>
+"""
+from argparse import ArgumentParser
+
+from app.models import Price, PriceStats, db, migrate, session_scope
+
+
+def compact_prices(args):
+    """ merge daily price records with the same price into validity intervals """
+    with session_scope() as session:
+        stats = Price.compact(session)
+    print(f'''prices: {stats['before']} -> {stats['after']} records''')
+    if args.vacuum and db.dialect.name == 'sqlite':
+        db.execute('VACUUM')
+        page_count, page_size = db.execute('PRAGMA page_count').scalar(), db.execute('PRAGMA page_size').scalar()
+        print(f'database size: {page_count * page_size / 2 ** 20:.1f} MB')
+
+
+def rebuild_stats(args):
+    """ recompute the current and the lowest prices from the whole price history """
+    with session_scope() as session:
+        count = PriceStats.rebuild(session)
+    print(f'{count} price stats records')
+
+
+def migrate_db(args):
+    """ create missing tables, columns and indexes """
+    migrate()
+    print('done')
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('migrate', help=migrate_db.__doc__).set_defaults(func=migrate_db)
+    compact = commands.add_parser('compact', help=compact_prices.__doc__)
+    compact.add_argument('--vacuum', action='store_true', help='rebuild the database file to free the space')
+    compact.set_defaults(func=compact_prices)
+    commands.add_parser('rebuild-stats', help=rebuild_stats.__doc__).set_defaults(func=rebuild_stats)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,255 @@
+""" Script for launching the bot on asyncio """
+from asyncio import Semaphore, get_running_loop, run, sleep
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from os import environ
+
+from telebot.async_telebot import AsyncTeleBot
+
+from app.models import Game, PSN_URL, session_scope
+from app import importer, metrics, posters, search, wishlist
+from app.telegram import read_token
+
+import logging
+
+logger = logging.getLogger('async_bot')
+
+MAX_HANDLERS = int(environ.get('PSNBOT_MAX_HANDLERS', 64))
+WORKERS = int(environ.get('PSNBOT_WORKERS', 16))
+DB_WORKERS = int(environ.get('PSNBOT_DB_WORKERS', 4))
+MAX_IMPORT_FILE_SIZE = 2 ** 20
+
+bot = AsyncTeleBot(token=None)
+# slow store requests get their own pool so that they can't take all the threads from the short DB queries
+store_executor = ThreadPoolExecutor(max_workers=WORKERS, thread_name_prefix='bot-store')
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='bot-db')
+_handlers_limit = None
+
+
+async def in_thread(func, *args, **kwargs):
+    """
+    Run blocking DB work in the DB pool
+    :param func: blocking function
+    :returns result of the function
+    """
+    return await get_running_loop().run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+
+async def in_store_thread(func, *args, **kwargs):
+    """
+    Run blocking work that may request the store in the store pool
+    :param func: blocking function
+    :returns result of the function
+    """
+    return await get_running_loop().run_in_executor(store_executor, partial(func, *args, **kwargs))
+
+
+def limited(handler):
+    """ Don't let more than MAX_HANDLERS handlers run at the same time """
+
+    @wraps(handler)
+    async def wrapper(*args, **kwargs):
+        global _handlers_limit
+        if _handlers_limit is None:
+            _handlers_limit = Semaphore(MAX_HANDLERS)
+        async with _handlers_limit:
+            with metrics.timer('handler', name=handler.__name__):
+                return await handler(*args, **kwargs)
+
+    return wrapper
+
+
+@bot.message_handler(commands=['start', 'help'])
+@limited
+async def start_message(message):
+    """ Greeting message """
+    await bot.send_message(message.chat.id, f'Привет, я бот для твоего вишлиста в [Sony PlayStation Store]({PSN_URL}). '
+                                            'Ты можешь кидать мне ссылки на игры, которые ты хочешь когда-нибудь '
+                                            'купить, а я пришлю тебе сообщение, если на какие-то из них будут скидки.'
+                                            '\nСписок доступных команд:'
+                                            '\n\n/help — увидеть это сообщение'
+                                            f'\n\n/add — {add_game.__doc__}'
+                                            f'\n\n/del — {del_game.__doc__}'
+                                            f'\n\n/list — {get_wishlist.__doc__}'
+                                            f'\n\n/import — {import_games.__doc__}'
+                                            f'\n\n/region — {set_region.__doc__}'
+                                            f'\n\n/watch — {watch_game.__doc__}'
+                                            f'\n\n/unwatch — {unwatch_game.__doc__}', parse_mode='MARKDOWN'
+                           )
+
+
+@bot.message_handler(commands=['add'])
+@limited
+async def add_game(message):
+    """ добавить игру в вишлист, пример:
+`/add https://store.playstation.com/ru-ru/concept/10000237`
+или
+`/add 10000237`
+добавить в вишлист Assassin's Creed Valhalla """
+    response, poster_url = await in_store_thread(wishlist.add_game, user_id=message.chat.id,
+                                           game_id=message.text.split(' ', maxsplit=1)[1])
+    if poster_url:
+        sent = await bot.send_photo(chat_id=message.chat.id,
+                                    photo=await in_store_thread(posters.get_photo, poster_url),
+                                    parse_mode='MARKDOWN',
+                                    caption=response)
+        posters.remember_file_id(poster_url, sent)
+        return
+    await bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['del'])
+@limited
+async def del_game(message):
+    """ удалить игру из вишлиста, пример:
+`/del https://store.playstation.com/ru-ru/product/EP3862-CUSA10484_00-DEADCELLS0000000`
+или
+`/del EP3862-CUSA10484_00-DEADCELLS0000000`
+удалить из вишлиста Dead Cells """
+    response = await in_store_thread(wishlist.delete_game, user_id=message.chat.id,
+                               game_id=message.text.split(' ', maxsplit=1)[1])
+    await bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['import'])
+@limited
+async def import_games(message):
+    """ добавить в вишлист сразу много игр: ссылки или идентификаторы по одной на строку после команды или
+текстовым/CSV файлом """
+    response = await in_store_thread(wishlist.import_games, user_id=message.chat.id,
+                               text=''.join(message.text.split(maxsplit=1)[1:]))
+    await bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(content_types=['document'],
+                     func=lambda message: importer.is_import_file(message.document.file_name,
+                                                                  message.document.mime_type))
+@limited
+async def import_games_file(message):
+    """ импорт игр из текстового/CSV файла """
+    if message.document.file_size > MAX_IMPORT_FILE_SIZE:
+        await bot.send_message(message.chat.id, 'Файл слишком большой')
+        return
+    content = await bot.download_file((await bot.get_file(message.document.file_id)).file_path)
+    response = await in_store_thread(wishlist.import_games, user_id=message.chat.id,
+                               text=content.decode('utf-8', errors='ignore'))
+    await bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['region'])
+@limited
+async def set_region(message):
+    """ выбрать регион магазина, в котором отслеживаются цены, пример:
+`/region en-us` """
+    response = await in_store_thread(wishlist.set_region, user_id=message.chat.id,
+                               locale=message.text.split(' ', maxsplit=1)[-1])
+    await bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['watch'])
+@limited
+async def watch_game(message):
+    """ присылать сообщение об игре, только когда цена ниже заданной (`<2000`), скидка не меньше заданной (`50%`)
+или только на нужное издание, пример:
+`/watch 10000237 <2000 Deluxe` """
+    response = await in_store_thread(wishlist.watch_game, user_id=message.chat.id,
+                               text=''.join(message.text.split(maxsplit=1)[1:]))
+    await bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['unwatch'])
+@limited
+async def unwatch_game(message):
+    """ удалить условия для игры и снова получать сообщения о любых скидках на неё, пример:
+`/unwatch 10000237` """
+    response = await in_store_thread(wishlist.unwatch_game, user_id=message.chat.id,
+                               game_id=message.text.split(' ', maxsplit=1)[-1])
+    await bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['list'])
+@limited
+async def get_wishlist(message):
+    """просто получить вишлист"""
+    text, keyboard = await in_thread(wishlist.wishlist_page, user_id=message.chat.id)
+    await bot.send_message(chat_id=message.chat.id, text=text, parse_mode='MARKDOWN', reply_markup=keyboard)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('list:'))
+@limited
+async def turn_wishlist_page(call):
+    """ листание вишлиста кнопками под сообщением """
+    page = call.data.split(':')[1]
+    await bot.answer_callback_query(call.id)
+    if page.isdigit():
+        text, keyboard = await in_thread(wishlist.wishlist_page, user_id=call.message.chat.id, page=int(page))
+        await bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id,
+                                    parse_mode='MARKDOWN', reply_markup=keyboard)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('posters:'))
+@limited
+async def send_wishlist_posters(call):
+    """ постеры игр со страницы вишлиста альбомами """
+    await bot.answer_callback_query(call.id)
+    groups = await in_thread(wishlist.wishlist_posters, user_id=call.message.chat.id,
+                             page=int(call.data.split(':')[1]))
+    for group in groups:
+        sent = await bot.send_media_group(call.message.chat.id, [media for _, media in group])
+        for (poster_url, _), message in zip(group, sent):
+            await in_thread(posters.remember_file_id, poster_url, message)
+
+
+@bot.inline_handler(func=lambda query: len(query.query) > 2)
+@limited
+async def search_game_from_store(inline_query):
+    """
+    inline-метод, который позволяет искать игры в PSN
+    :param inline_query: текст
+    """
+    try:
+        # the debounce waits here on the loop, the threads only make the upstream search
+        games = await in_thread(wishlist.search_cached, inline_query.query, user_id=inline_query.from_user.id)
+        if games is None:
+            await sleep(search.DEBOUNCE)
+            games = await in_store_thread(wishlist.search_store, inline_query.query,
+                                          user_id=inline_query.from_user.id)
+        if games is None:
+            return
+        await bot.answer_inline_query(
+            inline_query_id=inline_query.id,
+            results=await in_thread(wishlist.search_results, games),
+            switch_pm_text='Добавить игр?',
+            switch_pm_parameter='start'
+        )
+    except Exception as e:
+        logger.exception(e)
+
+
+@bot.inline_handler(func=lambda query: not query.query.strip())
+@limited
+async def watch_wishlist_inline(chosen_inline_result):
+    """
+    inline-метод, позволяющий публиковать в чате игры из своего вишлиста
+    :param chosen_inline_result: пустая строка
+    """
+    try:
+        results, next_offset = await in_thread(wishlist.wishlist_results, user_id=chosen_inline_result.from_user.id,
+                                               offset=chosen_inline_result.offset)
+        await bot.answer_inline_query(
+            inline_query_id=chosen_inline_result.id,
+            results=results,
+            next_offset=next_offset,
+            switch_pm_text='Добавить игр?',
+            switch_pm_parameter='start'
+        )
+    except Exception as e:
+        logger.exception(e)
+
+
+if __name__ == '__main__':
+    bot.token = read_token()
+    metrics.serve()
+    with session_scope() as session:
+        Game.warm_cache(session)
+    run(bot.polling(non_stop=True))
@@ -1,17 +1,15 @@
 """ Script for launching the bot """
-from telebot import TeleBot, types
-from app.models import Game, Wish, Price, PSN_URL, session_scope
-from PIL import Image
-from io import BytesIO
-from requests import get
-from urllib.parse import quote
+from telebot import TeleBot
+from app.models import Game, LOG_LEVEL, PSN_URL, session_scope
+from app import importer, metrics, posters, wishlist
+from app.telegram import read_token
 
 import logging
 
 logging.basicConfig(
     filename='top_bot.log',
     filemode='a',
-    level=logging.DEBUG,
+    level=LOG_LEVEL,
     format='%(asctime)s.%(msecs)d[%(name)s.%(levelname)s]: '
            '[%(filename)s:%(lineno)s - %(funcName)20s() ] '
            '%(message)s',
@@ -19,25 +17,13 @@ logging.basicConfig(
 
 logger = logging.getLogger('toplevel')
 
-bot = TeleBot(token=open('creds/telegram.token').read())
+bot = TeleBot(token=None)
 
-
-def get_image_bytes(img_url: str) -> BytesIO:
-    """
-    Get image by url and make a BytesIO object with it
-    :param img_url:
-    :returns BytesIO object
-    """
-    image_content = get(img_url).content
-    image = Image.open(BytesIO(image_content))
-    image_content = BytesIO()
-    image.seek(0)
-    image.save(image_content, format='JPEG')
-    image_content.seek(0)
-    return image_content
+MAX_IMPORT_FILE_SIZE = 2 ** 20
 
 
 @bot.message_handler(commands=['start', 'help'])
+@metrics.timed('handler', name='start_message')
 def start_message(message):
     """ Greeting message """
     bot.send_message(message.chat.id, f'Привет, я бот для твоего вишлиста в [Sony PlayStation Store]({PSN_URL}). Ты '
@@ -47,141 +33,153 @@ def start_message(message):
                                       '\n\n/help — увидеть это сообщение'
                                       f'\n\n/add — {add_game.__doc__}'
                                       f'\n\n/del — {del_game.__doc__}'
-                                      f'\n\n/list — {get_wishlist.__doc__}', parse_mode='MARKDOWN'
+                                      f'\n\n/list — {get_wishlist.__doc__}'
+                                      f'\n\n/import — {import_games.__doc__}'
+                                      f'\n\n/region — {set_region.__doc__}'
+                                      f'\n\n/watch — {watch_game.__doc__}'
+                                      f'\n\n/unwatch — {unwatch_game.__doc__}', parse_mode='MARKDOWN'
                      )
 
 
 @bot.message_handler(commands=['add'])
+@metrics.timed('handler', name='add_game')
 def add_game(message):
     """ добавить игру в вишлист, пример:
 `/add https://store.playstation.com/ru-ru/concept/10000237`
 или
 `/add 10000237`
 добавить в вишлист Assassin's Creed Valhalla """
-    try:
-        with session_scope() as session:
-            wish, is_created = Wish.get_or_create(user_id=message.chat.id,
-                                                  game_id=message.text.split(' ', maxsplit=1)[1],
-                                                  session=session)
-            game = Game.get(id=wish.game_id, session=session)
-            if is_created:
-                response = f'Игра успешно добавлена в твой вишлист: {game}.'
-            else:
-                response = f'Эта игра уже есть в твоём вишлисте: {game}.'
-            if game.poster_url:
-                bot.send_photo(chat_id=message.chat.id,
-                               photo=get_image_bytes(game.poster_url),
-                               parse_mode='MARKDOWN',
-                               caption=response)
-                return
-    except ValueError as ve:
-        response = str(ve)
+    response, poster_url = wishlist.add_game(user_id=message.chat.id,
+                                             game_id=message.text.split(' ', maxsplit=1)[1])
+    if poster_url:
+        sent = bot.send_photo(chat_id=message.chat.id,
+                              photo=posters.get_photo(poster_url),
+                              parse_mode='MARKDOWN',
+                              caption=response)
+        posters.remember_file_id(poster_url, sent)
+        return
     bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
 
 
 @bot.message_handler(commands=['del'])
+@metrics.timed('handler', name='del_game')
 def del_game(message):
     """ удалить игру из вишлиста, пример:
 `/del https://store.playstation.com/ru-ru/product/EP3862-CUSA10484_00-DEADCELLS0000000`
 или
 `/del EP3862-CUSA10484_00-DEADCELLS0000000`
 удалить из вишлиста Dead Cells """
-    game_id = message.text.split(' ', maxsplit=1)[1]
-    try:
-        with session_scope() as session:
-            game, game_is_new = Game.get_or_create(game_id, session=session)
-            was_deleted = Wish.delete(user_id=message.chat.id, game_id=game_id, session=session)
-        if was_deleted:
-            response = f'Игра была успешно удалена: {game}'
-        elif game_is_new or game and not was_deleted:
-            response = f'Игра отсутствует в вашем вишлисте: {game}'
-        else:
-            response = f'Игра с таким идентификатором не найдена: {game.name}'
-    except ValueError as ve:
-        response = str(ve)
+    response = wishlist.delete_game(user_id=message.chat.id, game_id=message.text.split(' ', maxsplit=1)[1])
+    bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
 
+@bot.message_handler(commands=['import'])
+@metrics.timed('handler', name='import_games')
+def import_games(message):
+    """ добавить в вишлист сразу много игр: ссылки или идентификаторы по одной на строку после команды или
+текстовым/CSV файлом """
+    response = wishlist.import_games(user_id=message.chat.id, text=''.join(message.text.split(maxsplit=1)[1:]))
+    bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(content_types=['document'],
+                     func=lambda message: importer.is_import_file(message.document.file_name,
+                                                                  message.document.mime_type))
+@metrics.timed('handler', name='import_games_file')
+def import_games_file(message):
+    """ импорт игр из текстового/CSV файла """
+    if message.document.file_size > MAX_IMPORT_FILE_SIZE:
+        bot.send_message(message.chat.id, 'Файл слишком большой')
+        return
+    text = bot.download_file(bot.get_file(message.document.file_id).file_path).decode('utf-8', errors='ignore')
+    bot.send_message(message.chat.id, wishlist.import_games(user_id=message.chat.id, text=text),
+                     parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['region'])
+@metrics.timed('handler', name='set_region')
+def set_region(message):
+    """ выбрать регион магазина, в котором отслеживаются цены, пример:
+`/region en-us` """
+    response = wishlist.set_region(user_id=message.chat.id, locale=message.text.split(' ', maxsplit=1)[-1])
+    bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['watch'])
+@metrics.timed('handler', name='watch_game')
+def watch_game(message):
+    """ присылать сообщение об игре, только когда цена ниже заданной (`<2000`), скидка не меньше заданной (`50%`)
+или только на нужное издание, пример:
+`/watch 10000237 <2000 Deluxe` """
+    response = wishlist.watch_game(user_id=message.chat.id, text=''.join(message.text.split(maxsplit=1)[1:]))
+    bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
+
+
+@bot.message_handler(commands=['unwatch'])
+@metrics.timed('handler', name='unwatch_game')
+def unwatch_game(message):
+    """ удалить условия для игры и снова получать сообщения о любых скидках на неё, пример:
+`/unwatch 10000237` """
+    response = wishlist.unwatch_game(user_id=message.chat.id, game_id=message.text.split(' ', maxsplit=1)[-1])
     bot.send_message(message.chat.id, response, parse_mode='MARKDOWN')
 
 
 @bot.message_handler(commands=['list'])
+@metrics.timed('handler', name='get_wishlist')
 def get_wishlist(message):
     """просто получить вишлист"""
-    with session_scope() as session:
-        wishlist = Wish.get_all(user_id=message.chat.id, session=session)
-        games = [Game.get(id=wish.game_id, session=session) for wish in wishlist]
-        if games:
-            response = '\n'.join([
-                f'{i}) {game}' for i, game in enumerate(sorted(games, key=lambda x: x.name), start=1)
-            ])
-        else:
-            response = 'Твой вишлист пуст :('
-        bot.send_message(
-            chat_id=message.chat.id,
-            text=response,
-            parse_mode='MARKDOWN'
-        )
+    text, keyboard = wishlist.wishlist_page(user_id=message.chat.id)
+    bot.send_message(chat_id=message.chat.id, text=text, parse_mode='MARKDOWN', reply_markup=keyboard)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('list:'))
+@metrics.timed('handler', name='turn_wishlist_page')
+def turn_wishlist_page(call):
+    """ листание вишлиста кнопками под сообщением """
+    page = call.data.split(':')[1]
+    bot.answer_callback_query(call.id)
+    if page.isdigit():
+        text, keyboard = wishlist.wishlist_page(user_id=call.message.chat.id, page=int(page))
+        bot.edit_message_text(text, chat_id=call.message.chat.id, message_id=call.message.message_id,
+                              parse_mode='MARKDOWN', reply_markup=keyboard)
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('posters:'))
+@metrics.timed('handler', name='send_wishlist_posters')
+def send_wishlist_posters(call):
+    """ постеры игр со страницы вишлиста альбомами """
+    bot.answer_callback_query(call.id)
+    for group in wishlist.wishlist_posters(user_id=call.message.chat.id, page=int(call.data.split(':')[1])):
+        sent = bot.send_media_group(call.message.chat.id, [media for _, media in group])
+        for (poster_url, _), message in zip(group, sent):
+            posters.remember_file_id(poster_url, message)
 
 
 @bot.inline_handler(func=lambda query: len(query.query) > 2)
+@metrics.timed('handler', name='search_game_from_store')
 def search_game_from_store(inline_query):
     """
     inline-метод, который позволяет искать игры в PSN
     :param inline_query: текст
     """
-
-    def has_sale_price(game_data: dict):
-        """
-        Возвращает True, если на игру действует скидка
-        :param game_data:
-        :return:
-        """
-        logger.info('')
-        try:
-            return game_data['default_sku']['rewards'][0] is not None
-        except Exception:
-            return False
-
     logger.info('inline: start')
-    psn_url = f'https://store.playstation.com/store/api/chihiro/00_09_000/tumbler/ru/ru/999/' \
-              f'{quote(inline_query.query)}?size=5&start=0&gameContentType=bundles&platform=ps4'
-    logger.info(psn_url)
-    search_data = get(psn_url).json()
-    try:
-        games = [
-            {
-                'name': game['name'],
-                'url': f'''https://store.playstation.com/ru-ru/product/{game['id']}''',
-                'price': game['default_sku']['display_price'],
-                'sale_price': game['default_sku']['rewards'][0]['bonus_price'] // 100 if has_sale_price(game) else None,
-                'valid_until': game['default_sku']['rewards'][0]['end_date'] if has_sale_price(game) else None,
-                'img_url': game['images'][0]['url']
-            } for game in search_data['links']
-        ]
+
+    def answer(games):
         bot.answer_inline_query(
             inline_query_id=inline_query.id,
-            results=[
-                types.InlineQueryResultPhoto(
-                    id=i,
-                    title=game['name'],
-                    photo_url=game['img_url'],
-                    thumb_url=game['img_url'],
-                    caption=f'''[{game['name']}]({game['url']}): ''' +
-                            (f'''~~{game['price']}~~ {game['sale_price']} till {game['valid_until']}''' \
-                                 if game['sale_price'] else f'''{game['price']}'''),
-                    parse_mode='MARKDOWN',
-                    input_message_content=types.InputMediaPhoto(caption=str(game),
-                                                                parse_mode='MARKDOWN',
-                                                                media=get_image_bytes(game['img_url'])),
-                ) for i, game in enumerate(games)
-            ],
+            results=wishlist.search_results(games),
             switch_pm_text='Добавить игр?',
             switch_pm_parameter='start'
         )
+
+    try:
+        wishlist.search_store_later(inline_query.query, answer, user_id=inline_query.from_user.id)
     except Exception as e:
         print(e)
 
 
-@bot.inline_handler(func=lambda query: query == ' ')
+@bot.inline_handler(func=lambda query: not query.query.strip())
+@metrics.timed('handler', name='watch_wishlist_inline')
 def watch_wishlist_inline(chosen_inline_result):
     """
     inline-метод, позволяющий публиковать в чате игры из своего вишлиста
@@ -189,32 +187,24 @@ def watch_wishlist_inline(chosen_inline_result):
     """
     print('общий инлайнер')
     try:
-        with session_scope() as session:
-            wishes = Wish.get_all(user_id=chosen_inline_result.from_user.id, session=session)
-            games = [Game.get(id=wish.game_id, session=session) for wish in wishes]
-
-            bot.answer_inline_query(
-                inline_query_id=chosen_inline_result.id,
-                results=[
-                    types.InlineQueryResultPhoto(
-                        id=game.id,
-                        title=game.name,
-                        photo_url=game.poster_url,
-                        thumb_url=game.poster_url,
-                        caption=str(game),
-                        parse_mode='MARKDOWN',
-                        input_message_content=types.InputMediaPhoto(caption=str(game),
-                                                                    parse_mode='MARKDOWN',
-                                                                    media=get_image_bytes(game.poster_url)),
-                    ) for i, game in enumerate(sorted(games, key=lambda x: x.name))],
-                switch_pm_text='Добавить игр?',
-                switch_pm_parameter='start'
-            )
+        results, next_offset = wishlist.wishlist_results(user_id=chosen_inline_result.from_user.id,
+                                                         offset=chosen_inline_result.offset)
+        bot.answer_inline_query(
+            inline_query_id=chosen_inline_result.id,
+            results=results,
+            next_offset=next_offset,
+            switch_pm_text='Добавить игр?',
+            switch_pm_parameter='start'
+        )
     except Exception as e:
         print(e)
 
 
 if __name__ == '__main__':
+    bot.token = read_token()
+    metrics.serve()
+    with session_scope() as session:
+        Game.warm_cache(session)
     try:
         bot.polling()
     except Exception as e:
@@ -0,0 +1,180 @@
+""" Shared HTTP layer for all the requests to the PSN store """
+from collections import OrderedDict, defaultdict
+from hashlib import sha1
+from json import dumps, loads, JSONDecodeError
+from pathlib import Path
+from threading import Lock, get_ident
+
+from requests import Response, Session as HttpSession
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from urllib3.util import Retry, parse_url
+
+from app import metrics
+
+import logging
+
+logger = logging.getLogger('fetch')
+
+TIMEOUT = (5, 30)
+POOL_SIZE = 16
+CACHE_DIR = Path('store_cache')
+CACHE_MAX_BYTES = 64 * 2 ** 20
+CACHED_HEADERS = ('ETag', 'Last-Modified', 'Content-Type')
+
+retry = Retry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=('GET', 'HEAD'),
+)
+adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE, max_retries=retry)
+http = HttpSession()
+http.mount('https://', adapter)
+http.mount('http://', adapter)
+
+_index = None
+_lock = Lock()
+_stats = defaultdict(lambda: defaultdict(int))
+
+
+def _key(url: str) -> str:
+    return sha1(url.encode()).hexdigest()
+
+
+def _load_index() -> OrderedDict:
+    """ Build the LRU index of the cached bodies, the least recently used first """
+    global _index
+    if _index is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        files = sorted(CACHE_DIR.glob('*.body'), key=lambda path: path.stat().st_mtime)
+        _index = OrderedDict((path.stem, path.stat().st_size) for path in files)
+    return _index
+
+
+def _write(path: Path, content: bytes):
+    """ Write the file so that a reader never sees it half written """
+    temp = path.with_suffix(f'.{get_ident()}.tmp')
+    temp.write_bytes(content)
+    temp.replace(path)
+
+
+def _remember(url: str, response: Response):
+    """
+    Save the body and the validators of the response on disk so that the cache survives restarts, evict the least
+    recently used ones
+    """
+    content = response.content
+    if len(content) > CACHE_MAX_BYTES:
+        return
+    key = _key(url)
+    meta = {
+        'url': url,
+        'headers': {header: response.headers[header] for header in CACHED_HEADERS if header in response.headers},
+        'encoding': response.encoding,
+        'sha1': sha1(content).hexdigest(),
+    }
+    with _lock:
+        index = _load_index()
+        _write(CACHE_DIR / f'{key}.body', content)
+        _write(CACHE_DIR / f'{key}.json', dumps(meta).encode())
+        index.pop(key, None)
+        index[key] = len(content)
+        size = sum(index.values())
+        while size > CACHE_MAX_BYTES and index:
+            evicted, evicted_size = index.popitem(last=False)
+            size -= evicted_size
+            (CACHE_DIR / f'{evicted}.body').unlink(missing_ok=True)
+            (CACHE_DIR / f'{evicted}.json').unlink(missing_ok=True)
+
+
+def _cached(url: str) -> Response:
+    """
+    Get the cached response of the url
+    :returns Response object or None if it isn't cached or the body doesn't match its hash
+    """
+    key = _key(url)
+    with _lock:
+        index = _load_index()
+        if key not in index:
+            return None
+        index.move_to_end(key)
+    try:
+        meta = loads((CACHE_DIR / f'{key}.json').read_text())
+        content = (CACHE_DIR / f'{key}.body').read_bytes()
+    except (OSError, JSONDecodeError):
+        return None
+    if meta['url'] != url or sha1(content).hexdigest() != meta['sha1']:
+        logger.warning('dropping a corrupted cache entry of %s', url)
+        return None
+    response = Response()
+    response.status_code = 200
+    response.url = url
+    response.headers = CaseInsensitiveDict(meta['headers'])
+    response.encoding = meta['encoding']
+    response._content = content
+    return response
+
+
+def fetch(url: str, revalidate: bool = True, **kwargs) -> Response:
+    """
+    GET the url through the pooled session
+    :param url: url to get
+    :param revalidate: send ETag/Last-Modified of the response cached on disk and reuse it on 304
+    :param kwargs: any other parameters of requests.get
+    :returns Response object
+    """
+    host = parse_url(url).host
+    kwargs.setdefault('timeout', TIMEOUT)
+    headers = kwargs.pop('headers', {})
+    cached = _cached(url) if revalidate else None
+    if cached is not None:
+        if cached.headers.get('ETag'):
+            headers['If-None-Match'] = cached.headers['ETag']
+        if cached.headers.get('Last-Modified'):
+            headers['If-Modified-Since'] = cached.headers['Last-Modified']
+
+    with metrics.timer('store_fetch', host=host):
+        response = http.get(url, headers=headers, **kwargs)
+    metrics.inc('store_responses', host=host, status=response.status_code)
+    not_modified = response.status_code == 304 and cached is not None
+    with _lock:
+        stats = _stats[host]
+        stats['requests'] += 1
+        if not_modified:
+            stats['cache_hits'] += 1
+            stats['bytes_saved'] += len(cached.content)
+        else:
+            stats['bytes_received'] += len(response.content)
+    if not_modified:
+        metrics.inc('store_cache_hits', host=host)
+        metrics.inc('store_bytes_saved', len(cached.content), host=host)
+        logger.debug('not modified: %s', url)
+        return cached
+    metrics.inc('store_bytes_received', len(response.content), host=host)
+
+    if revalidate and response.status_code == 200 and \
+            ('ETag' in response.headers or 'Last-Modified' in response.headers):
+        _remember(url, response)
+    return response
+
+
+def get_stats() -> dict:
+    """
+    Get per-host counters of the fetch layer, the requests, cache hits and bytes are also counted in the
+    store_responses, store_cache_hits, store_bytes_saved and store_bytes_received metrics
+    :returns dict with hosts as keys and dicts with requests, reused_connections, cache_hits, bytes_saved and
+    bytes_received as values
+    """
+    with _lock:
+        stats = {host: dict(counters) for host, counters in _stats.items()}
+    pools = adapter.poolmanager.pools
+    for key in pools.keys():
+        pool = pools.get(key)
+        if pool is None:
+            continue
+        host_stats = stats.setdefault(pool.host, {})
+        host_stats['connections'] = host_stats.get('connections', 0) + pool.num_connections
+        host_stats['reused_connections'] = host_stats.get('reused_connections', 0) + \
+            pool.num_requests - pool.num_connections
+    return stats
@@ -0,0 +1,208 @@
+""" Bulk import of games into a wishlist """
+from concurrent.futures import ThreadPoolExecutor
+from csv import reader
+from re import fullmatch, split
+
+from requests import RequestException
+from sqlalchemy import or_
+
+from app.models import Game, PSN_URL, Price, User, Wish, resolution_cache, session_scope
+from app.refresh import RateLimiter
+
+import logging
+
+logger = logging.getLogger('importer')
+
+MAX_GAMES = 500
+MAX_REJECTED_LINE = 40
+CONCEPT_ID = r'\d{6,}'
+PRODUCT_ID = r'[A-Za-z]{2}\d{4}-[A-Za-z]{4}\d{5}_\d{2}-\w+'
+IMPORT_EXTENSIONS = ('.txt', '.csv')
+IMPORT_MIME_TYPES = ('text/plain', 'text/csv', 'text/comma-separated-values')
+
+
+def is_import_file(file_name: str, mime_type: str) -> bool:
+    """ Check if an uploaded document is a text or CSV file """
+    return mime_type in IMPORT_MIME_TYPES or (file_name or '').lower().endswith(IMPORT_EXTENSIONS)
+
+
+def rank_token(token: str) -> int:
+    """
+    Rank how much a token looks like a game, only the tokens of the best rank in a line are taken so that the
+    numbers in the names of the games are skipped next to the real IDs
+    :returns 3 for urls, 2 for the usual concept and product IDs, 1 for any other word with a digit that /add may
+    accept and 0 for the words that are not games
+    """
+    if '://' in token or PSN_URL in token:
+        return 3
+    if fullmatch(CONCEPT_ID, token) or fullmatch(PRODUCT_ID, token):
+        return 2
+    return 1 if any(char.isdigit() for char in token) else 0
+
+
+def parse_lines(text: str) -> (list, list, list):
+    """
+    Validate every url or ID of the text with Game.parse_game_id like /add does, the other words like names of the
+    games are skipped
+    :param text: urls or IDs one per line or in the cells of CSV lines separated by commas or semicolons
+    :returns tuple with list of unique (id type, ID) pairs in the order of the text, list of invalid urls and list of
+    the non-empty lines without any game, e.g. CSV headers
+    """
+    valid, invalid, rejected = {}, [], []
+    for line, cells in zip(text.splitlines(), reader(text.splitlines(), skipinitialspace=True)):
+        tokens = [token.strip('"\'') for cell in cells for token in split(r'[\s;]+', cell)]
+        ranks = [rank_token(token) for token in tokens]
+        best = max(ranks, default=0)
+        if not best:
+            if line.strip():
+                rejected.append(line.strip()[:MAX_REJECTED_LINE])
+            continue
+        for token, rank in zip(tokens, ranks):
+            if rank != best:
+                continue
+            try:
+                valid.setdefault(Game.parse_game_id(token), None)
+            except ValueError:
+                invalid.append(token)
+    return list(valid), invalid, rejected
+
+
+def _chunks(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def find_games(session, pairs: list, batch_size: int = 500) -> dict:
+    """
+    Find already known games by their IDs
+    :param session: Session instance
+    :param pairs: list of (id type, ID) pairs
+    :param batch_size: max number of IDs in one query
+    :returns dict with (id type, ID) pairs as keys and Game IDs as values
+    """
+    found = {}
+    for chunk in _chunks(pairs, batch_size):
+        concept_ids = [game_id for id_type, game_id in chunk if id_type == 'concept_id']
+        product_ids = [game_id for id_type, game_id in chunk if id_type == 'product_id']
+        for id_, concept_id, product_id in session.query(Game.id, Game.concept_id, Game.product_id).filter(
+                or_(Game.concept_id.in_(concept_ids), Game.product_id.in_(product_ids))):
+            found[('concept_id', concept_id)] = id_
+            if product_id:
+                found[('product_id', product_id)] = id_
+    return {pair: found[pair] for pair in pairs if pair in found}
+
+
+def resolve_games(pairs: list, workers: int = 16, rate_limit: float = 20.) -> (dict, list, list):
+    """
+    Get info about unknown games from the store concurrently
+    :param pairs: list of (id type, ID) pairs
+    :param workers: number of threads fetching store pages
+    :param rate_limit: max number of requests per second to the store
+    :returns tuple with dict of (id type, ID) pairs and their game info, list of pairs that aren't in the store and
+    list of pairs that couldn't be fetched because of network or server errors
+    """
+    limiter = RateLimiter(rate_limit)
+
+    def resolve(pair):
+        limiter.wait(PSN_URL)
+        try:
+            return Game.get_game_info(**{pair[0]: pair[1]}), None
+        except RequestException as e:
+            logger.warning('%s is not resolved: %r', pair, e)
+            return None, e
+        except Exception as e:
+            logger.info('%s is not found: %r', pair, e)
+            return None, None
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = dict(zip(pairs, pool.map(resolve, pairs)))
+    return {pair: info for pair, (info, _) in results.items() if info}, \
+        [pair for pair, (info, error) in results.items() if not info and not error], \
+        [pair for pair, (info, error) in results.items() if error]
+
+
+def find_cached(pairs: list) -> (dict, list):
+    """
+    Find the games resolved or rejected by /add and earlier imports in the resolution cache
+    :param pairs: list of (id type, ID) pairs
+    :returns tuple with dict of (id type, ID) pairs and Game IDs and list of pairs known to be invalid
+    """
+    found, missing = {}, []
+    for pair in pairs:
+        cached = resolution_cache.get(pair)
+        if cached is None:
+            continue
+        game_id, error = cached
+        if error:
+            missing.append(pair)
+        else:
+            found[pair] = game_id
+    return found, missing
+
+
+def import_games(user_id, text: str, workers: int = 16, batch_size: int = 100) -> dict:
+    """
+    Add all the games from the text to the wishlist of a user
+    :param user_id: ID of the user
+    :param text: urls or IDs of the games
+    :param workers: number of threads fetching store pages of unknown games
+    :param batch_size: number of games written in one transaction
+    :returns dict with lists of added, already wished, not found, failed and invalid games and rejected lines
+    """
+    pairs, invalid, rejected = parse_lines(text)
+    if len(pairs) > MAX_GAMES:
+        raise ValueError(f'За раз можно импортировать не больше {MAX_GAMES} игр')
+
+    known, missing = find_cached(pairs)
+    missing = set(missing)
+    with session_scope() as session:
+        User.get_or_create(id=user_id, session=session)
+        known.update(find_games(session, [pair for pair in pairs if pair not in known and pair not in missing]))
+    resolved, not_found, failed = resolve_games(
+        [pair for pair in pairs if pair not in known and pair not in missing], workers=workers)
+    missing.update(not_found)
+    not_found = [pair for pair in pairs if pair in missing]
+
+    added, wished = [], []
+    for chunk in _chunks(pairs, batch_size):
+        with session_scope() as session:
+            chunk_infos = {pair: resolved[pair] for pair in chunk if pair in resolved}
+            by_concept = {info['concept_id']: info for info in chunk_infos.values()}
+            existing = find_games(session, [('concept_id', concept_id) for concept_id in by_concept])
+            new_games = [concept_id for concept_id in by_concept if ('concept_id', concept_id) not in existing]
+            Game.upsert(session, [
+                {'concept_id': concept_id, 'name': by_concept[concept_id]['name'],
+                 'poster_url': by_concept[concept_id].get('poster_url')}
+                for concept_id in new_games
+            ], index_elements=('concept_id',))
+            created = find_games(session, [('concept_id', concept_id) for concept_id in new_games])
+            for (_, concept_id), game_id in created.items():
+                Price.update_price(game_id=game_id, game_info=by_concept[concept_id], session=session)
+            existing.update(created)
+
+            game_ids = {pair: known[pair] for pair in chunk if pair in known}
+            for pair, info in chunk_infos.items():
+                game_ids[pair] = existing[('concept_id', info['concept_id'])]
+                resolution_cache.put(game_ids[pair], pair, ('concept_id', info['concept_id']))
+            already = {game_id for game_id, in session.query(Wish.game_id).filter(
+                Wish.user_id == user_id, Wish.game_id.in_(set(game_ids.values())))}
+            new_wishes = []
+            for pair, game_id in game_ids.items():
+                if game_id in already:
+                    wished.append(pair[1])
+                else:
+                    new_wishes.append({'user_id': user_id, 'game_id': game_id})
+                    already.add(game_id)
+                    added.append(pair[1])
+            Wish.upsert(session, new_wishes, index_elements=('game_id', 'user_id'))
+
+    stats = {
+        'added': added,
+        'wished': wished,
+        'not_found': [game_id for _, game_id in not_found],
+        'failed': [game_id for _, game_id in failed],
+        'invalid': invalid,
+        'rejected': rejected,
+    }
+    logger.info('%s: %s', user_id, {key: len(value) for key, value in stats.items()})
+    return stats
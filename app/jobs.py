@@ -0,0 +1,274 @@
+""" Persistent job queue for the fetch and parse work of the worker processes
+
+The default queue lives in an SQLite file (PSNBOT_QUEUE_PATH, jobs.sqlite by default) so that it needs no external
+service, set PSNBOT_QUEUE=1 to make the bot and the nightly refresh enqueue jobs instead of doing the work in-process.
+"""
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from json import dumps, loads
+from os import environ
+from threading import local
+from time import sleep, time
+import sqlite3
+
+import logging
+
+logger = logging.getLogger('jobs')
+
+ENABLED = environ.get('PSNBOT_QUEUE', '0') == '1'
+QUEUE_PATH = environ.get('PSNBOT_QUEUE_PATH', 'jobs.sqlite')
+LEASE = 60
+MAX_ATTEMPTS = 3
+RETRY_DELAY = 10
+
+QUEUED, RUNNING, DONE, FAILED = 'queued', 'running', 'done', 'failed'
+
+
+class Job:
+    """ Claimed job """
+
+    def __init__(self, id_: int, kind: str, payload: str, attempts: int, max_attempts: int):
+        self.id = id_
+        self.kind = kind
+        self.payload = loads(payload)
+        self.attempts = attempts
+        self.max_attempts = max_attempts
+
+    def __repr__(self):
+        return f'Job({self.id}, {self.kind}, {self.payload}, attempt {self.attempts}/{self.max_attempts})'
+
+
+class JobQueue(ABC):
+    """ Queue of jobs that are leased to the workers, retried on failures and deduplicated by key """
+
+    @abstractmethod
+    def enqueue(self, kind: str, payload: dict, dedup_key: str = None, max_attempts: int = MAX_ATTEMPTS,
+                delay: float = 0) -> int:
+        """
+        Add a job to the queue unless a job with the same key is already waiting or running
+        :param kind: name of the job handler
+        :param payload: json-serializable arguments of the handler
+        :param dedup_key: key of the job, e.g. 'refresh:<game ID>:<locale>'
+        :param max_attempts: number of attempts before the job is marked as failed
+        :param delay: seconds before the job can be claimed
+        :returns ID of the new job or of the already queued one
+        """
+
+    @abstractmethod
+    def claim(self, worker: str, limit: int = 1, lease: float = LEASE) -> list:
+        """
+        Lease the jobs that are ready to run including the ones whose previous lease has expired and that have
+        attempts left
+        :param worker: name of the worker
+        :param limit: max number of jobs
+        :param lease: seconds the jobs belong to the worker
+        :returns list of Job objects
+        """
+
+    @abstractmethod
+    def expire(self) -> list:
+        """
+        Mark the jobs whose lease expired on the last attempt as failed, e.g. after their worker was killed
+        :returns list of Job objects that are failed for good like after fail returned True
+        """
+
+    @abstractmethod
+    def extend(self, job_id: int, lease: float = LEASE):
+        """ Prolong the lease of a long job """
+
+    @abstractmethod
+    def complete(self, job_id: int):
+        """ Mark the job as done """
+
+    @abstractmethod
+    def fail(self, job_id: int, error: str, retry_delay: float = RETRY_DELAY) -> bool:
+        """
+        Schedule a retry of the job with exponential backoff or mark it as failed if it has no attempts left
+        :param job_id: ID of the job
+        :param error: description of the error
+        :param retry_delay: delay of the first retry in seconds
+        :returns True if the job is failed for good
+        """
+
+    @abstractmethod
+    def get_stats(self) -> dict:
+        """
+        Get the number of jobs by state
+        :returns dict with job kinds as keys and dicts of states and numbers as values
+        """
+
+    def wait(self, kind: str = None, timeout: float = None, poll_interval: float = 1.) -> bool:
+        """
+        Block until there are no queued or running jobs
+        :param kind: wait only for the jobs of this kind
+        :param timeout: max seconds to wait, forever if None
+        :param poll_interval: seconds between the checks
+        :returns True if the queue is drained, False on timeout
+        """
+        deadline = time() + timeout if timeout is not None else None
+        while True:
+            stats = self.get_stats()
+            pending = sum(counts.get(QUEUED, 0) + counts.get(RUNNING, 0)
+                          for job_kind, counts in stats.items() if kind in (None, job_kind))
+            if not pending:
+                return True
+            if deadline is not None and time() > deadline:
+                return False
+            sleep(poll_interval)
+
+
+class SQLiteJobQueue(JobQueue):
+    """ Job queue in an SQLite file shared by the processes of one host """
+
+    def __init__(self, path: str = QUEUE_PATH):
+        """
+        :param path: path to the database file
+        """
+        self.path = path
+        self._local = local()
+        self._connection().executescript('''
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                dedup_key TEXT,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                max_attempts INTEGER NOT NULL,
+                run_at REAL NOT NULL,
+                lease_until REAL,
+                worker TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE UNIQUE INDEX IF NOT EXISTS ix_jobs_dedup_key ON jobs (dedup_key)
+                WHERE dedup_key IS NOT NULL AND state IN ('queued', 'running');
+            CREATE INDEX IF NOT EXISTS ix_jobs_state_run_at ON jobs (state, run_at);
+        ''')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    @contextmanager
+    def _transaction(self):
+        """ Run the block in a write transaction so that the processes never claim the same job """
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            yield connection
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def enqueue(self, kind: str, payload: dict, dedup_key: str = None, max_attempts: int = MAX_ATTEMPTS,
+                delay: float = 0) -> int:
+        now = time()
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                'INSERT OR IGNORE INTO jobs (kind, payload, dedup_key, state, max_attempts, run_at, created_at, '
+                'updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (kind, dumps(payload), dedup_key, QUEUED, max_attempts, now + delay, now, now)
+            )
+            if cursor.rowcount:
+                return cursor.lastrowid
+            logger.debug('%s is already queued', dedup_key)
+            return connection.execute(
+                "SELECT id FROM jobs WHERE dedup_key = ? AND state IN ('queued', 'running')", (dedup_key,)
+            ).fetchone()[0]
+
+    def claim(self, worker: str, limit: int = 1, lease: float = LEASE) -> list:
+        now = time()
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, kind, payload, attempts + 1, max_attempts FROM jobs "
+                "WHERE state = 'queued' AND run_at <= ? "
+                "OR state = 'running' AND lease_until < ? AND attempts < max_attempts "
+                "ORDER BY run_at LIMIT ?",
+                (now, now, limit)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, lease_until = ?, worker = ?, "
+                "updated_at = ? WHERE id = ?",
+                [(now + lease, worker, now, row[0]) for row in rows]
+            )
+        return [Job(*row) for row in rows]
+
+    def expire(self) -> list:
+        now = time()
+        with self._transaction() as connection:
+            rows = connection.execute(
+                "SELECT id, kind, payload, attempts, max_attempts FROM jobs "
+                "WHERE state = 'running' AND lease_until < ? AND attempts >= max_attempts",
+                (now,)
+            ).fetchall()
+            connection.executemany(
+                "UPDATE jobs SET state = 'failed', lease_until = NULL, error = 'lease expired', updated_at = ? "
+                "WHERE id = ?",
+                [(now, row[0]) for row in rows]
+            )
+        return [Job(*row) for row in rows]
+
+    def extend(self, job_id: int, lease: float = LEASE):
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET lease_until = ? WHERE id = ? AND state = 'running'",
+                               (time() + lease, job_id))
+
+    def complete(self, job_id: int):
+        with self._transaction() as connection:
+            connection.execute("UPDATE jobs SET state = 'done', lease_until = NULL, updated_at = ? WHERE id = ?",
+                               (time(), job_id))
+
+    def fail(self, job_id: int, error: str, retry_delay: float = RETRY_DELAY) -> bool:
+        now = time()
+        with self._transaction() as connection:
+            attempts, max_attempts = connection.execute(
+                'SELECT attempts, max_attempts FROM jobs WHERE id = ?', (job_id,)
+            ).fetchone()
+            if attempts < max_attempts:
+                connection.execute(
+                    "UPDATE jobs SET state = 'queued', run_at = ?, lease_until = NULL, error = ?, updated_at = ? "
+                    "WHERE id = ?",
+                    (now + retry_delay * 2 ** (attempts - 1), error, now, job_id)
+                )
+                return False
+            connection.execute(
+                "UPDATE jobs SET state = 'failed', lease_until = NULL, error = ?, updated_at = ? WHERE id = ?",
+                (error, now, job_id)
+            )
+            return True
+
+    def get_stats(self) -> dict:
+        stats = {}
+        for kind, state, count in self._connection().execute(
+                'SELECT kind, state, count(*) FROM jobs GROUP BY kind, state'):
+            stats.setdefault(kind, {})[state] = count
+        return stats
+
+    def purge(self, older_than: float = 7 * 24 * 60 * 60) -> int:
+        """
+        Delete finished jobs
+        :param older_than: age of the jobs in seconds
+        :returns number of deleted jobs
+        """
+        with self._transaction() as connection:
+            return connection.execute("DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated_at < ?",
+                                      (time() - older_than,)).rowcount
+
+
+_queue = None
+
+
+def get_queue() -> JobQueue:
+    """ Get the default queue of the process """
+    global _queue
+    if _queue is None:
+        _queue = SQLiteJobQueue()
+    return _queue
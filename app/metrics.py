@@ -0,0 +1,143 @@
+""" Lightweight timers and counters of the hot paths with Prometheus-style text output
+
+Set PSNBOT_METRICS=0 to turn all of them off, PSNBOT_METRICS_PORT to serve them at /metrics (on 127.0.0.1 unless
+PSNBOT_METRICS_HOST says otherwise) and PSNBOT_METRICS_FILE to dump them to a file.
+"""
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from os import environ
+from threading import Lock, Thread
+from time import perf_counter
+
+import logging
+
+logger = logging.getLogger('metrics')
+
+ENABLED = environ.get('PSNBOT_METRICS', '1') != '0'
+PORT = environ.get('PSNBOT_METRICS_PORT')
+HOST = environ.get('PSNBOT_METRICS_HOST', '127.0.0.1')
+FILE = environ.get('PSNBOT_METRICS_FILE')
+PREFIX = 'psnbot'
+
+_lock = Lock()
+_counters = defaultdict(float)
+_timers = defaultdict(lambda: [0, 0.])
+
+
+def _key(metric: str, labels: dict) -> tuple:
+    return metric, tuple(sorted(labels.items()))
+
+
+def inc(metric: str, value: float = 1, **labels):
+    """
+    Increase a counter
+    :param metric: name of the counter
+    :param value: increment
+    :param labels: labels of the counter
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[_key(metric, labels)] += value
+
+
+def observe(metric: str, seconds: float, **labels):
+    """
+    Add a measured duration to a timer
+    :param metric: name of the timer
+    :param seconds: duration
+    :param labels: labels of the timer
+    """
+    if not ENABLED:
+        return
+    with _lock:
+        timer = _timers[_key(metric, labels)]
+        timer[0] += 1
+        timer[1] += seconds
+
+
+@contextmanager
+def timer(metric: str, **labels):
+    """ Measure the duration of the block """
+    if not ENABLED:
+        yield
+        return
+    started_at = perf_counter()
+    try:
+        yield
+    finally:
+        observe(metric, perf_counter() - started_at, **labels)
+
+
+def timed(metric: str, **labels):
+    """ Measure the duration of every call of the decorated function """
+
+    def decorator(func):
+        if not ENABLED:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(metric, **labels):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def _labels(labels: tuple) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{str(value)}"' for key, value in labels) + '}'
+
+
+def render() -> str:
+    """ Make Prometheus text exposition of all the metrics """
+    with _lock:
+        counters = dict(_counters)
+        timers = {key: tuple(value) for key, value in _timers.items()}
+    lines = []
+    for (name, labels), value in sorted(counters.items()):
+        lines.append(f'{PREFIX}_{name}_total{_labels(labels)} {value:g}')
+    for (name, labels), (count, total) in sorted(timers.items()):
+        lines.append(f'{PREFIX}_{name}_seconds_count{_labels(labels)} {count}')
+        lines.append(f'{PREFIX}_{name}_seconds_sum{_labels(labels)} {total:.6f}')
+    return '\n'.join(lines) + '\n'
+
+
+def dump(path: str = FILE):
+    """ Write the metrics to a file if it is configured """
+    if ENABLED and path:
+        with open(path, 'w') as file:
+            file.write(render())
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render().encode() if self.path.split('?')[0] == '/metrics' else b''
+        self.send_response(200 if body else 404)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(port=PORT, host: str = HOST):
+    """
+    Serve the metrics at http://<host>:<port>/metrics in a background thread if the port is configured
+    :param port: port to listen on
+    :param host: address to listen on, only the local machine can read the metrics by default
+    :returns ThreadingHTTPServer object or None if the metrics aren't served
+    """
+    if not (ENABLED and port):
+        return None
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    logger.info('serving metrics on %s:%s', host, port)
+    return server
@@ -1,24 +1,72 @@
 """ File with basic DB models for the bot"""
-from json import loads
 from re import fullmatch
-from sqlalchemy.exc import IntegrityError
-from bs4 import BeautifulSoup as Soup
-from requests import get
-from sqlalchemy import create_engine, Column, Integer, String, Date, ForeignKey, UniqueConstraint, or_
+from sqlalchemy import create_engine, event, Column, Integer, String, Date, ForeignKey, Index, UniqueConstraint, \
+    and_, bindparam, func, inspect, text
 from sqlalchemy.ext.declarative import declarative_base, AbstractConcreteBase
 from sqlalchemy.orm import sessionmaker
 from urllib3.util import parse_url
 from uuid import uuid4
+from collections import OrderedDict
 from contextlib import contextmanager
-from datetime import date, datetime as dt
+from app import metrics
+from app.resolver import ResolutionCache
+from datetime import date, datetime, timedelta
+from os import environ
+from time import perf_counter
 
 import logging
 
-db = create_engine('sqlite:///psnbot.sqlite', echo=False)
+DB_URL = environ.get('PSNBOT_DB_URL', 'sqlite:///psnbot.sqlite')
+LOG_LEVEL = environ.get('PSNBOT_LOG_LEVEL', 'INFO')
+_logging_configured = False
+
+
+def make_engine(url: str = DB_URL):
+    """
+    Create an engine with tuned connections: WAL journal and busy timeout for SQLite, a pool for the others
+    :param url: database url, PSNBOT_DB_URL environment variable or local psnbot.sqlite file by default
+    :returns Engine object
+    """
+    if url.startswith('sqlite'):
+        engine = create_engine(url, echo=False, connect_args={'check_same_thread': False, 'timeout': 30})
+
+        @event.listens_for(engine, 'connect')
+        def set_sqlite_pragmas(connection, _):
+            cursor = connection.cursor()
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+            cursor.execute('PRAGMA busy_timeout=30000')
+            cursor.close()
+    else:
+        engine = create_engine(
+            url,
+            echo=False,
+            pool_size=int(environ.get('PSNBOT_DB_POOL_SIZE', 10)),
+            max_overflow=int(environ.get('PSNBOT_DB_MAX_OVERFLOW', 20)),
+            pool_pre_ping=True,
+        )
+
+    if metrics.ENABLED:
+        @event.listens_for(engine, 'before_cursor_execute')
+        def start_query_timer(connection, cursor, statement, parameters, context, executemany):
+            context.query_started_at = perf_counter()
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def stop_query_timer(connection, cursor, statement, parameters, context, executemany):
+            metrics.observe('db_query', perf_counter() - context.query_started_at,
+                            statement=statement.lstrip().split(None, 1)[0].upper())
+
+    return engine
+
+
+db = make_engine()
 Base = declarative_base(bind=db)
 Session = sessionmaker(bind=db)
+resolution_cache = ResolutionCache()
 
 PSN_URL = 'store.playstation.com'
+DEFAULT_LOCALE = 'ru-ru'
+STORE_URL = environ.get('PSNBOT_STORE_URL', f'https://{PSN_URL}')
 
 
 @contextmanager
@@ -44,12 +92,16 @@ class BaseModel(Base, AbstractConcreteBase):
     @classmethod
     def logger(cls):
         """
-        Log a message with a given level 
+        Get a logger of the model, the log file is configured on the first call only
         """
+        global _logging_configured
+        if _logging_configured:
+            return logging.getLogger(cls.__name__)
+        _logging_configured = True
         logging.basicConfig(
             filename='bot.log',
             filemode='a',
-            level=logging.DEBUG,
+            level=LOG_LEVEL,
             format='%(asctime)s.%(msecs)d[%(name)s.%(levelname)s]: '
                    '[%(filename)s:%(lineno)s - %(funcName)20s() ] '
                    '%(message)s',
@@ -59,13 +111,13 @@ class BaseModel(Base, AbstractConcreteBase):
     @classmethod
     def get(cls, session: Session, **kwargs):
         """ Get a model object by given parameters """
-        cls.logger().info(f'{kwargs}')
+        cls.logger().debug('%s', kwargs)
         return session.query(cls).filter_by(**kwargs).one_or_none()
 
     @classmethod
     def get_all(cls, session: Session, **kwargs):
         """ Get all the objects that fits given parameters """
-        cls.logger().info(f'{kwargs}')
+        cls.logger().debug('%s', kwargs)
         return session.query(cls).filter_by(**kwargs).all()
 
     @classmethod
@@ -73,7 +125,7 @@ class BaseModel(Base, AbstractConcreteBase):
         """ Create a model object with given parameters
         :returns tuple with created object and True if the object was created else False
         """
-        cls.logger().info(f'{kwargs}')
+        cls.logger().debug('%s', kwargs)
         instance = session.query(cls).filter_by(**kwargs).one_or_none()
         if not instance:
             instance = cls(**kwargs)
@@ -83,6 +135,39 @@ class BaseModel(Base, AbstractConcreteBase):
             was_created = False
         return instance, was_created
 
+    @classmethod
+    def upsert(cls, session: Session, rows: list, index_elements: tuple, update: tuple = ()) -> int:
+        """
+        Insert many rows with one INSERT ... ON CONFLICT statement instead of a SELECT and an INSERT per row
+        (SQLite 3.24+ and PostgreSQL)
+        :param session: Session instance
+        :param rows: list of dicts with column values, the missing columns get their defaults
+        :param index_elements: names of the columns of the unique constraint the rows can conflict on
+        :param update: names of the columns updated in the conflicting rows, these rows are left as they are if empty
+        :returns number of the rows
+        """
+        if not rows:
+            return 0
+        cls.logger().debug('%s rows', len(rows))
+        columns = [column for column in cls.__table__.columns
+                   if column.default is not None or any(column.name in row for row in rows)]
+        values = [
+            {column.name: row[column.name] if column.name in row else
+             column.default.arg(None) if column.default is not None and column.default.is_callable else
+             column.default.arg if column.default is not None else None
+             for column in columns}
+            for row in rows
+        ]
+        action = 'DO UPDATE SET ' + ', '.join(f'{name} = excluded.{name}' for name in update) if update \
+            else 'DO NOTHING'
+        statement = text(
+            f'''INSERT INTO {cls.__tablename__} ({', '.join(column.name for column in columns)}) '''
+            f'''VALUES ({', '.join(f':{column.name}' for column in columns)}) '''
+            f'''ON CONFLICT ({', '.join(index_elements)}) {action}'''
+        ).bindparams(*[bindparam(column.name, type_=column.type) for column in columns])
+        session.execute(statement, values)
+        return len(rows)
+
     @classmethod
     def get_or_create(cls, session: Session, **kwargs) -> (Base, bool):
         """
@@ -91,7 +176,7 @@ class BaseModel(Base, AbstractConcreteBase):
         :param kwargs: specific for each model
         :return: tuple the object of given model with flag if the object was created
         """
-        cls.logger().info(f'{cls.__name__}:get_or_create({kwargs})')
+        cls.logger().debug('%s:get_or_create(%s)', cls.__name__, kwargs)
         instance = cls.get(session=session, **kwargs)
         if instance:
             return instance, False
@@ -106,7 +191,7 @@ class BaseModel(Base, AbstractConcreteBase):
         :param session: Session instance
         :param kwargs: any possible parameters
         """
-        cls.logger().debug(f'{cls}.delete({kwargs})')
+        cls.logger().debug('%s.delete(%s)', cls, kwargs)
         session.query(cls).filter(**kwargs).delete()
 
 
@@ -115,6 +200,33 @@ class User(BaseModel):
     __tablename__ = 'users'
     id = Column(String, primary_key=True)
     email = Column(String, unique=True, nullable=True)
+    locale = Column(String, nullable=True, default=DEFAULT_LOCALE)
+
+    @staticmethod
+    def set_locale(session: Session, user_id, locale: str) -> 'User':
+        """
+        Set the store region of a user
+        :param session: Session instance
+        :param user_id: ID of the user
+        :param locale: locale of the store like ru-ru or en-us
+        :returns User object
+        """
+        locale = locale.strip().lower()
+        if not fullmatch(r'[a-z]{2}-[a-z]{2}', locale):
+            raise ValueError('Неверный регион. Регион магазина выглядит так: `ru-ru`, `en-us`, `de-de`')
+        user, _ = User.get_or_create(id=user_id, session=session)
+        user.locale = locale
+        return user
+
+    @staticmethod
+    def get_locale(session: Session, user_id) -> str:
+        """
+        Get the store region of a user
+        :param session: Session instance
+        :param user_id: ID of the user
+        :returns locale like ru-ru, DEFAULT_LOCALE for the unknown users
+        """
+        return session.query(User.locale).filter(User.id == user_id).scalar() or DEFAULT_LOCALE
 
 
 class Game(BaseModel):
@@ -126,94 +238,61 @@ class Game(BaseModel):
     poster_url = Column(String, unique=False, nullable=True)
 
     @staticmethod
-    def get_game_info(concept_id: str = None, product_id: str = None, game_url: str = None,
-                      store_locale='ru-ru') -> dict:
+    def get_game_url(concept_id: str = None, product_id: str = None, game_url: str = None,
+                     store_locale='ru-ru') -> str:
         """
-        Parse game info from PSN store.
+        Get the url of the game page in PSN store
         :param product_id: product ID (required if concept_id and game_url aren't provided)
         :param concept_id: concept ID (required if product_id and game_url aren't provided)
         :param game_url: url of the game in the PSN store (required if game_id isn't provided)
         :param store_locale: str, russian store is default
-        :returns dict with information about a game from PSN store or None if the game does not exist
+        :returns url of the concept or product page
         """
-
-        Game.logger().info(f'{concept_id, product_id, game_url, store_locale}')
         if not (product_id or concept_id or game_url):
             raise ValueError('There is at least one of concept_id, product_ or game_url arguments needed.')
 
         if concept_id:
-            game_url = f'''https://{PSN_URL}/{store_locale}/concept/{concept_id}'''
+            return f'''{STORE_URL}/{store_locale}/concept/{concept_id}'''
         elif product_id:
-            game_url = f'''https://{PSN_URL}/{store_locale}/product/{product_id}'''
+            return f'''{STORE_URL}/{store_locale}/product/{product_id}'''
+        return game_url
 
-        game_page = Soup(
-            markup=get(url=game_url).text.replace(u'\xa0', u''),
-            features='html.parser'
-        )
+    @staticmethod
+    def get_game_info(concept_id: str = None, product_id: str = None, game_url: str = None,
+                      store_locale='ru-ru') -> dict:
+        """
+        Parse game info from PSN store.
+        :param product_id: product ID (required if concept_id and game_url aren't provided)
+        :param concept_id: concept ID (required if product_id and game_url aren't provided)
+        :param game_url: url of the game in the PSN store (required if game_id isn't provided)
+        :param store_locale: str, russian store is default
+        :returns dict with information about a game from PSN store or None if the game does not exist
+        """
 
-        data = game_page.select_one('div[class="pdp-upsells script"]')
-        if data is None:
-            data = game_page.select_one('div[class="pdp-cta"] script')
-        data = loads(next(data.children))['cache']
+        from app.fetch import fetch
+        from app.parser import parse_game_page
 
-        concept_id = concept_id or next(key for key in data if key.startswith('Concept:')).replace('Concept:', '')
+        Game.logger().debug('%s', (concept_id, product_id, game_url, store_locale))
+        game_url = Game.get_game_url(concept_id=concept_id, product_id=product_id, game_url=game_url,
+                                     store_locale=store_locale)
+        page = fetch(game_url).text
+        with metrics.timer('page_parse'):
+            game_info = parse_game_page(page, concept_id=concept_id)
 
-        id_name = {
-            f'''GameCTA:{
-                v.get(
-                    'activeCtaId', 
-                    v.get('webctas', v['skus'])[0]['__ref'].replace('Sku', '').replace('GameCTA', '')
-                )
-            }''':
-                v.get('edition', v)['name'] for k, v in data.items() \
-            if k.startswith('Product')
-        }
-
-        id_data = {
-            edition_name: {
-                'original_price': data[id_]['local']['telemetryMeta']['skuDetail']['skuPriceDetail'][0][
-                                      'originalPriceValue'] // 100,
-                'sale_price': data[id_]['local']['telemetryMeta']['skuDetail']['skuPriceDetail'][0][
-                                  'discountPriceValue'] // 100,
-                'valid_until': dt.fromtimestamp(int(data[id_]['price']['endTime'] or 10 ** 14) // 1000),
-                'currency': data[id_]['price']['currencyCode']
-            } for id_, edition_name in id_name.items() if id_ in data
-        }
-
-        concept_info = data[f'Concept:{concept_id}']
-        if 'media' not in concept_info:
-            concept_info = loads(
-                Soup(loads(game_page.select_one('#__NEXT_DATA__').next
-                           )['props']['pageProps']['batarangs']['background-image']['text'],
-                     'html.parser'
-                     ).script.next
-            )['cache'][f'Concept:{concept_id}']
-        product_info = next(v for k, v in data.items() if k.startswith('Product'))
-
-        game_info = {
-            'name': concept_info.get('name', product_info['name']),
-            'poster_url': next(x['url'] for x in concept_info['media'] if x['role'] == 'MASTER'),
-            'editions': id_data,
-            'concept_id': concept_id,
-        }
-
-        Game.logger().debug(
-            f'''concept_id, poster_url: {concept_id, game_info['poster_url']}''')
+        Game.logger().debug('concept_id, poster_url: %s', (game_info['concept_id'], game_info['poster_url']))
 
         return game_info
 
     @staticmethod
-    def get_or_create(session: Session, **kwargs) -> (BaseModel, bool):
+    def parse_game_id(game_id: str) -> (str, str):
         """
-        Check the correctness of game_id and then check if the game exists in the store.
-        :param session: Session instance
-        :param kwargs: should include game_id param
-        :returns Game object and True if it was successfully created else False
+        Check the correctness of game_id and get the ID out of the url
+        :param game_id: url or concept ID or product ID of the game
+        :returns tuple with type of the ID (concept_id or product_id) and the ID itself
         """
-        Game.logger().debug(f'({kwargs})')
-        game_id = kwargs['game_id']
+        game_id = game_id.strip()
         if not fullmatch(r'\d+|[\d\w-]+', game_id):
-            Game.logger().debug(msg=f'not full matched: {game_id}')
+            Game.logger().debug('not full matched: %s', game_id)
             game_url = parse_url(game_id)
             if game_url.host != PSN_URL or not fullmatch(
                     r'/[a-z\-]+/(concept/\d+|product/[\w\d-]+)',
@@ -224,38 +303,64 @@ class Game(BaseModel):
                                  игры] ```''')
             game_id = game_url.path.split('/')[-1]
         if game_id.isnumeric():
-            id_type = 'concept_id'
-        else:
-            id_type = 'product_id'
+            return 'concept_id', game_id
+        return 'product_id', game_id
 
-        game = Game.get(**{id_type: game_id}, session=session)
+    @staticmethod
+    def get_or_create(session: Session, **kwargs) -> (BaseModel, bool):
+        """
+        Check the correctness of game_id and then check if the game exists in the store.
+        :param session: Session instance
+        :param kwargs: should include game_id param
+        :returns Game object and True if it was successfully created else False
+        """
+        Game.logger().debug('(%s)', kwargs)
+        raw_id = kwargs['game_id'].strip()
+        game = Game.get_cached(session, raw_id)
+        if game:
+            return game, False
+        try:
+            id_type, game_id = Game.parse_game_id(raw_id)
+        except ValueError as ve:
+            resolution_cache.put_invalid(str(ve), raw_id)
+            raise
+        game = Game.get_cached(session, (id_type, game_id)) or Game.get(**{id_type: game_id}, session=session)
         if game:
-            Game.logger().debug(f'Game.get_or_create game already exists: {game_id, game.name}')
+            Game.logger().debug('Game.get_or_create game already exists: %s', (game_id, game.name))
+            resolution_cache.put(game.id, raw_id, (id_type, game_id), ('concept_id', game.concept_id))
             return game, False
         try:
             game_info = Game.get_game_info(concept_id=game_id) if game_id.isnumeric() \
                 else Game.get_game_info(product_id=game_id)
         except (StopIteration, ValueError):
-            raise ValueError('Введён несуществующий идентификатор игры. Его можно найти после `/product/` или'
-                             '`/concept/` в url на сайте PSN Store')
-        Game.logger().debug(f'game_info received: {game_info}')
+            error = 'Введён несуществующий идентификатор игры. Его можно найти после `/product/` или' \
+                    '`/concept/` в url на сайте PSN Store'
+            resolution_cache.put_invalid(error, raw_id, (id_type, game_id))
+            raise ValueError(error)
+        Game.logger().debug('game_info received: %s', game_info)
         game = Game.get(concept_id=game_info.get('concept_id'), session=session)
         if game is None:
             if game_info:
-                game, game_was_created = Game.create(
-                    product_id=game_info.get('product_id'),
-                    concept_id=game_info.get('concept_id'),
-                    name=game_info['name'],
-                    poster_url=game_info.get('poster_url'),
-                    session=session
-                )
+                # a concurrent add of the same game may insert it first, the row that won is selected then
+                new_id = str(uuid4())
+                Game.upsert(session, [{
+                    'id': new_id,
+                    'product_id': game_info.get('product_id'),
+                    'concept_id': game_info.get('concept_id'),
+                    'name': game_info['name'],
+                    'poster_url': game_info.get('poster_url'),
+                }], index_elements=('concept_id',))
+                game = Game.get(concept_id=game_info.get('concept_id'), session=session)
+                game_was_created = game.id == new_id
 
                 Price.update_price(game_id=game.id, game_info=game_info, session=session)
+                resolution_cache.put(game.id, raw_id, (id_type, game_id), ('concept_id', game.concept_id))
                 return game, game_was_created
             else:
                 raise ValueError('Введён несуществующий идентификатор игры. Его можно найти после `/product/` или'
                                  f'`/concept/` в url на сайте PSN Store: {PSN_URL}')
         else:
+            resolution_cache.put(game.id, raw_id, (id_type, game_id), ('concept_id', game.concept_id))
             with session_scope() as sess:
                 sess.query(Game).filter(
                     Game.concept_id == game.concept_id
@@ -264,8 +369,49 @@ class Game(BaseModel):
                 )
                 return game, False
 
+    @staticmethod
+    def get_cached(session: Session, key) -> 'Game':
+        """
+        Get a game by an identifier from the resolution cache without any store requests
+        :param session: Session instance
+        :param key: raw identifier from the user or (id type, ID) pair
+        :returns Game object or None if the identifier isn't cached
+        :raises ValueError if the identifier is known to be invalid
+        """
+        cached = resolution_cache.get(key)
+        if cached is None:
+            return None
+        game_id, error = cached
+        if error:
+            raise ValueError(error)
+        game = session.query(Game).get(game_id)
+        if game is None:
+            resolution_cache.discard(key)
+        return game
+
+    @staticmethod
+    def warm_cache(session: Session, limit: int = None) -> int:
+        """
+        Fill the resolution cache with the games from the database
+        :param session: Session instance
+        :param limit: max number of games, the cache size by default
+        :returns number of cached games
+        """
+        count = 0
+        for game_id, concept_id, product_id in session.query(Game.id, Game.concept_id, Game.product_id).limit(
+                limit or resolution_cache.max_size):
+            resolution_cache.put(game_id, concept_id, product_id,
+                                 concept_id and ('concept_id', concept_id), product_id and ('product_id', product_id))
+            count += 1
+        Game.logger().info('%s games are cached', count)
+        return count
+
+    def link(self, locale: str = DEFAULT_LOCALE) -> str:
+        """ Make a Markdown link to the game page in the store of the locale """
+        return f'[{self.name}](https://{PSN_URL}/{locale}/concept/{self.concept_id}/)'
+
     def __str__(self):
-        return f'[{self.name}](https://store.playstation.com/ru-ru/concept/{self.concept_id}/)'
+        return self.link()
 
 
 class Wish(BaseModel):
@@ -274,6 +420,7 @@ class Wish(BaseModel):
     user_id = Column(String, ForeignKey('users.id', onupdate="CASCADE", ondelete="CASCADE"))
     game_id = Column(String, ForeignKey('games.id', onupdate="CASCADE", ondelete="CASCADE"))
     gu = UniqueConstraint(game_id, user_id)
+    user_index = Index('ix_wishes_user_id_game_id', user_id, game_id)
 
     @staticmethod
     def get_or_create(session: Session = None, **kwargs) -> (Base, bool):
@@ -286,16 +433,16 @@ class Wish(BaseModel):
         user_id = kwargs['user_id']
         game_id = kwargs['game_id']
         session = session or Session()
-        Game.logger().debug(f'Wish.get_or_create({user_id, game_id})')
-        user, is_created = User.get_or_create(id=user_id, session=session)
+        Game.logger().debug('Wish.get_or_create(%s)', (user_id, game_id))
+        User.upsert(session, [{'id': str(user_id)}], index_elements=('id',))
         game, is_created = Game.get_or_create(game_id=game_id, session=session)
         if game:
-            try:
-                wish, is_created = Wish.create(user_id=user.id, game_id=game.id, session=session)
-            except (IntegrityError,):
-                is_created = False
-                wish = None
-            return wish, is_created
+            # INSERT ... ON CONFLICT so that the same game added twice at once doesn't fail on the unique constraint
+            new_id = str(uuid4())
+            Wish.upsert(session, [{'id': new_id, 'user_id': str(user_id), 'game_id': game.id}],
+                        index_elements=('game_id', 'user_id'))
+            wish = Wish.get(user_id=str(user_id), game_id=game.id, session=session)
+            return wish, wish.id == new_id
         else:
             return None, False
 
@@ -313,17 +460,151 @@ class Wish(BaseModel):
         user, user_was_created = User.get_or_create(id=user_id, session=session)
         game, game_was_created = Game.get_or_create(game_id=game_id, session=session)
         if not (user_was_created or game_was_created):
+            session.query(WatchRule).filter(WatchRule.user_id == user.id, WatchRule.game_id == game.id).delete()
             was_deleted = session.query(Wish).filter(Wish.user_id == user.id, Wish.game_id == game.id).delete()
         else:
             was_deleted = None, False
         return was_deleted
 
+    @staticmethod
+    def count_games(session: Session, user_id) -> int:
+        """
+        Get the size of the wishlist of a user
+        :param session: Session instance
+        :param user_id: ID of the user
+        :returns number of wished games
+        """
+        return session.query(func.count(Wish.id)).filter(Wish.user_id == user_id).scalar()
+
+    @staticmethod
+    def get_games(session: Session, user_id, with_prices: bool = False, locale: str = DEFAULT_LOCALE,
+                  offset: int = 0, limit: int = None) -> list:
+        """
+        Get games from a wishlist of a given user sorted by name in one query
+        :param session: Session instance
+        :param user_id: ID of the user
+        :param with_prices: add the current and the lowest prices of every game edition
+        :param locale: locale of the prices
+        :param offset: number of games to skip
+        :param limit: max number of games, all the games if None
+        :returns list of Game objects or list of tuples (Game, list of its PriceStats objects) if with_prices
+        """
+        Wish.logger().debug('%s', (user_id, with_prices, offset, limit))
+        query = session.query(Game).join(Wish, Wish.game_id == Game.id).filter(Wish.user_id == user_id)
+        if not with_prices:
+            return query.order_by(Game.name, Game.id).offset(offset).limit(limit).all()
+
+        page = session.query(Game.id).join(Wish, Wish.game_id == Game.id).filter(
+            Wish.user_id == user_id
+        ).order_by(Game.name, Game.id).offset(offset).limit(limit).subquery()
+        rows = query.join(
+            page, page.c.id == Game.id
+        ).outerjoin(
+            PriceStats, and_(PriceStats.game_id == Game.id, PriceStats.locale == locale)
+        ).add_entity(PriceStats).order_by(Game.name, Game.id, PriceStats.edition).all()
+
+        games = OrderedDict()
+        for game, price in rows:
+            prices = games.setdefault(game, [])
+            if price is not None:
+                prices.append(price)
+        return list(games.items())
+
+
+class WatchRule(BaseModel):
+    """
+    A condition on the price of a wished game: a user with rules on a game is notified only about the prices that
+    match one of them. The indexes lead with (game, edition, threshold) so that the rules are looked up by the changed
+    prices and never scanned in full.
+    """
+    __tablename__ = 'watch_rules'
+    wish_id = Column(String, ForeignKey('wishes.id', onupdate="CASCADE", ondelete="CASCADE"), nullable=False)
+    user_id = Column(String, ForeignKey('users.id', onupdate="CASCADE", ondelete="CASCADE"), nullable=False)
+    game_id = Column(String, ForeignKey('games.id', onupdate="CASCADE", ondelete="CASCADE"), nullable=False)
+    edition = Column(String, nullable=True)
+    below_price = Column(Integer, nullable=True)
+    min_discount = Column(Integer, nullable=True)
+
+    price_index = Index('ix_watch_rules_game_id_edition_below_price', game_id, edition, below_price)
+    discount_index = Index('ix_watch_rules_game_id_edition_min_discount', game_id, edition, min_discount)
+    user_index = Index('ix_watch_rules_user_id_game_id', user_id, game_id)
+
+    @staticmethod
+    def add(session: Session, user_id, game_id: str, edition: str = None, below_price: int = None,
+            min_discount: int = None) -> 'WatchRule':
+        """
+        Add a rule to a wish, the game is added to the wishlist if it isn't there
+        :param session: Session instance
+        :param user_id: ID of the user
+        :param game_id: url or concept ID or product ID of the game
+        :param edition: part of the edition name, any edition if None
+        :param below_price: the price should be lower than this one
+        :param min_discount: the discount should be at least this number of percents
+        :returns WatchRule object
+        :raises ValueError if the game or the edition is not found
+        """
+        if min_discount is not None and not 0 < min_discount <= 100:
+            raise ValueError('Скидка указывается в процентах от 1 до 100')
+        wish, _ = Wish.get_or_create(user_id=user_id, game_id=game_id, session=session)
+        if wish is None:
+            raise ValueError(f'Игра с таким идентификатором не найдена: {game_id}')
+        session.flush()
+        if edition:
+            locale = User.get_locale(session, user_id)
+            editions = [name for name in PriceStats.get_for_game(session, wish.game_id, locale) if name]
+            found = sorted((name for name in editions if edition.lower() in name.lower()), key=len)
+            if not found:
+                raise ValueError(f'Издание «{edition}» не найдено, есть: {", ".join(sorted(editions))}')
+            edition = found[0]
+        rule, _ = WatchRule.create(session, wish_id=wish.id, user_id=wish.user_id, game_id=wish.game_id,
+                                   edition=edition or None, below_price=below_price, min_discount=min_discount)
+        return rule
+
+    @staticmethod
+    def get_for_wish(session: Session, user_id, game_id: str) -> list:
+        """
+        Get the rules of a wish
+        :param session: Session instance
+        :param user_id: ID of the user
+        :param game_id: ID of the game in the database
+        :returns list of WatchRule objects
+        """
+        return session.query(WatchRule).filter(WatchRule.user_id == user_id, WatchRule.game_id == game_id).order_by(
+            WatchRule.edition, WatchRule.below_price, WatchRule.min_discount).all()
+
+    def is_matched(self, price) -> bool:
+        """ Check a Price object or parsed edition info against the rule the same way the notifier does """
+        if isinstance(price, dict):
+            edition, original_price = price.get('edition'), price['original_price']
+        else:
+            edition, original_price = price.edition, price.original_price
+        current = PriceStats.effective_price(price)
+        if self.edition is not None and self.edition != edition:
+            return False
+        if self.below_price is None and self.min_discount is None:
+            return current < original_price
+        return (self.below_price is None or current < self.below_price) and \
+            (self.min_discount is None or (original_price - current) * 100 >= self.min_discount * original_price)
+
+    def __str__(self):
+        conditions = []
+        if self.below_price is not None:
+            conditions.append(f'дешевле {self.below_price}')
+        if self.min_discount is not None:
+            conditions.append(f'скидка от {self.min_discount}%')
+        if not conditions:
+            conditions.append('любая скидка')
+        if self.edition:
+            conditions.append(f'издание {self.edition}')
+        return ', '.join(conditions)
+
 
 class Price(BaseModel):
-    """ A record with a price of a game at specific day """
+    """ A price of a game edition that was the same from check_date to last_check_date """
     __tablename__ = 'prices'
     game_id = Column(String, ForeignKey('games.id', onupdate="CASCADE", ondelete="CASCADE"))
     check_date = Column(Date, nullable=False)
+    last_check_date = Column(Date, nullable=True)
     locale = Column(String, default='ru-ru', nullable=False)
     original_price = Column(Integer, nullable=False)
     sale_price = Column(Integer, nullable=True)
@@ -332,47 +613,303 @@ class Price(BaseModel):
     currency = Column(String, nullable=True, default='RUB')
 
     game_date_locale_edition = UniqueConstraint(game_id, check_date, locale, edition)
+    date_index = Index('ix_prices_check_date_game_id', check_date, game_id)
+
+    def is_same(self, edition_info: dict) -> bool:
+        """ Check if the price record has the same price as the parsed edition info """
+        valid_until = edition_info.get('valid_until')
+        if isinstance(valid_until, datetime):
+            valid_until = valid_until.date()
+        return (self.original_price, self.sale_price, self.valid_until, self.currency) == \
+            (edition_info['original_price'], edition_info.get('sale_price'), valid_until,
+             edition_info.get('currency', 'RUB'))
 
     @staticmethod
-    def update_price(game_id: str, session: Session, locale: str = 'ru-ru', game_info: dict = None):
+    def get_current(session: Session, game_id: str, locale: str = 'ru-ru') -> list:
         """
-        Get current price of a given game
+        Get the latest price record of every edition of a game
         :param session: Session instance
-        :param game_info: dict with game info if already uploaded, empty by default
+        :param game_id: game ID
         :param locale: locale of the shop, ru-ru as default
+        :returns list of Price objects
+        """
+        latest = session.query(
+            Price.edition,
+            func.max(Price.check_date).label('check_date')
+        ).filter(
+            Price.game_id == game_id,
+            Price.locale == locale
+        ).group_by(Price.edition).subquery()
+        return session.query(Price).join(
+            latest, and_(Price.edition == latest.c.edition, Price.check_date == latest.c.check_date)
+        ).filter(
+            Price.game_id == game_id,
+            Price.locale == locale
+        ).all()
+
+    @staticmethod
+    def get_on(session: Session, game_id: str, day: date, locale: str = 'ru-ru') -> list:
+        """
+        Get prices of every edition of a game that were actual at the given day
+        :param session: Session instance
         :param game_id: game ID
+        :param day: date to get the prices at
+        :param locale: locale of the shop, ru-ru as default
+        :returns list of Price objects
         """
-        Price.logger().info(f'{game_id, locale, game_info}')
+        return session.query(Price).filter(
+            Price.game_id == game_id,
+            Price.locale == locale,
+            Price.check_date <= day,
+            func.coalesce(Price.last_check_date, Price.check_date) >= day
+        ).order_by(Price.edition).all()
 
-        game = Game.get(session=session, id=game_id)
-        game_info = game_info or Game.get_game_info(concept_id=game.concept_id, store_locale=locale)
-        common_game_info = dict(
-            game_id=game_id,
-            check_date=date.today(),
-            locale=locale,
-        )
-        print(game_info)
+    @staticmethod
+    def update_price(game_id: str, session: Session, locale: str = 'ru-ru', game_info: dict = None) -> dict:
+        """
+        Store current price of a given game writing a new record only for the editions whose price has changed
+        :param session: Session instance
+        :param game_info: dict with game info if already uploaded, empty by default
+        :param locale: locale of the shop, ru-ru as default
+        :param game_id: game ID
+        :returns dict with numbers of inserted and extended price records
+        """
+        Price.logger().debug('%s', (game_id, locale, game_info))
+
+        if not game_info:
+            game = Game.get(session=session, id=game_id)
+            game_info = Game.get_game_info(concept_id=game.concept_id, store_locale=locale)
+        today = date.today()
+        current = {price.edition: price for price in Price.get_current(session, game_id=game_id, locale=locale)}
+        stats = PriceStats.get_for_game(session, game_id=game_id, locale=locale)
+        inserted, extended, changed = 0, [], []
         for edition_name, edition_info in game_info['editions'].items():
-            print(edition_info, common_game_info)
-            price_record = Price(edition=edition_name, **edition_info, **common_game_info)
-            session.merge(price_record)
+            if edition_name not in stats:
+                stats[edition_name] = PriceStats(game_id=game_id, locale=locale, edition=edition_name)
+                session.add(stats[edition_name])
+            stats[edition_name].track(session, edition_info, today)
+            price = current.get(edition_name)
+            if price is not None and price.is_same(edition_info):
+                if (price.last_check_date or price.check_date) < today:
+                    extended.append(price.id)
+                continue
+            changed.append(dict(edition_info, game_id=game_id, locale=locale, edition=edition_name,
+                                check_date=today, last_check_date=today))
+            if price is not None and price.check_date == today:
+                session.expire(price)
+            else:
+                inserted += 1
+        Price.upsert(session, changed, index_elements=('game_id', 'check_date', 'locale', 'edition'),
+                     update=('original_price', 'sale_price', 'valid_until', 'currency', 'last_check_date'))
+        if extended:
+            session.query(Price).filter(Price.id.in_(extended)).update(
+                {Price.last_check_date: today}, synchronize_session=False
+            )
+        return {'inserted': inserted, 'extended': len(extended)}
 
     @staticmethod
-    def update_prices():
+    def compact(session: Session, batch_size: int = 1000) -> dict:
         """
-        Update all prices of the games that have non-actual prices
+        Merge consecutive daily records with the same price into one record with the validity interval
+        :param session: Session instance
+        :param batch_size: number of deleted records per statement
+        :returns dict with numbers of records before and after compaction
         """
-        Game.logger().info('nothing special')
-        with session_scope() as sess:
-            for game_id, in sess.query(Game).outerjoin(Price).filter(
-                    or_(
-                        Price.check_date < date.today(),
-                        Price.check_date == None
-                    )
-            ).distinct().values(Game.id):
-                print(game_id)
-                Price.update_price(game_id=game_id, session=sess)
-        print('''That's all!''')
+        Price.logger().info('compacting')
+        before = session.query(func.count(Price.id)).scalar()
+        run, redundant = None, []
+
+        def close(price_run):
+            if price_run and price_run[1] != (price_run[0].last_check_date or price_run[0].check_date):
+                session.query(Price).filter(Price.id == price_run[0].id).update(
+                    {Price.last_check_date: price_run[1]}, synchronize_session=False
+                )
 
+        for price in session.query(Price).order_by(
+                Price.game_id, Price.locale, Price.edition, Price.check_date).yield_per(batch_size):
+            key = (price.game_id, price.locale, price.edition)
+            if run and run[2] == key and run[0].is_same(vars(price)):
+                run[1] = price.last_check_date or price.check_date
+                redundant.append(price.id)
+            else:
+                close(run)
+                run = [price, price.last_check_date or price.check_date, key]
+        close(run)
+        for start in range(0, len(redundant), batch_size):
+            session.query(Price).filter(Price.id.in_(redundant[start:start + batch_size])).delete(
+                synchronize_session=False
+            )
+        return {'before': before, 'after': before - len(redundant)}
 
-BaseModel.metadata.create_all(db)
+    @staticmethod
+    def update_prices(workers: int = 8, rate_limit: float = 5., batch_size: int = 50, budget: int = None,
+                      parse_processes: int = 0) -> dict:
+        """
+        Update prices of the games that have non-actual prices, the most important ones first
+        :param workers: number of threads fetching store pages
+        :param rate_limit: max number of requests per second to the store
+        :param batch_size: number of games written in one transaction
+        :param budget: max number of pages fetched, all the stale games if None
+        :param parse_processes: number of processes parsing the pages, the fetching threads parse them if 0
+        :returns dict with refresh statistics: pages, wall_time, pages_per_sec, inserted, extended, failed, skipped,
+        circuit_trips, concurrency and freshness
+        """
+        from app.refresh import refresh_prices
+
+        Game.logger().info('%s', (workers, rate_limit, batch_size, budget, parse_processes))
+        stats = refresh_prices(workers=workers, rate_limit=rate_limit, batch_size=batch_size, budget=budget,
+                               parse_processes=parse_processes)
+        print(f'''That's all! {stats['pages']} pages in {stats['wall_time']:.1f}s '''
+              f'''({stats['pages_per_sec']:.2f} pages/sec), '''
+              f'''{stats['inserted']} new and {stats['extended']} extended price records, '''
+              f'''{stats['failed']} failed and {stats['skipped']} skipped pages, '''
+              f'''{stats['freshness']['fresh_share']:.0%} of prices are fresh''')
+        return stats
+
+
+class PriceStats(BaseModel):
+    """ Precomputed current and lowest prices of a game edition in a locale maintained by Price.update_price """
+    __tablename__ = 'price_stats'
+    game_id = Column(String, ForeignKey('games.id', onupdate="CASCADE", ondelete="CASCADE"), nullable=False)
+    locale = Column(String, default='ru-ru', nullable=False)
+    edition = Column(String, nullable=True)
+    currency = Column(String, nullable=True, default='RUB')
+    original_price = Column(Integer, nullable=True)
+    current_price = Column(Integer, nullable=True)
+    check_date = Column(Date, nullable=True)
+    lowest_price = Column(Integer, nullable=True)
+    lowest_date = Column(Date, nullable=True)
+    low_30d_price = Column(Integer, nullable=True)
+    low_30d_date = Column(Date, nullable=True)
+    last_discount_date = Column(Date, nullable=True)
+
+    game_locale_edition = UniqueConstraint(game_id, locale, edition)
+
+    WINDOW = timedelta(days=30)
+
+    @staticmethod
+    def effective_price(price) -> int:
+        """ Get the price a game edition can be bought for from a Price object or parsed edition info """
+        if isinstance(price, dict):
+            sale_price, original_price = price.get('sale_price'), price['original_price']
+        else:
+            sale_price, original_price = price.sale_price, price.original_price
+        return original_price if sale_price is None else sale_price
+
+    @property
+    def is_lowest(self) -> bool:
+        """ The current price is the lowest one ever """
+        return self.current_price is not None and self.current_price <= self.lowest_price
+
+    @staticmethod
+    def get_for_game(session: Session, game_id: str, locale: str = 'ru-ru') -> dict:
+        """
+        Get the stats of every edition of a game
+        :param session: Session instance
+        :param game_id: game ID
+        :param locale: locale of the shop, ru-ru as default
+        :returns dict with editions as keys and PriceStats objects as values
+        """
+        return {stats.edition: stats for stats in session.query(PriceStats).filter(
+            PriceStats.game_id == game_id, PriceStats.locale == locale)}
+
+    @staticmethod
+    def window_low(session: Session, game_id: str, locale: str, edition: str, today: date) -> tuple:
+        """
+        Find the lowest price of a game edition over the last 30 days in the price history
+        :returns tuple (price, last day it was seen) or (None, None) if there are no prices in the window
+        """
+        seen_until = func.coalesce(Price.last_check_date, Price.check_date)
+        price = func.coalesce(Price.sale_price, Price.original_price)
+        low = session.query(price, seen_until).filter(
+            Price.game_id == game_id,
+            Price.locale == locale,
+            Price.edition == edition,
+            seen_until >= today - PriceStats.WINDOW
+        ).order_by(price, seen_until.desc()).first()
+        return (low[0], min(low[1], today)) if low else (None, None)
+
+    def track(self, session: Session, edition_info: dict, today: date):
+        """
+        Take the price seen today into account
+        :param session: Session instance
+        :param edition_info: parsed edition info with original_price, sale_price and currency
+        :param today: date of the check
+        """
+        price = PriceStats.effective_price(edition_info)
+        self.original_price = edition_info['original_price']
+        self.currency = edition_info.get('currency', 'RUB')
+        self.current_price = price
+        self.check_date = today
+        if self.lowest_price is None or price <= self.lowest_price:
+            self.lowest_price, self.lowest_date = price, today
+        if self.low_30d_date is not None and self.low_30d_date < today - PriceStats.WINDOW:
+            session.flush()
+            self.low_30d_price, self.low_30d_date = PriceStats.window_low(
+                session, self.game_id, self.locale, self.edition, today)
+        if self.low_30d_price is None or price <= self.low_30d_price:
+            self.low_30d_price, self.low_30d_date = price, today
+        if price < self.original_price:
+            self.last_discount_date = today
+
+    @staticmethod
+    def rebuild(session: Session, batch_size: int = 1000, today: date = None) -> int:
+        """
+        Compute the stats from the whole price history, e.g. for a database filled before they were introduced
+        :param session: Session instance
+        :param batch_size: number of price records loaded at once
+        :param today: date the 30-day window ends at, today by default
+        :returns number of the stats records
+        """
+        today = today or date.today()
+        session.query(PriceStats).delete(synchronize_session=False)
+        stats, count = None, 0
+        for price in session.query(Price).order_by(
+                Price.game_id, Price.locale, Price.edition, Price.check_date).yield_per(batch_size):
+            if stats is None or (stats.game_id, stats.locale, stats.edition) != \
+                    (price.game_id, price.locale, price.edition):
+                stats = PriceStats(game_id=price.game_id, locale=price.locale, edition=price.edition)
+                session.add(stats)
+                count += 1
+            seen_until = price.last_check_date or price.check_date
+            value = PriceStats.effective_price(price)
+            stats.original_price, stats.currency = price.original_price, price.currency
+            stats.current_price, stats.check_date = value, seen_until
+            if stats.lowest_price is None or value <= stats.lowest_price:
+                stats.lowest_price, stats.lowest_date = value, seen_until
+            if seen_until >= today - PriceStats.WINDOW and (stats.low_30d_price is None or
+                                                            value <= stats.low_30d_price):
+                stats.low_30d_price, stats.low_30d_date = value, min(seen_until, today)
+            if price.sale_price is not None and price.sale_price < price.original_price:
+                stats.last_discount_date = seen_until
+        PriceStats.logger().info('%s stats records', count)
+        return count
+
+    def __str__(self):
+        return f'{self.current_price} {self.currency or ""}'
+
+
+# indexes made redundant by others, ix_wishes_game_id is covered by the unique (game_id, user_id) constraint
+DROPPED_INDEXES = ('ix_wishes_game_id',)
+
+
+def migrate(engine=db):
+    """
+    Create missing tables, add the columns and indexes that are missing in already existing ones and drop the
+    redundant indexes
+    :param engine: Engine object
+    """
+    BaseModel.metadata.create_all(engine)
+    for name in DROPPED_INDEXES:
+        engine.execute(f'DROP INDEX IF EXISTS {name}')
+    inspector = inspect(engine)
+    for table in BaseModel.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing and column.nullable:
+                engine.execute(f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                               f'{column.type.compile(dialect=engine.dialect)}')
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in indexes:
+                index.create(bind=engine)
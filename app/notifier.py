@@ -0,0 +1,264 @@
+""" Notifications about discounts on the games from wishlists """
+from argparse import ArgumentParser
+from datetime import date
+from time import sleep
+
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import aliased
+
+from app import jobs, metrics
+from app.models import DEFAULT_LOCALE, Game, Price, PriceStats, User, WatchRule, Wish, session_scope
+from app.refresh import RateLimiter
+from app.telegram import get_bot
+
+import logging
+
+logger = logging.getLogger('notifier')
+
+GLOBAL_RATE = 30
+CHAT_RATE = 1
+MESSAGE_MAX_LENGTH = 4096
+USERS_BATCH = 500
+REFRESH_TIMEOUT = 4 * 60 * 60
+
+
+def get_new_discounts(session, check_date: date = None, user_ids: list = None):
+    """
+    Get (user, game, edition) triples whose discount in the user's region appeared or changed at the given check
+    in one query, the wishes with watch rules are left to get_rule_matches
+    :param session: Session instance
+    :param check_date: date of the check, today by default
+    :param user_ids: IDs of the users to check, all by default
+    :returns iterable of tuples (user_id, Game, Price, PriceStats) ordered by user_id, streamed from the DB
+    """
+    check_date = check_date or date.today()
+    current, previous, earlier = Price, aliased(Price), aliased(Price)
+    previous_date = session.query(
+        func.max(earlier.check_date)
+    ).filter(
+        earlier.game_id == current.game_id,
+        earlier.locale == current.locale,
+        earlier.edition == current.edition,
+        earlier.check_date < current.check_date,
+    ).correlate(current).as_scalar()
+
+    query = session.query(
+        Wish.user_id, Game, current, PriceStats
+    ).join(
+        Game, Game.id == Wish.game_id
+    ).join(
+        User, User.id == Wish.user_id
+    ).join(
+        current, and_(current.game_id == Wish.game_id,
+                      current.locale == func.coalesce(User.locale, DEFAULT_LOCALE))
+    ).outerjoin(
+        previous, and_(
+            previous.game_id == current.game_id,
+            previous.locale == current.locale,
+            previous.edition == current.edition,
+            previous.check_date == previous_date,
+        )
+    ).outerjoin(
+        PriceStats, and_(
+            PriceStats.game_id == current.game_id,
+            PriceStats.locale == current.locale,
+            PriceStats.edition == current.edition,
+        )
+    ).filter(
+        current.check_date == check_date,
+        current.sale_price < current.original_price,
+        or_(
+            previous.id == None,
+            previous.sale_price.is_distinct_from(current.sale_price),
+        ),
+        ~session.query(WatchRule.id).filter(
+            WatchRule.user_id == Wish.user_id,
+            WatchRule.game_id == Wish.game_id,
+        ).exists()
+    )
+    if user_ids is not None:
+        query = query.filter(Wish.user_id.in_(user_ids))
+    return query.order_by(Wish.user_id, Game.name, current.edition).yield_per(1000)
+
+
+def get_rule_matches(session, check_date: date = None, user_ids: list = None):
+    """
+    Get (user, game, edition) triples whose price changed at the given check and matches a watch rule of the user
+    in one query. The query starts from the prices written at the check and looks up the rules of each of them by
+    the (game, edition, threshold) indexes, so it costs as much as the number of changed prices whatever the number
+    of rules is.
+    :param session: Session instance
+    :param check_date: date of the check, today by default
+    :param user_ids: IDs of the users to check, all by default
+    :returns iterable of tuples (user_id, Game, Price, PriceStats) ordered by user_id, streamed from the DB
+    """
+    check_date = check_date or date.today()
+    price = func.coalesce(Price.sale_price, Price.original_price)
+    query = session.query(
+        WatchRule.user_id, Game, Price, PriceStats
+    ).select_from(
+        Price
+    ).join(
+        WatchRule, and_(WatchRule.game_id == Price.game_id,
+                        or_(WatchRule.edition == None, WatchRule.edition == Price.edition))
+    ).join(
+        User, User.id == WatchRule.user_id
+    ).join(
+        Game, Game.id == Price.game_id
+    ).outerjoin(
+        PriceStats, and_(
+            PriceStats.game_id == Price.game_id,
+            PriceStats.locale == Price.locale,
+            PriceStats.edition == Price.edition,
+        )
+    ).filter(
+        Price.check_date == check_date,
+        Price.locale == func.coalesce(User.locale, DEFAULT_LOCALE),
+        or_(WatchRule.below_price == None, price < WatchRule.below_price),
+        or_(WatchRule.min_discount == None,
+            (Price.original_price - price) * 100 >= WatchRule.min_discount * Price.original_price),
+        or_(WatchRule.below_price != None, WatchRule.min_discount != None, price < Price.original_price),
+    )
+    if user_ids is not None:
+        query = query.filter(WatchRule.user_id.in_(user_ids))
+    return query.distinct().order_by(WatchRule.user_id, Game.name, Price.edition).yield_per(1000)
+
+
+def format_discount(game: Game, price: Price, stats: PriceStats = None) -> str:
+    """ Make a line about a discount on a game edition in the store of its region with the lowest prices if known """
+    link = game.link(price.locale)
+    if price.sale_price is None:
+        text = f'{link} ({price.edition}): {price.original_price} {price.currency or ""}'
+    else:
+        text = f'{link} ({price.edition}): ~~{price.original_price}~~ {price.sale_price} {price.currency or ""}' + \
+            (f' до {price.valid_until:%d.%m.%Y}' if price.valid_until and price.valid_until.year < 5000 else '')
+    if stats is None or stats.lowest_price is None:
+        return text
+    if PriceStats.effective_price(price) <= stats.lowest_price:
+        return f'{text}, это самая низкая цена'
+    return f'{text}, минимум за 30 дней: {stats.low_30d_price}, исторический минимум: {stats.lowest_price}'
+
+
+def split_message(lines: list, header: str = '') -> list:
+    """ Join lines into messages that fit in Telegram message limit """
+    messages, message = [], header
+    for line in lines:
+        if len(message) + len(line) + 1 > MESSAGE_MAX_LENGTH:
+            messages.append(message)
+            message = ''
+        message = f'{message}\n{line}' if message else line
+    if message:
+        messages.append(message)
+    return messages
+
+
+class SendQueue:
+    """ Sends messages respecting Telegram limits per chat and in total """
+
+    def __init__(self, bot, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE):
+        """
+        :param bot: any object with TeleBot-like send_message method
+        :param global_rate: max number of messages per second in total
+        :param chat_rate: max number of messages per second to one chat
+        """
+        self.bot = bot
+        self.global_limiter = RateLimiter(global_rate)
+        self.chat_limiter = RateLimiter(chat_rate)
+        self.sent = 0
+        self.failed = 0
+
+    def send(self, chat_id, text: str, retries: int = 3):
+        """
+        Send a message waiting for the limits and retrying after Telegram asks to slow down
+        :param chat_id: ID of the chat
+        :param text: Markdown text of the message
+        :param retries: number of attempts after 429 error
+        """
+        for _ in range(retries):
+            self.chat_limiter.wait(chat_id)
+            self.global_limiter.wait('global')
+            try:
+                with metrics.timer('telegram_send', method='send_message'):
+                    self.bot.send_message(chat_id=chat_id, text=text, parse_mode='MARKDOWN')
+                self.sent += 1
+                return
+            except Exception as e:
+                if getattr(e, 'error_code', None) != 429:
+                    logger.warning('%s: %s', chat_id, e)
+                    break
+                retry_after = getattr(e, 'result_json', {}).get('parameters', {}).get('retry_after', 1)
+                logger.info('%s: retry after %ss', chat_id, retry_after)
+                metrics.inc('telegram_throttled')
+                sleep(retry_after)
+        self.failed += 1
+
+
+def get_discount_lines(check_date: date = None, batch: int = USERS_BATCH):
+    """
+    Get the lines about the new discounts and the rule matches of every user batch by batch, each batch is read in
+    its own short transaction and nothing is kept open while the caller sends the messages
+    :param check_date: date of the check, today by default
+    :param batch: number of users per transaction
+    :returns iterable of tuples (user_id, list of lines)
+    """
+    after = None
+    while True:
+        with session_scope() as session:
+            query = session.query(User.id)
+            if after is not None:
+                query = query.filter(User.id > after)
+            user_ids = [user_id for user_id, in query.order_by(User.id).limit(batch)]
+            if not user_ids:
+                return
+            # the rows are grouped in Python, so the order of the user IDs in the DB collation doesn't matter
+            lines = {}
+            for rows in (get_new_discounts(session, check_date, user_ids),
+                         get_rule_matches(session, check_date, user_ids)):
+                for user_id, game, price, stats in rows:
+                    lines.setdefault(user_id, []).append(format_discount(game, price, stats))
+        after = user_ids[-1]
+        yield from lines.items()
+
+
+def notify_discounts(bot, check_date: date = None) -> dict:
+    """
+    Send every user one message with the new discounts on the games from their wishlist and the prices matching
+    their watch rules
+    :param bot: any object with TeleBot-like send_message method
+    :param check_date: date of the check, today by default
+    :returns dict with number of notified users, sent and failed messages
+    """
+    queue = SendQueue(bot)
+    users = 0
+    for user_id, lines in get_discount_lines(check_date):
+        users += 1
+        for text in split_message(lines, header='Скидки на игры из твоего вишлиста:'):
+            queue.send(user_id, text)
+    stats = {'users': users, 'sent': queue.sent, 'failed': queue.failed}
+    logger.info('%s', stats)
+    return stats
+
+
+def main():
+    parser = ArgumentParser(description='Refresh the prices and notify the users about the new discounts')
+    parser.add_argument('--skip-refresh', action='store_true',
+                        help="don't refresh the prices, e.g. when python -m app.refresh was run separately")
+    parser.add_argument('--refresh-timeout', type=float, default=REFRESH_TIMEOUT,
+                        help='max seconds to wait for the queued refresh, then the prices written so far are notified')
+    args = parser.parse_args()
+
+    if not args.skip_refresh and jobs.ENABLED:
+        from app.refresh import enqueue_refresh
+
+        enqueue_refresh(jobs.get_queue())
+        if not jobs.get_queue().wait('refresh_price', timeout=args.refresh_timeout):
+            logger.warning('the refresh jobs are not done in %ss, notifying about the prices written so far: %s',
+                           args.refresh_timeout, jobs.get_queue().get_stats().get('refresh_price'))
+    elif not args.skip_refresh:
+        Price.update_prices()
+    notify_discounts(get_bot())
+    metrics.dump()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+""" Process pool for the CPU-bound parsing of store pages
+
+The threads fetching the pages are limited by the GIL as soon as the parsing is the bottleneck, so the pages are
+parsed in worker processes. The pool gets raw response bytes, which are pickled as a flat buffer instead of being
+decoded and re-encoded, and returns compact tuples instead of nested dicts. The processes are spawned rather than
+forked because the pool is started from a process whose other threads may hold the fetch, metrics or logging locks.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime as dt
+from multiprocessing import get_context
+from os import cpu_count
+
+from app.parser import parse_game_page
+
+import logging
+
+logger = logging.getLogger('parse_pool')
+
+CHUNK_SIZE = 8
+
+
+def compact(game_info: dict) -> tuple:
+    """
+    Pack the game info into a record that is cheap to pickle
+    :param game_info: dict from parse_game_page
+    :returns tuple (concept ID, name, poster url, tuple of (edition, original price, sale price, valid until
+    timestamp, currency) tuples)
+    """
+    return (
+        game_info['concept_id'],
+        game_info['name'],
+        game_info['poster_url'],
+        tuple((edition, info['original_price'], info['sale_price'], int(info['valid_until'].timestamp()),
+               info['currency']) for edition, info in game_info['editions'].items()),
+    )
+
+
+def expand(record: tuple) -> dict:
+    """
+    Unpack a record made by compact
+    :param record: tuple from compact
+    :returns dict with information about a game like parse_game_page
+    """
+    concept_id, name, poster_url, editions = record
+    return {
+        'name': name,
+        'poster_url': poster_url,
+        'editions': {
+            edition: {
+                'original_price': original_price,
+                'sale_price': sale_price,
+                'valid_until': dt.fromtimestamp(valid_until),
+                'currency': currency,
+            } for edition, original_price, sale_price, valid_until, currency in editions
+        },
+        'concept_id': concept_id,
+    }
+
+
+def parse_record(content: bytes, concept_id: str = None) -> tuple:
+    """
+    Parse a store page in a worker process
+    :param content: raw html of the page
+    :param concept_id: concept ID if it is known
+    :returns record from compact
+    """
+    return compact(parse_game_page(content.decode('utf-8'), concept_id=concept_id))
+
+
+def _parse_item(item: tuple) -> tuple:
+    content, concept_id = item
+    try:
+        return parse_record(content, concept_id), None
+    except Exception as e:
+        return None, repr(e)
+
+
+class ParsePool:
+    """ Pool of processes parsing store pages """
+
+    def __init__(self, processes: int = None, chunk_size: int = CHUNK_SIZE):
+        """
+        :param processes: number of worker processes, number of cores by default
+        :param chunk_size: number of pages sent to a process at once by map
+        """
+        self.processes = processes or cpu_count()
+        self.chunk_size = chunk_size
+        self._executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=get_context('spawn'))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
+
+    def shutdown(self):
+        self._executor.shutdown()
+
+    def submit(self, content: bytes, concept_id: str = None):
+        """
+        Parse one page, e.g. right after a thread has fetched it
+        :param content: raw html of the page
+        :param concept_id: concept ID if it is known
+        :returns Future object with the record from compact
+        """
+        return self._executor.submit(parse_record, content, concept_id)
+
+    def parse(self, content: bytes, concept_id: str = None) -> dict:
+        """
+        Parse one page and wait for the result
+        :returns dict with information about a game like parse_game_page
+        """
+        return expand(self.submit(content, concept_id).result())
+
+    def map(self, items) -> list:
+        """
+        Parse many pages sending them to the processes in chunks
+        :param items: iterable of (raw html, concept ID or None) pairs
+        :returns list of (record or None, error or None) pairs in the order of the items
+        """
+        return list(self._executor.map(_parse_item, items, chunksize=self.chunk_size))
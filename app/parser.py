@@ -0,0 +1,145 @@
+""" Extraction of game info from PSN store pages """
+from datetime import datetime as dt
+from html import unescape
+from json import loads, JSONDecodeError
+
+from app import metrics
+
+import logging
+
+logger = logging.getLogger('parser')
+
+UPSELLS_MARKER = 'class="pdp-upsells script"'
+CTA_MARKER = 'class="pdp-cta"'
+NEXT_DATA_MARKER = 'id="__NEXT_DATA__"'
+
+
+def _inner_text(page: str, marker: str, closing: str = '<', start: int = 0) -> str:
+    """
+    Get the text between the end of the tag containing the marker and the closing string
+    :param page: html of the page
+    :param marker: string inside the opening tag
+    :param closing: string the text ends with
+    :param start: position to start searching from
+    :returns text or None if there is no such tag
+    """
+    start = page.find(marker, start)
+    if start == -1:
+        return None
+    start = page.find('>', start) + 1
+    end = page.find(closing, start)
+    return page[start:end] if start and end != -1 else None
+
+
+def extract_cache(page: str) -> dict:
+    """
+    Get the Apollo cache of the product page scanning for its script instead of parsing the whole document
+    :param page: html of the page
+    :returns dict with the cache or None if it is not found
+    """
+    upsells = _inner_text(page, UPSELLS_MARKER)
+    cta = page.find(CTA_MARKER)
+    for text in (upsells and unescape(upsells),
+                 _inner_text(page, '<script', '</script>', start=cta) if cta != -1 else None):
+        if text and text.strip():
+            try:
+                return loads(text)['cache']
+            except (JSONDecodeError, KeyError, TypeError):
+                continue
+    return None
+
+
+def extract_background_cache(page: str) -> dict:
+    """
+    Get the Apollo cache hidden in the background image batarang of __NEXT_DATA__
+    :param page: html of the page
+    :returns dict with the cache or None if it is not found
+    """
+    try:
+        next_data = loads(_inner_text(page, NEXT_DATA_MARKER, '</script>'))
+        batarang = next_data['props']['pageProps']['batarangs']['background-image']['text']
+        return loads(_inner_text(batarang, '<script', '</script>'))['cache']
+    except (JSONDecodeError, KeyError, TypeError):
+        return None
+
+
+def soup(markup: str):
+    """ Parse the whole document, BeautifulSoup is imported only when the fast extraction fails """
+    from bs4 import BeautifulSoup
+
+    return BeautifulSoup(markup=markup, features='html.parser')
+
+
+def soup_extract_cache(page) -> dict:
+    """ Get the Apollo cache of the product page from the parsed document """
+    data = page.select_one('div[class="pdp-upsells script"]')
+    if data is None:
+        data = page.select_one('div[class="pdp-cta"] script')
+    return loads(next(data.children))['cache']
+
+
+def soup_extract_background_cache(page) -> dict:
+    """ Get the Apollo cache of the background image batarang from the parsed document """
+    return loads(
+        soup(loads(page.select_one('#__NEXT_DATA__').next
+                   )['props']['pageProps']['batarangs']['background-image']['text']
+             ).script.next
+    )['cache']
+
+
+def parse_game_page(page: str, concept_id: str = None, fast: bool = True) -> dict:
+    """
+    Parse game info from a PSN store page.
+    :param page: html of the concept or product page
+    :param concept_id: concept ID if it is known
+    :param fast: try to extract the data without building the whole document tree first
+    :returns dict with information about a game
+    """
+    page = page.replace(u'\xa0', u'')
+    game_page = None
+    data = extract_cache(page) if fast else None
+    if data is None:
+        logger.debug('falling back to the soup parser')
+        metrics.inc('parse_fallbacks')
+        game_page = soup(page)
+        data = soup_extract_cache(game_page)
+
+    concept_id = concept_id or next(key for key in data if key.startswith('Concept:')).replace('Concept:', '')
+
+    id_name = {
+        f'''GameCTA:{
+            v.get(
+                'activeCtaId',
+                v.get('webctas', v['skus'])[0]['__ref'].replace('Sku', '').replace('GameCTA', '')
+            )
+        }''':
+            v.get('edition', v)['name'] for k, v in data.items() \
+        if k.startswith('Product')
+    }
+
+    id_data = {
+        edition_name: {
+            'original_price': data[id_]['local']['telemetryMeta']['skuDetail']['skuPriceDetail'][0][
+                                  'originalPriceValue'] // 100,
+            'sale_price': data[id_]['local']['telemetryMeta']['skuDetail']['skuPriceDetail'][0][
+                              'discountPriceValue'] // 100,
+            'valid_until': dt.fromtimestamp(int(data[id_]['price']['endTime'] or 10 ** 14) // 1000),
+            'currency': data[id_]['price']['currencyCode']
+        } for id_, edition_name in id_name.items() if id_ in data
+    }
+
+    concept_info = data[f'Concept:{concept_id}']
+    if 'media' not in concept_info:
+        background = extract_background_cache(page) if fast else None
+        if background is None:
+            game_page = game_page or soup(page)
+            background = soup_extract_background_cache(game_page)
+        concept_info = background[f'Concept:{concept_id}']
+    product_info = next(v for k, v in data.items() if k.startswith('Product'))
+
+    return {
+        'name': concept_info.get('name', product_info['name']),
+        'poster_url': next(x['url'] for x in concept_info['media'] if x['role'] == 'MASTER'),
+        'editions': id_data,
+        'concept_id': concept_id,
+    }
@@ -0,0 +1,130 @@
+""" On-disk cache of game posters pre-encoded for Telegram """
+from collections import OrderedDict
+from hashlib import sha1
+from io import BytesIO
+from pathlib import Path
+from threading import Lock
+
+from app import metrics
+from app.fetch import fetch
+
+import logging
+
+logger = logging.getLogger('posters')
+
+CACHE_DIR = Path('posters')
+CACHE_MAX_BYTES = 256 * 2 ** 20
+VARIANTS = {
+    'full': (1280, 1280),
+}
+
+_index = None
+_lock = Lock()
+
+
+def _key(poster_url: str) -> str:
+    return sha1(poster_url.encode()).hexdigest()
+
+
+def _load_index() -> OrderedDict:
+    """ Build the LRU index of the cached files, the least recently used first """
+    global _index
+    if _index is None:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        files = sorted(CACHE_DIR.glob('*.jpg'), key=lambda path: path.stat().st_mtime)
+        _index = OrderedDict((path.name, path.stat().st_size) for path in files)
+    return _index
+
+
+def _evict():
+    """ Remove the least recently used files until the cache fits in its budget """
+    index = _load_index()
+    size = sum(index.values())
+    while size > CACHE_MAX_BYTES and index:
+        name, file_size = index.popitem(last=False)
+        size -= file_size
+        (CACHE_DIR / name).unlink(missing_ok=True)
+        (CACHE_DIR / name).with_suffix('.file_id').unlink(missing_ok=True)
+        logger.debug('evicted %s', name)
+
+
+@metrics.timed('image_encode')
+def _encode(image_content: bytes) -> dict:
+    """
+    Make JPEG variants of the image
+    :param image_content: original image bytes
+    :returns dict with variant names as keys and JPEG bytes as values
+    """
+    from PIL import Image
+
+    image = Image.open(BytesIO(image_content)).convert('RGB')
+    variants = {}
+    for variant, size in VARIANTS.items():
+        resized = image.copy()
+        resized.thumbnail(size)
+        content = BytesIO()
+        resized.save(content, format='JPEG', quality=85, optimize=True)
+        variants[variant] = content.getvalue()
+    return variants
+
+
+def get_image(poster_url: str, variant: str = 'full') -> BytesIO:
+    """
+    Get the pre-encoded poster from the cache downloading and encoding it on a miss
+    :param poster_url: url of the poster, Game.poster_url
+    :param variant: one of VARIANTS
+    :returns BytesIO object with JPEG image
+    """
+    key = _key(poster_url)
+    name = f'{key}.{variant}.jpg'
+    with _lock:
+        index = _load_index()
+        if name in index:
+            index.move_to_end(name)
+            path = CACHE_DIR / name
+            path.touch()
+            return BytesIO(path.read_bytes())
+
+    variants = _encode(fetch(poster_url).content)
+    with _lock:
+        index = _load_index()
+        for variant_name, content in variants.items():
+            variant_file = f'{key}.{variant_name}.jpg'
+            (CACHE_DIR / variant_file).write_bytes(content)
+            index[variant_file] = len(content)
+        _evict()
+    return BytesIO(variants[variant])
+
+
+def get_file_id(poster_url: str, variant: str = 'full') -> str:
+    """
+    Get Telegram file_id of the poster if it was already uploaded
+    :param poster_url: url of the poster, Game.poster_url
+    :param variant: one of VARIANTS
+    :returns file_id or None
+    """
+    path = CACHE_DIR / f'{_key(poster_url)}.{variant}.file_id'
+    return path.read_text() if path.exists() else None
+
+
+def remember_file_id(poster_url: str, message, variant: str = 'full'):
+    """
+    Save Telegram file_id of the uploaded poster so that it is never uploaded again
+    :param poster_url: url of the poster, Game.poster_url
+    :param message: Telegram message with the photo
+    :param variant: one of VARIANTS
+    """
+    if message is None or not getattr(message, 'photo', None):
+        return
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    (CACHE_DIR / f'{_key(poster_url)}.{variant}.file_id').write_text(message.photo[-1].file_id)
+
+
+def get_photo(poster_url: str, variant: str = 'full'):
+    """
+    Get something to pass as a photo to Telegram: file_id if it is known else the cached image
+    :param poster_url: url of the poster, Game.poster_url
+    :param variant: one of VARIANTS
+    :returns file_id string or BytesIO object
+    """
+    return get_file_id(poster_url, variant) or get_image(poster_url, variant)
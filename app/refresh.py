@@ -0,0 +1,325 @@
+""" Concurrent refresh of the game prices
+
+Usage: python -m app.refresh [--workers N] [--rate-limit R] [--budget B] [--parse-processes P]
+"""
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from threading import Condition, Lock
+from time import monotonic, sleep
+
+from requests import RequestException
+
+from app import metrics
+from app.fetch import fetch as fetch_page
+from app.models import Game, Price, PSN_URL, session_scope
+from app.parse_pool import ParsePool, expand
+from app.parser import parse_game_page
+from app.scheduler import freshness, plan
+
+import logging
+
+logger = logging.getLogger('refresh')
+
+
+class RateLimiter:
+    """ Spaces out requests to the same host so that there are at most `rate` of them per second """
+
+    def __init__(self, rate: float = None):
+        self.interval = 1 / rate if rate else 0
+        self._lock = Lock()
+        self._next_slot = {}
+
+    def wait(self, host: str):
+        """
+        Block until a request to the given host is allowed
+        :param host: host name the request is going to
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+class StoreError(Exception):
+    """ The store throttles the requests, fails or returns a page that can't be parsed """
+
+
+class CircuitOpen(Exception):
+    """ The store kept failing after several cooldowns, the rest of the cycle is skipped """
+
+
+class CircuitBreaker:
+    """ Stops all the requests to the store for a cooldown after several failures in a row
+
+    After the cooldown one probe request is let through: its success closes the circuit, its failure opens it again
+    for a twice longer cooldown. The circuit stays open for good after max_trips trips.
+    """
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30., max_trips: int = 3):
+        """
+        :param threshold: number of failures in a row that open the circuit
+        :param cooldown: seconds of the first cooldown
+        :param max_trips: number of trips after which the requests are not made at all
+        """
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.max_trips = max_trips
+        self.failures = 0
+        self.trips = 0
+        self._open_until = 0.
+        self._probing = False
+        self._lock = Lock()
+
+    def wait(self):
+        """
+        Block until a request is allowed
+        :raises CircuitOpen if the circuit is open for good
+        """
+        while True:
+            with self._lock:
+                if self.trips >= self.max_trips:
+                    raise CircuitOpen(f'{self.trips} trips of the circuit breaker')
+                now = monotonic()
+                if not self._open_until:
+                    return
+                if now >= self._open_until and not self._probing:
+                    self._probing = True
+                    return
+                delay = max(self._open_until - now, .1)
+            sleep(delay)
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self._open_until = 0.
+            self._probing = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._probing or self.failures >= self.threshold:
+                self.trips += 1
+                self.failures = 0
+                self._probing = False
+                self._open_until = monotonic() + self.cooldown * 2 ** (self.trips - 1)
+                metrics.inc('circuit_trips')
+                logger.warning('circuit breaker trip %s, cooling down until %.0f', self.trips, self._open_until)
+
+
+class AdaptiveConcurrency:
+    """ Limits the number of requests in flight growing the limit on successes and halving it on failures (AIMD) """
+
+    def __init__(self, limit: int, min_limit: int = 1):
+        """
+        :param limit: max number of requests in flight
+        :param min_limit: the limit never goes lower
+        """
+        self.max_limit = limit
+        self.min_limit = min_limit
+        self.limit = float(limit)
+        self._active = 0
+        self._condition = Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._active >= int(self.limit):
+                self._condition.wait()
+            self._active += 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+    def grow(self):
+        with self._condition:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+    def backoff(self):
+        with self._condition:
+            self.limit = max(self.min_limit, self.limit / 2)
+        metrics.inc('concurrency_backoffs')
+
+
+def refresh_prices(workers: int = 8, rate_limit: float = 5., batch_size: int = 50, budget: int = None,
+                   parse_processes: int = 0) -> dict:
+    """
+    Fetch store pages of the stale games in every requested locale concurrently and write their prices in batches
+
+    A game whose page can't be fetched, parsed or written is skipped without losing the others. Throttling, server
+    errors and parse failures halve the number of requests in flight and trip the circuit breaker after several of
+    them in a row. Every batch is committed as soon as it is written and the plan leaves out the pairs checked today, so
+    an interrupted refresh resumes where it stopped on the next run.
+    :param workers: number of threads fetching store pages
+    :param rate_limit: max number of requests per second to the store, no limit if None
+    :param batch_size: number of games written in one transaction
+    :param budget: max number of pages fetched in this cycle, the most important ones go first
+    :param parse_processes: number of processes parsing the pages of every batch in chunks, the fetching threads
+    parse them if 0
+    :returns dict with number of refreshed pages, total wall time, pages per second, numbers of inserted and
+    extended price records, numbers of failed and skipped pairs, number of circuit breaker trips, final
+    concurrency and freshness of the prices after the refresh
+    """
+    started_at = monotonic()
+    with session_scope() as session:
+        games = plan(session, budget=budget)
+    logger.info('%s (game, locale) pairs to refresh with %s workers', len(games), workers)
+
+    limiter = RateLimiter(rate_limit)
+    breaker = CircuitBreaker()
+    concurrency = AdaptiveConcurrency(workers)
+    parse_pool = ParsePool(parse_processes) if parse_processes else None
+
+    def fetch(concept_id: str, locale: str) -> dict:
+        breaker.wait()
+        with concurrency:
+            limiter.wait(PSN_URL)
+            try:
+                response = fetch_page(Game.get_game_url(concept_id=concept_id, store_locale=locale))
+            except RequestException as e:
+                raise StoreError(repr(e))
+            if response.status_code == 429 or response.status_code >= 500:
+                raise StoreError(f'HTTP {response.status_code}')
+            if response.status_code == 404:
+                return None
+            if parse_pool is not None:
+                return response.content
+            try:
+                with metrics.timer('page_parse'):
+                    return parse_game_page(response.text, concept_id=concept_id)
+            except Exception as e:
+                raise StoreError(f'parse failure: {e!r}')
+
+    def fetch_isolated(concept_id: str, locale: str) -> dict:
+        try:
+            game_info = fetch(concept_id, locale)
+        except StoreError:
+            breaker.failure()
+            concurrency.backoff()
+            raise
+        breaker.success()
+        concurrency.grow()
+        return game_info
+
+    pages = inserted = extended = 0
+    failed, skipped = [], 0
+
+    def write(session, game_id: str, concept_id: str, locale: str, game_info: dict):
+        """ Write the prices of a game in a savepoint so that a bad page is rolled back without the batch """
+        nonlocal pages, inserted, extended
+        try:
+            with session.begin_nested():
+                written = Price.update_price(game_id=game_id, locale=locale, game_info=game_info, session=session)
+        except Exception as e:
+            logger.warning('%s in %s is not written: %r', concept_id, locale, e)
+            failed.append((concept_id, locale))
+            return
+        inserted += written['inserted']
+        extended += written['extended']
+        pages += 1
+
+    def write_raw(session, raw: list):
+        """ Parse the fetched pages of a batch in the process pool, which sends them in chunks, and write them """
+        results = parse_pool.map((content, concept_id) for _, concept_id, _, content in raw)
+        for (game_id, concept_id, locale, _), (record, error) in zip(raw, results):
+            if error:
+                breaker.failure()
+                concurrency.backoff()
+                logger.warning('%s in %s is not refreshed: parse failure: %s', concept_id, locale, error)
+                failed.append((concept_id, locale))
+                continue
+            write(session, game_id, concept_id, locale, expand(record))
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(fetch_isolated, concept_id, locale): (game_id, concept_id, locale)
+                       for game_id, concept_id, locale in games}
+            pending = as_completed(futures)
+            done = 0
+            while done < len(futures):
+                with session_scope() as session:
+                    batch, raw = 0, []
+                    for future in pending:
+                        game_id, concept_id, locale = futures[future]
+                        done += 1
+                        try:
+                            result = future.result()
+                        except CircuitOpen:
+                            skipped += 1
+                            continue
+                        except StoreError as e:
+                            logger.warning('%s in %s is not refreshed: %s', concept_id, locale, e)
+                            failed.append((concept_id, locale))
+                            continue
+                        if not result:
+                            logger.warning('%s in %s is not found', concept_id, locale)
+                            failed.append((concept_id, locale))
+                            continue
+                        if parse_pool is None:
+                            write(session, game_id, concept_id, locale, result)
+                        else:
+                            raw.append((game_id, concept_id, locale, result))
+                        batch += 1
+                        if batch == batch_size:
+                            break
+                    if raw:
+                        write_raw(session, raw)
+    finally:
+        if parse_pool:
+            parse_pool.shutdown()
+
+    wall_time = monotonic() - started_at
+    stats = {
+        'pages': pages,
+        'wall_time': wall_time,
+        'pages_per_sec': pages / wall_time if wall_time else 0.,
+        'inserted': inserted,
+        'extended': extended,
+        'failed': len(failed),
+        'skipped': skipped,
+        'circuit_trips': breaker.trips,
+        'concurrency': concurrency.limit,
+    }
+    with session_scope() as session:
+        stats['freshness'] = freshness(session)
+    logger.info('%s', stats)
+    return stats
+
+
+def enqueue_refresh(queue, budget: int = None) -> int:
+    """
+    Leave the refresh of the stale games to the worker processes
+    :param queue: JobQueue object
+    :param budget: max number of pages fetched in this cycle, the most important ones go first
+    :returns number of enqueued jobs
+    """
+    with session_scope() as session:
+        games = plan(session, budget=budget)
+    for game_id, concept_id, locale in games:
+        queue.enqueue('refresh_price', {'game_id': game_id, 'concept_id': concept_id, 'locale': locale},
+                      dedup_key=f'refresh:{game_id}:{locale}')
+    logger.info('%s (game, locale) pairs are enqueued', len(games))
+    return len(games)
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--workers', type=int, default=8, help='number of threads fetching store pages')
+    parser.add_argument('--rate-limit', type=float, default=5., help='max number of store requests per second')
+    parser.add_argument('--batch-size', type=int, default=50, help='number of games written in one transaction')
+    parser.add_argument('--budget', type=int, help='max number of pages fetched in this cycle')
+    parser.add_argument('--parse-processes', type=int, default=0, help='number of processes parsing the pages')
+    args = parser.parse_args()
+    Price.update_prices(workers=args.workers, rate_limit=args.rate_limit, batch_size=args.batch_size,
+                        budget=args.budget, parse_processes=args.parse_processes)
+    metrics.dump()
+
+
+if __name__ == '__main__':
+    main()
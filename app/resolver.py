@@ -0,0 +1,99 @@
+""" In-process cache resolving game identifiers to Game IDs """
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from app import metrics
+
+MAX_SIZE = 50000
+TTL = 24 * 60 * 60
+NEGATIVE_TTL = 60 * 60
+
+
+class ResolutionCache:
+    """ Bounded TTL cache of url → product ID → concept ID → Game.id resolutions including invalid identifiers """
+
+    def __init__(self, max_size: int = MAX_SIZE, ttl: float = TTL, negative_ttl: float = NEGATIVE_TTL):
+        """
+        :param max_size: max number of cached identifiers
+        :param ttl: seconds a resolved identifier stays valid
+        :param negative_ttl: seconds an invalid identifier stays valid
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = Lock()
+        self.stats = {'hits': 0, 'negative_hits': 0, 'misses': 0, 'expired': 0, 'evicted': 0}
+
+    def get(self, key) -> tuple:
+        """
+        Get the resolution of an identifier
+        :param key: raw identifier from the user or (id type, ID) pair
+        :returns tuple (Game ID, None) for a resolved identifier, (None, error message) for an invalid one or None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                metrics.inc('resolution_cache', result='miss')
+                return None
+            expires_at, value = entry
+            if expires_at < monotonic():
+                del self._entries[key]
+                self.stats['expired'] += 1
+                self.stats['misses'] += 1
+                metrics.inc('resolution_cache', result='expired')
+                return None
+            self._entries.move_to_end(key)
+            self.stats['negative_hits' if value[1] else 'hits'] += 1
+            metrics.inc('resolution_cache', result='negative_hit' if value[1] else 'hit')
+            return value
+
+    def _put(self, key, value: tuple, ttl: float):
+        self._entries[key] = (monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.stats['evicted'] += 1
+
+    def put(self, game_id: str, *keys):
+        """
+        Remember that the identifiers resolve to the game
+        :param game_id: Game.id
+        :param keys: raw identifiers and (id type, ID) pairs
+        """
+        if not game_id:
+            return
+        with self._lock:
+            for key in keys:
+                if key:
+                    self._put(key, (game_id, None), self.ttl)
+
+    def put_invalid(self, error: str, *keys):
+        """
+        Remember that the identifiers are invalid so that they never cost a store round-trip again
+        :param error: message of the error to raise again
+        :param keys: raw identifiers and (id type, ID) pairs
+        """
+        with self._lock:
+            for key in keys:
+                if key:
+                    self._put(key, (None, error), self.negative_ttl)
+
+    def discard(self, *keys):
+        """ Forget the identifiers, e.g. when their game was deleted """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def get_stats(self) -> dict:
+        """
+        Get cache statistics
+        :returns dict with counters, current size and hit rate
+        """
+        with self._lock:
+            stats = dict(self.stats, size=len(self._entries))
+        lookups = stats['hits'] + stats['negative_hits'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['negative_hits']) / lookups if lookups else 0.
+        return stats
@@ -0,0 +1,115 @@
+""" Priorities of the price refresh within a fixed fetch budget """
+from datetime import date
+from math import inf, log1p
+
+from sqlalchemy import and_, case, func
+
+from app.models import DEFAULT_LOCALE, Game, Price, User, Wish
+
+import logging
+
+logger = logging.getLogger('scheduler')
+
+VOLATILITY_WEIGHT = 7
+URGENCY_WEIGHT = 3
+
+
+def get_candidates(session, today: date = None) -> list:
+    """
+    Get every (game, locale) pair requested by the users with the signals of its refresh priority
+    :param session: Session instance
+    :param today: date of the cycle, today by default
+    :returns list of tuples (game ID, concept ID, locale, wishes, last seen date, first seen date, number of price
+    records, end date of the current sale)
+    """
+    today = today or date.today()
+    requested = session.query(
+        Wish.game_id.label('game_id'),
+        func.coalesce(User.locale, DEFAULT_LOCALE).label('locale'),
+        func.count(Wish.id).label('wishes')
+    ).join(
+        User, User.id == Wish.user_id
+    ).group_by(Wish.game_id, func.coalesce(User.locale, DEFAULT_LOCALE)).subquery()
+    history = session.query(
+        Price.game_id.label('game_id'),
+        Price.locale.label('locale'),
+        func.max(func.coalesce(Price.last_check_date, Price.check_date)).label('last_seen'),
+        func.min(Price.check_date).label('first_seen'),
+        func.count(Price.id).label('records'),
+        func.min(case([(and_(Price.sale_price < Price.original_price, Price.valid_until >= today),
+                         Price.valid_until)])).label('sale_ends'),
+    ).group_by(Price.game_id, Price.locale).subquery()
+    return session.query(
+        Game.id, Game.concept_id, requested.c.locale, requested.c.wishes,
+        history.c.last_seen, history.c.first_seen, history.c.records, history.c.sale_ends
+    ).join(
+        requested, requested.c.game_id == Game.id
+    ).outerjoin(
+        history, and_(history.c.game_id == Game.id, history.c.locale == requested.c.locale)
+    ).all()
+
+
+def priority(wishes: int, last_seen: date, first_seen: date, records: int, sale_ends: date,
+             today: date = None) -> float:
+    """
+    Score how much refreshing a game price is worth: popular, volatile, long unchecked games and games whose sale is
+    about to end go first, games checked today are not refreshed at all
+    :returns score, 0 means the price is fresh
+    """
+    today = today or date.today()
+    if last_seen is None:
+        return inf
+    age = (today - last_seen).days
+    if age <= 0:
+        return 0.
+    changes_per_day = (records - 1) / max((last_seen - first_seen).days, 1)
+    urgency = URGENCY_WEIGHT / (1 + max((sale_ends - today).days, 0)) if sale_ends else 0.
+    return (1 + log1p(wishes)) * age * (1 + VOLATILITY_WEIGHT * changes_per_day) * (1 + urgency)
+
+
+def plan(session, budget: int = None, today: date = None) -> list:
+    """
+    Pick the pairs to refresh in this cycle
+    :param session: Session instance
+    :param budget: max number of fetches in the cycle, all the stale pairs if None
+    :param today: date of the cycle, today by default
+    :returns list of tuples (game ID, concept ID, locale) ordered by priority
+    """
+    scored = []
+    for game_id, concept_id, locale, *signals in get_candidates(session, today):
+        score = priority(*signals, today=today)
+        if score:
+            scored.append((score, game_id, concept_id, locale))
+    scored.sort(key=lambda item: item[0], reverse=True)
+    logger.info('%s stale pairs, budget %s', len(scored), budget)
+    return [(game_id, concept_id, locale) for _, game_id, concept_id, locale in scored[:budget]]
+
+
+def freshness(session, today: date = None) -> dict:
+    """
+    Measure how fresh the prices of the requested games are
+    :param session: Session instance
+    :param today: date of the measurement, today by default
+    :returns dict with number of pairs, share of pairs checked today, mean and max age in days weighted by wishes
+    and number of never checked pairs
+    """
+    today = today or date.today()
+    pairs = fresh = never = wishes_total = 0
+    age_total, age_max = 0., 0
+    for _, _, _, wishes, last_seen, *_ in get_candidates(session, today):
+        pairs += 1
+        if last_seen is None:
+            never += 1
+            continue
+        age = (today - last_seen).days
+        fresh += age <= 0
+        age_total += age * wishes
+        wishes_total += wishes
+        age_max = max(age_max, age)
+    return {
+        'pairs': pairs,
+        'fresh_share': fresh / pairs if pairs else 1.,
+        'mean_age_days': age_total / wishes_total if wishes_total else 0.,
+        'max_age_days': age_max,
+        'never_checked': never,
+    }
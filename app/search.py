@@ -0,0 +1,184 @@
+""" Cache of PSN store search results for inline queries """
+from collections import OrderedDict
+from threading import Event, Lock, Timer, current_thread
+from time import monotonic
+
+from app import metrics
+
+import logging
+
+logger = logging.getLogger('search')
+
+SEARCH_SIZE = 50
+SHOWN_RESULTS = 5
+TTL = 15 * 60
+MAX_QUERIES = 4096
+DEBOUNCE = 0.3
+
+
+def normalize(query: str) -> str:
+    """ Make the same cache key for queries that differ only in case and spaces """
+    return ' '.join(query.lower().split())
+
+
+def matches(game: dict, query: str) -> bool:
+    """ Check if every word of the normalized query is in the game name """
+    name = normalize(game['name'])
+    return all(word in name for word in query.split())
+
+
+class SearchCache:
+    """ TTL+LRU cache of search results that also answers longer queries from the results of their prefixes """
+
+    def __init__(self, search, ttl: float = TTL, max_queries: int = MAX_QUERIES, debounce: float = DEBOUNCE,
+                 size: int = SEARCH_SIZE):
+        """
+        :param search: function making an upstream search by a query, returns list of dicts with 'name' key
+        :param ttl: seconds the results stay valid
+        :param max_queries: max number of cached queries
+        :param debounce: seconds to wait for a newer query of the same user before searching upstream
+        :param size: max number of results the upstream returns, fewer results mean the set is complete, so it is
+        larger than the number of results shown to let the longer queries be answered from their prefixes
+        """
+        self.search = search
+        self.ttl = ttl
+        self.max_queries = max_queries
+        self.debounce = debounce
+        self.size = size
+        self._results = OrderedDict()
+        self._in_flight = {}
+        self._latest = OrderedDict()
+        self._timers = {}
+        self._lock = Lock()
+        self.stats = {'hits': 0, 'prefix_hits': 0, 'misses': 0, 'upstream_calls': 0, 'coalesced': 0, 'dropped': 0}
+
+    def _count(self, event: str):
+        """ Count an event in the stats and in the search_cache metric, the caller holds the lock """
+        self.stats[event] += 1
+        metrics.inc('search_cache', event=event)
+
+    def _cached(self, query: str) -> list:
+        """ Get results of the query or filter the results of its longest complete cached prefix """
+        now = monotonic()
+        entry = self._results.get(query)
+        if entry and now - entry[0] < self.ttl:
+            self._results.move_to_end(query)
+            self._count('hits')
+            return entry[1]
+        for end in range(len(query) - 1, 0, -1):
+            entry = self._results.get(query[:end])
+            if entry and now - entry[0] < self.ttl and len(entry[1]) < self.size:
+                self._count('prefix_hits')
+                return [game for game in entry[1] if matches(game, query)]
+        return None
+
+    def _store(self, query: str, results: list):
+        self._results[query] = (monotonic(), results)
+        self._results.move_to_end(query)
+        while len(self._results) > self.max_queries:
+            self._results.popitem(last=False)
+
+    def _remember(self, query: str, user_id):
+        """ Remember the latest query of the user, the caller holds the lock """
+        self._latest[user_id] = query
+        self._latest.move_to_end(user_id)
+        while len(self._latest) > self.max_queries:
+            self._latest.popitem(last=False)
+
+    def peek(self, query: str, user_id=None) -> list:
+        """
+        Get search results only if they are cached, the query becomes the latest one of the user
+        :param query: text of the inline query
+        :param user_id: ID of the user
+        :returns list of found games or None on a miss
+        """
+        query = normalize(query)
+        with self._lock:
+            if user_id is not None:
+                self._remember(query, user_id)
+            return self._cached(query)
+
+    def get(self, query: str, user_id=None) -> list:
+        """
+        Get search results from the cache or from the upstream without waiting for newer queries, see peek and
+        get_later for the debounce
+        :param query: text of the inline query
+        :param user_id: ID of the user, the query is dropped if peek or get_later got a newer one of theirs
+        :returns list of found games or None if a newer query of the same user came
+        """
+        query = normalize(query)
+        with self._lock:
+            results = self._cached(query)
+            if results is not None:
+                return results
+            if user_id is not None and self._latest.get(user_id, query) != query:
+                self._count('dropped')
+                return None
+            in_flight = self._in_flight.get(query)
+            if in_flight is None:
+                in_flight = self._in_flight[query] = [Event(), None]
+                self._count('misses')
+                self._count('upstream_calls')
+                is_leader = True
+            else:
+                self._count('coalesced')
+                is_leader = False
+        if not is_leader:
+            in_flight[0].wait()
+            return in_flight[1]
+
+        try:
+            results = in_flight[1] = self.search(query)
+            with self._lock:
+                self._store(query, results)
+            return results
+        finally:
+            with self._lock:
+                del self._in_flight[query]
+            in_flight[0].set()
+
+    def get_later(self, query: str, callback, user_id):
+        """
+        Pass search results to the callback right away if they are cached, else after the debounce in a timer
+        thread unless a newer query of the same user comes first, the calling thread never waits
+        :param query: text of the inline query
+        :param callback: function taking the list of found games
+        :param user_id: ID of the user
+        """
+        results = self.peek(query, user_id)
+        if results is not None:
+            callback(results)
+            return
+        timer = Timer(self.debounce, self._fire, (query, callback, user_id))
+        timer.daemon = True
+        with self._lock:
+            previous = self._timers.get(user_id)
+            if previous is not None:
+                previous.cancel()
+                self._count('dropped')
+            self._timers[user_id] = timer
+        timer.start()
+
+    def _fire(self, query: str, callback, user_id):
+        with self._lock:
+            if self._timers.get(user_id) is not current_thread():
+                return  # replaced by a newer query of the user and already counted as dropped
+            del self._timers[user_id]
+        try:
+            results = self.get(query, user_id=user_id)
+            if results is not None:
+                callback(results)
+        except Exception as e:
+            logger.exception(e)
+
+    def get_stats(self) -> dict:
+        """
+        Get cache metrics, /metrics has the same counters as search_cache with the event label
+        :returns dict with counters, hit rate and number of saved upstream calls
+        """
+        with self._lock:
+            stats = dict(self.stats)
+        served = stats['hits'] + stats['prefix_hits'] + stats['misses'] + stats['coalesced']
+        stats['saved_calls'] = stats['hits'] + stats['prefix_hits'] + stats['coalesced'] + stats['dropped']
+        stats['hit_rate'] = (stats['hits'] + stats['prefix_hits']) / served if served else 0.
+        return stats
@@ -0,0 +1,25 @@
+""" Telegram token and the client of the entry points that only send messages """
+from os import environ
+
+TOKEN_FILE = 'creds/telegram.token'
+
+_bot = None
+
+
+def read_token() -> str:
+    """ Get the bot token from PSNBOT_TOKEN or from the token file """
+    token = environ.get('PSNBOT_TOKEN')
+    if token:
+        return token
+    with open(TOKEN_FILE) as file:
+        return file.read().strip()
+
+
+def get_bot():
+    """ Get TeleBot object created on the first call """
+    global _bot
+    if _bot is None:
+        from telebot import TeleBot
+
+        _bot = TeleBot(token=read_token())
+    return _bot
@@ -0,0 +1,466 @@
+""" Wishlist actions shared by the sync and async bot runtimes """
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from re import fullmatch
+from urllib.parse import quote
+
+from telebot import types
+
+from app import importer, jobs, posters
+from app.fetch import fetch
+from app.models import DEFAULT_LOCALE, PSN_URL, Game, Price, PriceStats, STORE_URL, User, WatchRule, Wish, \
+    session_scope
+from app.search import SEARCH_SIZE, SHOWN_RESULTS, SearchCache
+
+import logging
+
+logger = logging.getLogger('wishlist')
+
+PAGE_SIZE = 10
+INLINE_PAGE_SIZE = 20
+MEDIA_GROUP_SIZE = 10
+PRICE_WORKERS = 8
+
+SEARCH_URL = f'{STORE_URL}/store/api/chihiro/00_09_000/tumbler/{{country}}/{{language}}/999/' \
+             '{query}?size={size}&start=0&gameContentType=bundles&platform=ps4'
+
+
+def is_known(session, game_id: str) -> bool:
+    """
+    Check if a game can be found without requests to the store
+    :param session: Session instance
+    :param game_id: url or concept ID or product ID of the game
+    :returns True if the game is in the database
+    :raises ValueError if the identifier is invalid
+    """
+    game_id = game_id.strip()
+    if Game.get_cached(session, game_id):
+        return True
+    id_type, parsed_id = Game.parse_game_id(game_id)
+    return Game.get(**{id_type: parsed_id}, session=session) is not None
+
+
+def add_game(user_id, game_id: str, enqueue: bool = jobs.ENABLED) -> (str, str):
+    """
+    Add a game to the wishlist of a user
+    :param user_id: ID of the user
+    :param game_id: url or concept ID or product ID of the game
+    :param enqueue: leave the games that aren't in the database to the workers instead of fetching them here
+    :returns tuple with response text and poster url of the game (None if there is no poster or game)
+    """
+    try:
+        if enqueue:
+            with session_scope() as session:
+                known = is_known(session, game_id)
+            if not known:
+                jobs.get_queue().enqueue('resolve_game', {'user_id': user_id, 'game_id': game_id},
+                                         dedup_key=f'resolve:{user_id}:{game_id.strip()}')
+                return 'Ищу игру в PSN Store, пришлю ответ, как только она будет добавлена.', None
+        with session_scope() as session:
+            wish, is_created = Wish.get_or_create(user_id=user_id, game_id=game_id, session=session)
+            game = Game.get(id=wish.game_id, session=session)
+            locale = User.get_locale(session, user_id)
+            if is_created:
+                response = f'Игра успешно добавлена в твой вишлист: {game.link(locale)}.'
+            else:
+                response = f'Эта игра уже есть в твоём вишлисте: {game.link(locale)}.'
+            poster_url, added_id = game.poster_url, game.id
+        load_prices(user_id, locale, game_id=added_id, enqueue=enqueue)
+        return response, poster_url
+    except ValueError as ve:
+        return str(ve), None
+
+
+def delete_game(user_id, game_id: str) -> str:
+    """
+    Delete a game from the wishlist of a user
+    :param user_id: ID of the user
+    :param game_id: url or concept ID or product ID of the game
+    :returns response text
+    """
+    try:
+        with session_scope() as session:
+            game, game_is_new = Game.get_or_create(game_id=game_id, session=session)
+            was_deleted = Wish.delete(user_id=user_id, game_id=game_id, session=session)
+            locale = User.get_locale(session, user_id)
+            if was_deleted:
+                return f'Игра была успешно удалена: {game.link(locale)}'
+            elif game_is_new or game and not was_deleted:
+                return f'Игра отсутствует в вашем вишлисте: {game.link(locale)}'
+            else:
+                return f'Игра с таким идентификатором не найдена: {game.name}'
+    except ValueError as ve:
+        return str(ve)
+
+
+def import_games(user_id, text: str) -> str:
+    """
+    Add many games to the wishlist of a user at once
+    :param user_id: ID of the user
+    :param text: urls or IDs of the games, one per line
+    :returns response text with the summary
+    """
+    try:
+        stats = importer.import_games(user_id=user_id, text=text)
+    except ValueError as ve:
+        return str(ve)
+    has_games = any(games for key, games in stats.items() if key != 'rejected')
+    if not has_games and not stats['rejected']:
+        return 'Не нашёл ни одной ссылки или идентификатора игры'
+    response = [f'''Добавлено игр: {len(stats['added'])}''' if has_games else
+                'Не нашёл ни одной ссылки или идентификатора игры']
+    if stats['wished']:
+        response.append(f'''Уже были в вишлисте: {len(stats['wished'])}''')
+    if stats['not_found']:
+        response.append(f'''Не найдены в магазине: {', '.join(stats['not_found'][:10])}''' +
+                        ('...' if len(stats['not_found']) > 10 else ''))
+    if stats['failed']:
+        response.append(f'''Не удалось загрузить из магазина, попробуй позже: {', '.join(stats['failed'][:10])}''' +
+                        ('...' if len(stats['failed']) > 10 else ''))
+    if stats['invalid']:
+        response.append(f'''Неверные ссылки: {', '.join(stats['invalid'][:10])}''' +
+                        ('...' if len(stats['invalid']) > 10 else ''))
+    if stats['rejected']:
+        response.append('Строки без ссылок и идентификаторов игр:\n' +
+                        '\n'.join(f'''`{line.replace('`', "'")}`''' for line in stats['rejected'][:10]) +
+                        ('\n...' if len(stats['rejected']) > 10 else ''))
+    return '\n'.join(response)
+
+
+def set_region(user_id, locale: str) -> str:
+    """
+    Set the store region the prices of a user are tracked in and get the prices of the wishlist in it
+    :param user_id: ID of the user
+    :param locale: locale of the store like ru-ru
+    :returns response text
+    """
+    try:
+        with session_scope() as session:
+            locale = User.set_locale(session, user_id=user_id, locale=locale).locale
+    except ValueError as ve:
+        return str(ve)
+    response = f'Теперь цены отслеживаются в регионе `{locale}`'
+    loaded = load_prices(user_id, locale)
+    if loaded:
+        response += f'\nЗагружаю цены игр из вишлиста в этом регионе: {loaded}' if jobs.ENABLED else \
+            f'\nЗагружены цены игр из вишлиста в этом регионе: {loaded}'
+    return response
+
+
+def load_prices(user_id, locale: str, game_id: str = None, enqueue: bool = jobs.ENABLED) -> int:
+    """
+    Get the prices of the games from the wishlist of a user in their region unless the prices are already known
+    :param user_id: ID of the user
+    :param locale: locale of the store like ru-ru
+    :param game_id: ID of the only game to check, the whole wishlist if None
+    :param enqueue: leave the fetching to the workers
+    :returns number of the games whose prices are enqueued or written
+    """
+    with session_scope() as session:
+        query = session.query(Game.id, Game.concept_id).join(
+            Wish, Wish.game_id == Game.id
+        ).filter(
+            Wish.user_id == user_id,
+            Game.concept_id != None,
+            ~session.query(PriceStats.id).filter(
+                PriceStats.game_id == Game.id, PriceStats.locale == locale).exists(),
+        )
+        if game_id is not None:
+            query = query.filter(Game.id == game_id)
+        games = query.all()
+    if enqueue:
+        for missing_id, concept_id in games:
+            jobs.get_queue().enqueue('refresh_price', {'game_id': missing_id, 'concept_id': concept_id,
+                                                       'locale': locale},
+                                     dedup_key=f'refresh:{missing_id}:{locale}')
+        return len(games)
+
+    def get_info(concept_id: str) -> dict:
+        try:
+            return Game.get_game_info(concept_id=concept_id, store_locale=locale)
+        except Exception as e:
+            logger.warning('%s in %s is not loaded: %r', concept_id, locale, e)
+            return None
+
+    with ThreadPoolExecutor(max_workers=PRICE_WORKERS) as pool:
+        infos = list(pool.map(get_info, [concept_id for _, concept_id in games]))
+    written = 0
+    with session_scope() as session:
+        for (missing_id, _), game_info in zip(games, infos):
+            if game_info:
+                Price.update_price(game_id=missing_id, locale=locale, game_info=game_info, session=session)
+                written += 1
+    return written
+
+
+def parse_rule(text: str) -> (str, dict):
+    """
+    Parse the arguments of the /watch command like `10000237 <2000 50% Deluxe`
+    :param text: url or ID of the game followed by the conditions in any order
+    :returns tuple with the game identifier and dict with edition, below_price and min_discount
+    :raises ValueError if there is no game identifier
+    """
+    parts = text.split()
+    if not parts:
+        raise ValueError('Укажи игру и условие, например: `/watch 10000237 <2000 50% Deluxe`')
+    conditions, edition = {'edition': None, 'below_price': None, 'min_discount': None}, []
+    for part in parts[1:]:
+        if fullmatch(r'<\d+', part):
+            conditions['below_price'] = int(part[1:])
+        elif fullmatch(r'\d+%', part):
+            conditions['min_discount'] = int(part[:-1])
+        else:
+            edition.append(part)
+    conditions['edition'] = ' '.join(edition) or None
+    return parts[0], conditions
+
+
+def watch_game(user_id, text: str) -> str:
+    """
+    Add a watch rule to a game from the wishlist of a user, the game is added to the wishlist if it isn't there
+    :param user_id: ID of the user
+    :param text: arguments of the /watch command, see parse_rule
+    :returns response text
+    """
+    try:
+        game_id, conditions = parse_rule(text)
+        with session_scope() as session:
+            rule = WatchRule.add(session, user_id=user_id, game_id=game_id, **conditions)
+            game = Game.get(id=rule.game_id, session=session)
+            locale = User.get_locale(session, user_id)
+            matched = [stats for stats in PriceStats.get_for_game(session, rule.game_id, locale).values()
+                       if stats.current_price is not None and rule.is_matched(
+                           {'edition': stats.edition, 'original_price': stats.original_price,
+                            'sale_price': stats.current_price})]
+            rules = WatchRule.get_for_wish(session, user_id=rule.user_id, game_id=rule.game_id)
+            response = f'Пришлю сообщение об игре {game.link(locale)}, когда:\n' + \
+                '\n'.join(f'— {other}' for other in rules)
+            if matched:
+                response += '\nУсловие уже выполняется:\n' + '\n'.join(price_text(stats) for stats in matched)
+            return response
+    except ValueError as ve:
+        return str(ve)
+
+
+def unwatch_game(user_id, game_id: str) -> str:
+    """
+    Delete the watch rules of a game from the wishlist of a user, the user is notified about any discount on it again
+    :param user_id: ID of the user
+    :param game_id: url or concept ID or product ID of the game
+    :returns response text
+    """
+    try:
+        with session_scope() as session:
+            game, _ = Game.get_or_create(game_id=game_id, session=session)
+            if game is None:
+                return f'Игра с таким идентификатором не найдена: {game_id}'
+            deleted = session.query(WatchRule).filter(
+                WatchRule.user_id == user_id, WatchRule.game_id == game.id).delete()
+            locale = User.get_locale(session, user_id)
+            if not deleted:
+                return f'Для игры нет условий: {game.link(locale)}'
+            return f'Условия удалены, пришлю сообщение о любой скидке на игру {game.link(locale)}'
+    except ValueError as ve:
+        return str(ve)
+
+
+def wishlist_page(user_id, page: int = 0) -> (str, types.InlineKeyboardMarkup):
+    """
+    Make a numbered list of one page of the games from the wishlist of a user
+    :param user_id: ID of the user
+    :param page: number of the page starting with 0
+    :returns tuple with response text and keyboard to switch the pages and to get the posters of the page (None if
+    there is one page without posters)
+    """
+    with session_scope() as session:
+        total = Wish.count_games(session, user_id=user_id)
+        if not total:
+            return 'Твой вишлист пуст :(', None
+        pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
+        page = min(max(page, 0), pages - 1)
+        locale = User.get_locale(session, user_id)
+        games = Wish.get_games(user_id=user_id, session=session, with_prices=True, locale=locale,
+                               offset=page * PAGE_SIZE, limit=PAGE_SIZE)
+        text = '\n'.join([
+            f'{i}) {game.link(locale)}' + ''.join(f'\n    {price_text(stats)}' for stats in prices)
+            for i, (game, prices) in enumerate(games, start=page * PAGE_SIZE + 1)
+        ])
+        has_posters = any(game.poster_url for game, _ in games)
+
+    keyboard = types.InlineKeyboardMarkup()
+    navigation = []
+    if page > 0:
+        navigation.append(types.InlineKeyboardButton('◀', callback_data=f'list:{page - 1}'))
+    if pages > 1:
+        navigation.append(types.InlineKeyboardButton(f'{page + 1}/{pages}', callback_data='list:-'))
+    if page < pages - 1:
+        navigation.append(types.InlineKeyboardButton('▶', callback_data=f'list:{page + 1}'))
+    if navigation:
+        keyboard.row(*navigation)
+    if has_posters:
+        keyboard.row(types.InlineKeyboardButton('Постеры', callback_data=f'posters:{page}'))
+    return text, keyboard if navigation or has_posters else None
+
+
+def wishlist_posters(user_id, page: int = 0) -> list:
+    """
+    Make media groups with the posters of one page of the wishlist of a user
+    :param user_id: ID of the user
+    :param page: number of the page starting with 0
+    :returns list of media groups, lists of (poster url, InputMediaPhoto object) pairs
+    """
+    with session_scope() as session:
+        locale = User.get_locale(session, user_id)
+        games = [(game.link(locale), game.poster_url) for game in Wish.get_games(
+            user_id=user_id, session=session, offset=max(page, 0) * PAGE_SIZE, limit=PAGE_SIZE) if game.poster_url]
+    media = [
+        (poster_url, types.InputMediaPhoto(media=posters.get_file_id(poster_url) or poster_url, caption=caption,
+                                           parse_mode='MARKDOWN'))
+        for caption, poster_url in games
+    ]
+    return [media[start:start + MEDIA_GROUP_SIZE] for start in range(0, len(media), MEDIA_GROUP_SIZE)]
+
+
+def price_text(stats) -> str:
+    """
+    Describe the current price of a game edition next to its lowest prices
+    :param stats: PriceStats object
+    :returns text line
+    """
+    text = f'{stats.edition}: {stats}'
+    if stats.is_lowest:
+        return f'{text}, это самая низкая цена'
+    if stats.low_30d_price is not None and stats.low_30d_price < stats.current_price:
+        text += f', минимум за 30 дней: {stats.low_30d_price}'
+    return f'{text}, исторический минимум: {stats.lowest_price}'
+
+
+def has_sale_price(game_data: dict):
+    """
+    Возвращает True, если на игру действует скидка
+    :param game_data:
+    :return:
+    """
+    try:
+        return game_data['default_sku']['rewards'][0] is not None
+    except Exception:
+        return False
+
+
+def search_upstream(query: str, locale: str = DEFAULT_LOCALE) -> list:
+    """
+    Search games in PSN store, a larger page than is shown is fetched so that the cache can filter it for the longer
+    queries
+    :param query: text of the inline query
+    :param locale: locale of the store like ru-ru
+    :returns list of dicts with name, url, price, sale_price, valid_until and img_url of the found games
+    """
+    language, country = locale.split('-')
+    psn_url = SEARCH_URL.format(country=country, language=language, query=quote(query), size=SEARCH_SIZE)
+    logger.info(psn_url)
+    search_data = fetch(psn_url).json()
+    return [
+        {
+            'name': game['name'],
+            'url': f'''https://{PSN_URL}/{locale}/product/{game['id']}''',
+            'price': game['default_sku']['display_price'],
+            'sale_price': game['default_sku']['rewards'][0]['bonus_price'] // 100 if has_sale_price(game) else None,
+            'valid_until': game['default_sku']['rewards'][0]['end_date'] if has_sale_price(game) else None,
+            'img_url': game['images'][0]['url']
+        } for game in search_data['links']
+    ]
+
+
+search_caches = {}
+
+
+def get_search_cache(user_id=None) -> SearchCache:
+    """ Get the search cache of the store region of a user, every region has its own one """
+    if user_id is None:
+        locale = DEFAULT_LOCALE
+    else:
+        with session_scope() as session:
+            locale = User.get_locale(session, user_id)
+    cache = search_caches.get(locale)
+    if cache is None:
+        cache = search_caches.setdefault(locale, SearchCache(partial(search_upstream, locale=locale)))
+    return cache
+
+
+def search_store(query: str, user_id=None) -> list:
+    """
+    Search games in the PSN store of the user's region through the cache
+    :param query: text of the inline query
+    :param user_id: ID of the user, their stale queries are dropped
+    :returns list of dicts like search_upstream or None if the query was superseded by a newer one
+    """
+    games = get_search_cache(user_id).get(query, user_id=user_id)
+    return games[:SHOWN_RESULTS] if games is not None else None
+
+
+def search_cached(query: str, user_id) -> list:
+    """
+    Get the search results only if they are cached, the query becomes the latest one of the user
+    :param query: text of the inline query
+    :param user_id: ID of the user
+    :returns list of dicts like search_upstream or None on a miss
+    """
+    games = get_search_cache(user_id).peek(query, user_id=user_id)
+    return games[:SHOWN_RESULTS] if games is not None else None
+
+
+def search_store_later(query: str, callback, user_id):
+    """
+    Search games in the PSN store of the user's region through the cache after the debounce without blocking the
+    calling thread
+    :param query: text of the inline query
+    :param callback: function taking the list of dicts like search_upstream, isn't called for superseded queries
+    :param user_id: ID of the user
+    """
+    get_search_cache(user_id).get_later(query, lambda games: callback(games[:SHOWN_RESULTS]), user_id=user_id)
+
+
+def search_results(games: list) -> list:
+    """
+    Make inline results for the found games, Telegram downloads the posters by their urls itself
+    :param games: list from search_store
+    :returns list of InlineQueryResultPhoto objects
+    """
+    return [
+        types.InlineQueryResultPhoto(
+            id=i,
+            title=game['name'],
+            photo_url=game['img_url'],
+            thumb_url=game['img_url'],
+            caption=f'''[{game['name']}]({game['url']}): ''' +
+                    (f'''~~{game['price']}~~ {game['sale_price']} till {game['valid_until']}''' \
+                         if game['sale_price'] else f'''{game['price']}'''),
+            parse_mode='MARKDOWN',
+        ) for i, game in enumerate(games)
+    ]
+
+
+def wishlist_results(user_id, offset: str = '') -> (list, str):
+    """
+    Make inline results for one page of the games from the wishlist of a user
+    :param user_id: ID of the user
+    :param offset: offset of the inline query, position of the first game of the page
+    :returns tuple with list of InlineQueryResultPhoto or InlineQueryResultCachedPhoto objects and the offset of
+    the next page (empty string if it is the last one)
+    """
+    start = int(offset) if offset.isdigit() else 0
+    with session_scope() as session:
+        locale = User.get_locale(session, user_id)
+        games = Wish.get_games(user_id=user_id, session=session, offset=start, limit=INLINE_PAGE_SIZE)
+        results = []
+        for game in games:
+            file_id = game.poster_url and posters.get_file_id(game.poster_url)
+            if file_id:
+                results.append(types.InlineQueryResultCachedPhoto(
+                    id=game.id, photo_file_id=file_id, title=game.name, caption=game.link(locale),
+                    parse_mode='MARKDOWN'))
+            elif game.poster_url:
+                results.append(types.InlineQueryResultPhoto(
+                    id=game.id, title=game.name, photo_url=game.poster_url, thumb_url=game.poster_url,
+                    caption=game.link(locale), parse_mode='MARKDOWN'))
+        return results, str(start + INLINE_PAGE_SIZE) if len(games) == INLINE_PAGE_SIZE else ''
@@ -0,0 +1,227 @@
+""" Worker processes running the queued fetch and parse jobs
+
+Usage: python -m app.worker run [--processes N] [--threads M] [--rate-limit R]
+       python -m app.worker enqueue-refresh [--budget B]
+       python -m app.worker stats
+"""
+from argparse import ArgumentParser
+from multiprocessing import get_context
+from os import getpid
+from socket import gethostname
+from threading import Event, Lock, Thread
+
+from app import jobs, metrics
+from app.models import Game, LOG_LEVEL, PSN_URL, Price, db, session_scope
+from app.refresh import RateLimiter, enqueue_refresh
+
+import logging
+
+logger = logging.getLogger('worker')
+
+POLL_INTERVAL = 1.
+
+limiter = RateLimiter()
+
+
+def resolve_game(payload: dict):
+    """ Find a game in the store, add it to the wishlist and send the answer to the user """
+    from app import posters, wishlist
+    from app.telegram import get_bot
+
+    limiter.wait(PSN_URL)
+    response, poster_url = wishlist.add_game(user_id=payload['user_id'], game_id=payload['game_id'], enqueue=False)
+    if poster_url:
+        sent = get_bot().send_photo(chat_id=payload['user_id'], photo=posters.get_photo(poster_url),
+                                    parse_mode='MARKDOWN', caption=response)
+        posters.remember_file_id(poster_url, sent)
+        return
+    get_bot().send_message(payload['user_id'], response, parse_mode='MARKDOWN')
+
+
+def resolve_game_failed(payload: dict):
+    """ Tell the user that the game could not be added after the last attempt """
+    from app.telegram import get_bot
+
+    get_bot().send_message(payload['user_id'], 'Не получилось найти игру в PSN Store, попробуй добавить её позже: '
+                                               f'{payload["game_id"]}')
+
+
+def refresh_price(payload: dict):
+    """ Fetch the store page of a game in a locale and write its prices """
+    limiter.wait(PSN_URL)
+    game_info = Game.get_game_info(concept_id=payload['concept_id'], store_locale=payload['locale'])
+    with session_scope() as session:
+        Price.update_price(game_id=payload['game_id'], locale=payload['locale'], game_info=game_info,
+                           session=session)
+
+
+HANDLERS = {
+    'resolve_game': resolve_game,
+    'refresh_price': refresh_price,
+}
+FAILURE_HANDLERS = {
+    'resolve_game': resolve_game_failed,
+}
+
+
+class Heartbeat(Thread):
+    """ Prolongs the leases of the jobs running in a process so that a slow job is never claimed twice """
+
+    def __init__(self, queue: jobs.JobQueue, stop: Event, lease: float = jobs.LEASE):
+        """
+        :param queue: JobQueue object
+        :param stop: Event object
+        :param lease: seconds a job belongs to the worker, the leases are prolonged three times per lease
+        """
+        super().__init__(name='heartbeat', daemon=True)
+        self.queue = queue
+        self.stop = stop
+        self.lease = lease
+        self.jobs = set()
+        self._lock = Lock()
+
+    def add(self, job_id: int):
+        with self._lock:
+            self.jobs.add(job_id)
+
+    def discard(self, job_id: int):
+        with self._lock:
+            self.jobs.discard(job_id)
+
+    def run(self):
+        while not self.stop.wait(self.lease / 3):
+            with self._lock:
+                job_ids = list(self.jobs)
+            for job_id in job_ids:
+                try:
+                    self.queue.extend(job_id, self.lease)
+                except Exception:
+                    logger.exception('lease of %s is not extended', job_id)
+
+
+def report_failure(job: jobs.Job):
+    """ Run the failure handler of a job that has no attempts left """
+    if job.kind not in FAILURE_HANDLERS:
+        return
+    try:
+        FAILURE_HANDLERS[job.kind](job.payload)
+    except Exception:
+        logger.exception('failure of %s is not reported', job)
+
+
+def work(queue: jobs.JobQueue, name: str, stop: Event, lease: float = jobs.LEASE,
+         poll_interval: float = POLL_INTERVAL, heartbeat: Heartbeat = None):
+    """
+    Run the jobs from the queue one by one until the stop event is set
+    :param queue: JobQueue object
+    :param name: name of the worker the jobs are leased to
+    :param stop: Event object
+    :param lease: seconds a job belongs to the worker
+    :param poll_interval: seconds to sleep when the queue is empty
+    :param heartbeat: Heartbeat thread prolonging the lease of the running job, the job has to finish within the
+    lease without it
+    """
+    while not stop.is_set():
+        for job in queue.expire():
+            logger.warning('%s failed: lease expired', job)
+            metrics.inc('jobs', kind=job.kind, result='failed')
+            report_failure(job)
+        claimed = queue.claim(name, lease=lease)
+        if not claimed:
+            stop.wait(poll_interval)
+            continue
+        for job in claimed:
+            logger.debug('%s runs %s', name, job)
+            if heartbeat is not None:
+                heartbeat.add(job.id)
+            try:
+                with metrics.timer('job', kind=job.kind):
+                    HANDLERS[job.kind](job.payload)
+            except Exception as e:
+                logger.exception('%s failed', job)
+                metrics.inc('jobs', kind=job.kind, result='failed')
+                if queue.fail(job.id, repr(e)):
+                    report_failure(job)
+            else:
+                metrics.inc('jobs', kind=job.kind, result='done')
+                queue.complete(job.id)
+            finally:
+                if heartbeat is not None:
+                    heartbeat.discard(job.id)
+
+
+def run_process(index: int, threads: int, rate_limit: float):
+    """
+    Entry point of a worker process: several threads so that the store requests of one process overlap
+    :param index: number of the process
+    :param threads: number of threads
+    :param rate_limit: max number of requests per second to the store from this process
+    """
+    logging.basicConfig(filename='worker.log', filemode='a', level=LOG_LEVEL,
+                        format='%(asctime)s[%(processName)s %(name)s.%(levelname)s]: %(message)s')
+    db.dispose()
+    limiter.interval = 1 / rate_limit if rate_limit else 0
+    queue = jobs.SQLiteJobQueue()
+    stop = Event()
+    name = f'{gethostname()}:{getpid()}'
+    heartbeat = Heartbeat(queue, stop)
+    heartbeat.start()
+    workers = [Thread(target=work, args=(queue, f'{name}:{thread}', stop), kwargs={'heartbeat': heartbeat},
+                      daemon=True) for thread in range(threads)]
+    for worker in workers:
+        worker.start()
+    logger.info('worker %s started with %s threads', index, threads)
+    try:
+        for worker in workers:
+            worker.join()
+    except KeyboardInterrupt:
+        stop.set()
+
+
+def run_workers(args):
+    """ run worker processes until they are interrupted """
+    context = get_context('spawn')
+    processes = [
+        context.Process(target=run_process, args=(index, args.threads, args.rate_limit / args.processes),
+                        name=f'worker-{index}')
+        for index in range(args.processes)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        for process in processes:
+            process.join()
+
+
+def enqueue(args):
+    """ enqueue the refresh of the stale prices """
+    print(f'{enqueue_refresh(jobs.get_queue(), budget=args.budget)} jobs are enqueued')
+
+
+def print_stats(args):
+    """ show the number of jobs by kind and state """
+    for kind, states in sorted(jobs.get_queue().get_stats().items()):
+        print(kind, ', '.join(f'{state}: {count}' for state, count in sorted(states.items())))
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    run = commands.add_parser('run', help=run_workers.__doc__)
+    run.add_argument('--processes', type=int, default=2, help='number of worker processes')
+    run.add_argument('--threads', type=int, default=4, help='number of threads in every process')
+    run.add_argument('--rate-limit', type=float, default=5., help='max number of store requests per second')
+    run.set_defaults(func=run_workers)
+    refresh = commands.add_parser('enqueue-refresh', help=enqueue.__doc__)
+    refresh.add_argument('--budget', type=int, help='max number of pages fetched in this cycle')
+    refresh.set_defaults(func=enqueue)
+    commands.add_parser('stats', help=print_stats.__doc__).set_defaults(func=print_stats)
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
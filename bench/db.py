@@ -0,0 +1,90 @@
+""" Benchmark of the hot queries on a big database with and without indexes
+
+Usage: python -m bench.db [number of price rows]
+"""
+from datetime import date, timedelta
+from os import environ
+from random import Random
+from tempfile import mkdtemp
+from time import perf_counter
+import sys
+
+from sqlalchemy import inspect
+
+environ['PSNBOT_DB_URL'] = f'sqlite:///{mkdtemp()}/bench.sqlite'
+
+from app.models import BaseModel, Game, Price, PriceStats, User, Wish, db, migrate, session_scope  # noqa: E402
+from app.notifier import get_new_discounts  # noqa: E402
+from app.scheduler import plan  # noqa: E402
+
+DAYS = 100
+USERS = 10000
+WISHES_PER_USER = 10
+
+
+def populate(price_rows: int):
+    """ Fill the database with games, daily prices of each of them and wishlists """
+    rnd = Random(0)
+    games = max(price_rows // DAYS, 1)
+    today = date.today()
+    with db.begin() as connection:
+        connection.execute(Game.__table__.insert(), [
+            {'id': str(i), 'name': f'Game {i}', 'concept_id': str(10 ** 7 + i)} for i in range(games)
+        ])
+        connection.execute(User.__table__.insert(), [{'id': str(i)} for i in range(USERS)])
+        connection.execute(Wish.__table__.insert(), [
+            {'id': f'{user}-{game}', 'user_id': str(user), 'game_id': str(game)}
+            for user in range(USERS) for game in set(rnd.randrange(games) for _ in range(WISHES_PER_USER))
+        ])
+        for day in range(DAYS):
+            check_date = today - timedelta(days=day)
+            connection.execute(Price.__table__.insert(), [
+                {'id': f'{game}-{day}', 'game_id': str(game), 'check_date': check_date, 'locale': 'ru-ru',
+                 'original_price': 4000, 'sale_price': rnd.choice((4000, 4000, 1999)), 'edition': 'Standard'}
+                for game in range(games)
+            ])
+    with session_scope() as session:
+        PriceStats.rebuild(session)
+
+
+def drop_indexes():
+    inspector = inspect(db)
+    for table in BaseModel.metadata.sorted_tables:
+        indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name in indexes:
+                index.drop(bind=db)
+
+
+def timed(query, repeats: int = 5) -> float:
+    """ Best time of the query in ms """
+    best = float('inf')
+    for _ in range(repeats):
+        with session_scope() as session:
+            started_at = perf_counter()
+            list(query(session))
+            best = min(best, perf_counter() - started_at)
+    return best * 1000
+
+
+QUERIES = {
+    'refresh plan': plan,
+    'wishlist': lambda session: Wish.get_games(session, user_id='42', with_prices=True),
+    'new discounts': get_new_discounts,
+}
+
+
+def main(price_rows: int = 10 ** 6):
+    migrate()
+    print(f'populating {price_rows} price rows...')
+    populate(price_rows)
+    drop_indexes()
+    before = {name: timed(query) for name, query in QUERIES.items()}
+    migrate()
+    after = {name: timed(query) for name, query in QUERIES.items()}
+    for name in QUERIES:
+        print(f'{name:>15}: {before[name]:10.1f} ms -> {after[name]:10.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
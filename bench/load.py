@@ -0,0 +1,90 @@
+""" Load test of the async bot: simulated users against a fake Telegram API and the store stub
+
+Usage: python -m bench.load [users] [distinct games]
+
+Exits with 1 if any of the users failed.
+"""
+from asyncio import gather, run, sleep
+from os import chdir, environ
+from statistics import quantiles
+from tempfile import mkdtemp
+from time import perf_counter
+from types import SimpleNamespace
+import sys
+
+from bench.stub import StubStore
+
+TELEGRAM_LATENCY = 0.05
+STORE_LATENCY = 0.2
+
+workdir = mkdtemp()
+chdir(workdir)
+store = StubStore(latency=STORE_LATENCY).start()
+environ['PSNBOT_DB_URL'] = f'sqlite:///{workdir}/load.sqlite'
+environ['PSNBOT_STORE_URL'] = store.base_url
+environ['PSNBOT_TOKEN'] = '123456:load-test'
+
+from app import async_bot  # noqa: E402
+from app.models import migrate  # noqa: E402
+
+
+class FakeTelegram:
+    """ Stands in for Telegram API methods of the async bot, answers after TELEGRAM_LATENCY """
+
+    def __init__(self):
+        self.calls = 0
+
+    async def send_message(self, *args, **kwargs):
+        self.calls += 1
+        await sleep(TELEGRAM_LATENCY)
+        return SimpleNamespace(photo=None)
+
+    async def send_photo(self, *args, **kwargs):
+        self.calls += 1
+        await sleep(TELEGRAM_LATENCY)
+        return SimpleNamespace(photo=[SimpleNamespace(file_id=f'file-{self.calls}')])
+
+    async def answer_inline_query(self, *args, **kwargs):
+        self.calls += 1
+        await sleep(TELEGRAM_LATENCY)
+
+
+def message(user: int, text: str):
+    return SimpleNamespace(chat=SimpleNamespace(id=user), from_user=SimpleNamespace(id=user), text=text)
+
+
+async def timed(handler, update, latencies: list):
+    started_at = perf_counter()
+    await handler(update)
+    latencies.append(perf_counter() - started_at)
+
+
+async def simulate_user(user: int, games: int, latencies: list):
+    """ One user adds a couple of games and asks for the wishlist """
+    for game in (user % games, (user * 7) % games):
+        await timed(async_bot.add_game, message(user, f'/add {10 ** 7 + game}'), latencies)
+    await timed(async_bot.get_wishlist, message(user, '/list'), latencies)
+
+
+async def main(users: int = 200, games: int = 50) -> int:
+    migrate()
+    fake = FakeTelegram()
+    for method in ('send_message', 'send_photo', 'answer_inline_query'):
+        setattr(async_bot.bot, method, getattr(fake, method))
+    latencies = []
+    started_at = perf_counter()
+    results = await gather(*(simulate_user(user, games, latencies) for user in range(users)),
+                           return_exceptions=True)
+    wall_time = perf_counter() - started_at
+    errors = [result for result in results if isinstance(result, Exception)]
+    percentiles = quantiles(latencies, n=100) if len(latencies) > 1 else [0.] * 99
+    print(f'{users} users, {len(latencies)} handled updates, {len(errors)} failed users in {wall_time:.2f}s')
+    print(f'p50: {percentiles[49] * 1000:.1f} ms, p99: {percentiles[98] * 1000:.1f} ms')
+    print(f'store requests: {store.requests}, telegram calls: {fake.calls}')
+    for error in errors[:3]:
+        print(f'FAILED {error!r}')
+    return len(errors)
+
+
+if __name__ == '__main__':
+    sys.exit(1 if run(main(*map(int, sys.argv[1:3]))) else 0)
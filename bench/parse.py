@@ -0,0 +1,59 @@
+""" Benchmark of the PSN store page parsers
+
+Usage: python -m bench.parse <directory with saved concept/product pages> [repeats]
+"""
+from pathlib import Path
+from statistics import median
+from time import perf_counter
+import sys
+import tracemalloc
+
+from app.parser import parse_game_page
+
+
+def load_pages(pages_dir: str) -> dict:
+    """
+    Read saved store pages
+    :param pages_dir: directory with *.html files
+    :returns dict with file names as keys and page texts as values
+    """
+    return {path.name: path.read_text(encoding='utf-8') for path in sorted(Path(pages_dir).glob('*.html'))}
+
+
+def bench_parser(pages: dict, fast: bool, repeats: int = 5) -> dict:
+    """
+    Measure parse time and peak memory of one parser on every page
+    :param pages: dict from load_pages
+    :param fast: use the scanning extractor if True else the full soup parser
+    :param repeats: number of parses of each page for the timing
+    :returns dict with median parse time per page in ms and max peak memory per page in KB
+    """
+    times, peaks = [], []
+    for page in pages.values():
+        for _ in range(repeats):
+            started_at = perf_counter()
+            parse_game_page(page, fast=fast)
+            times.append(perf_counter() - started_at)
+        tracemalloc.start()
+        parse_game_page(page, fast=fast)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        'parse_ms': median(times) * 1000 if times else 0.,
+        'peak_kb': max(peaks, default=0) / 1024,
+    }
+
+
+def main(pages_dir: str, repeats: int = 5):
+    pages = load_pages(pages_dir)
+    print(f'{len(pages)} pages from {pages_dir}')
+    results = {name: bench_parser(pages, fast=fast, repeats=repeats) for name, fast in (('soup', False),
+                                                                                        ('fast', True))}
+    for name, result in results.items():
+        print(f'''{name:>5}: {result['parse_ms']:8.2f} ms/page, {result['peak_kb']:10.1f} KB peak''')
+    if results['fast']['parse_ms']:
+        print(f'''speedup: {results['soup']['parse_ms'] / results['fast']['parse_ms']:.1f}x''')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1], *map(int, sys.argv[2:3]))
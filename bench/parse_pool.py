@@ -0,0 +1,65 @@
+""" Scaling of the page parsing with the number of processes
+
+Usage: python -m bench.parse_pool [directory with saved concept/product pages] [--pages N] [--chunk-size N]
+
+Recorded pages are repeated up to N pages, generated stub pages are used if there is no directory.
+"""
+from argparse import ArgumentParser
+from os import cpu_count
+from pathlib import Path
+from time import perf_counter
+
+from app.parse_pool import ParsePool, parse_record
+from bench.stub import make_page
+
+
+def load_items(pages_dir: str = None, pages: int = 400) -> list:
+    """
+    Get raw pages to parse
+    :param pages_dir: directory with *.html files
+    :param pages: number of pages
+    :returns list of (raw html, concept ID) pairs
+    """
+    recorded = [(path.read_bytes(), None) for path in sorted(Path(pages_dir).glob('*.html'))] if pages_dir else []
+    items = recorded or [(make_page(str(10 ** 7 + i), 'http://localhost').encode(), None) for i in range(pages)]
+    return [items[i % len(items)] for i in range(pages)]
+
+
+def bench_serial(items: list) -> float:
+    started_at = perf_counter()
+    for content, concept_id in items:
+        parse_record(content, concept_id)
+    return perf_counter() - started_at
+
+
+def bench_pool(items: list, processes: int, chunk_size: int) -> float:
+    with ParsePool(processes, chunk_size=chunk_size) as pool:
+        pool.map(items[:processes])
+        started_at = perf_counter()
+        results = pool.map(items)
+        wall_time = perf_counter() - started_at
+    errors = sum(1 for _, error in results if error)
+    if errors:
+        print(f'{errors} pages are not parsed')
+    return wall_time
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('pages_dir', nargs='?', help='directory with saved store pages')
+    parser.add_argument('--pages', type=int, default=400, help='number of parsed pages')
+    parser.add_argument('--chunk-size', type=int, default=8, help='number of pages sent to a process at once')
+    args = parser.parse_args()
+
+    items = load_items(args.pages_dir, args.pages)
+    serial = bench_serial(items)
+    print(f'{len(items)} pages, serial: {len(items) / serial:8.1f} pages/sec')
+    processes = 1
+    while processes <= cpu_count():
+        wall_time = bench_pool(items, processes, args.chunk_size)
+        print(f'{processes:>2} processes: {len(items) / wall_time:8.1f} pages/sec, speedup {serial / wall_time:.1f}x')
+        processes *= 2
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+""" Serial against concurrent price refresh with the store served by the local stub
+
+Usage: python -m bench.refresh [--fixtures DIR] [--games N] [--latency S] [--workers 1 4 16]
+
+Recorded store pages go to DIR/pages/<concept ID>.html like for bench.suite, the other games are served from
+generated pages. Every run starts with no prices so that all the games are stale.
+"""
+from argparse import ArgumentParser
+from os import chdir, environ
+from pathlib import Path
+from tempfile import mkdtemp
+
+from bench.stub import StubStore
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', help='directory with recorded store pages')
+    parser.add_argument('--games', type=int, default=200, help='number of games, recorded ones go first')
+    parser.add_argument('--latency', type=float, default=.1, help='seconds the stub waits before every response')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16], help='numbers of fetching threads')
+    args = parser.parse_args()
+
+    workdir = mkdtemp()
+    chdir(workdir)
+    store = StubStore(latency=args.latency, fixtures_dir=args.fixtures).start()
+    environ['PSNBOT_DB_URL'] = f'sqlite:///{workdir}/refresh.sqlite'
+    environ['PSNBOT_STORE_URL'] = store.base_url
+
+    from app.models import Game, Price, PriceStats, User, Wish, migrate, session_scope
+    from app.refresh import refresh_prices
+
+    migrate()
+    recorded = sorted(path.stem for path in Path(args.fixtures).glob('pages/*.html')) if args.fixtures else []
+    ids = (recorded + [str(10 ** 7 + i) for i in range(args.games)])[:args.games]
+    with session_scope() as session:
+        session.add(User(id='1'))
+        session.add_all(Game(id=concept_id, concept_id=concept_id, name=f'Game {concept_id}') for concept_id in ids)
+        session.flush()
+        session.add_all(Wish(user_id='1', game_id=concept_id) for concept_id in ids)
+
+    def run(workers: int) -> dict:
+        with session_scope() as session:
+            session.query(Price).delete()
+            session.query(PriceStats).delete()
+        return refresh_prices(workers=workers, rate_limit=None)
+
+    # the warm-up fills the on-disk revalidation cache of app.fetch in the working directory, the same state a restarted
+    # bot finds after its earlier runs, so that every measured run gets the same responses
+    run(max(args.workers))
+    serial = None
+    for workers in args.workers:
+        stats = run(workers)
+        serial = serial or stats['wall_time']
+        print(f'{workers:>3} workers: {stats["pages"]} pages in {stats["wall_time"]:6.2f}s, '
+              f'{stats["pages_per_sec"]:7.1f} pages/sec, speedup {serial / stats["wall_time"]:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+""" Matching of the changed prices against the watch rules
+
+Usage: python -m bench.rules [number of games]
+
+The time to match should grow with the number of changed prices and stay flat when only the number of rules grows.
+"""
+from datetime import date, timedelta
+from os import environ
+from tempfile import mkdtemp
+from time import perf_counter
+import sys
+
+environ['PSNBOT_DB_URL'] = f'sqlite:///{mkdtemp()}/rules.sqlite'
+
+from app.models import Game, Price, User, WatchRule, Wish, migrate, session_scope  # noqa: E402
+from app.notifier import get_rule_matches  # noqa: E402
+
+TODAY = date(2020, 6, 1)
+USERS = 1000
+
+
+def add_rules(games: int, per_game: int, start_user: int):
+    """ Add wishes with a price rule and a discount rule of per_game users to every game """
+    wishes, rules = [], []
+    for game in range(games):
+        for user in range(start_user, start_user + per_game):
+            wish_id = f'{game}:{user % USERS}'
+            wishes.append({'id': wish_id, 'game_id': str(game), 'user_id': str(user % USERS)})
+            rules.append({'wish_id': wish_id, 'game_id': str(game), 'user_id': str(user % USERS),
+                          'below_price': 1000 + user % 3000})
+            rules.append({'wish_id': wish_id, 'game_id': str(game), 'user_id': str(user % USERS),
+                          'edition': 'Standard', 'min_discount': 10 + user % 80})
+    with session_scope() as session:
+        Wish.upsert(session, wishes, index_elements=('game_id', 'user_id'))
+        WatchRule.upsert(session, rules, index_elements=('id',))
+
+
+def change_prices(changed: int, check_date: date):
+    with session_scope() as session:
+        Price.upsert(session, [
+            {'game_id': str(game), 'check_date': check_date, 'locale': 'ru-ru', 'edition': 'Standard',
+             'original_price': 4000, 'sale_price': 1999, 'currency': 'RUB'}
+            for game in range(changed)
+        ], index_elements=('game_id', 'check_date', 'locale', 'edition'))
+
+
+def match(check_date: date) -> (int, float):
+    started_at = perf_counter()
+    with session_scope() as session:
+        matches = sum(1 for _ in get_rule_matches(session, check_date))
+    return matches, perf_counter() - started_at
+
+
+def main(games: int = 2000):
+    migrate()
+    with session_scope() as session:
+        session.add_all(Game(id=str(game), name=f'Game {game}', concept_id=str(10 ** 7 + game))
+                        for game in range(games))
+        session.add_all(User(id=str(user)) for user in range(USERS))
+    per_game, day = 0, 0
+    for target in (5, 20, 50):
+        add_rules(games, target - per_game, start_user=per_game)
+        per_game = target
+        for changed in (10, 100, 1000):
+            day += 1
+            check_date = TODAY + timedelta(days=day)
+            change_prices(min(changed, games), check_date)
+            matches, seconds = match(check_date)
+            print(f'{games * per_game * 2:>8} rules, {changed:>5} changed prices: {matches:>6} matches '
+                  f'in {seconds * 1000:8.1f} ms')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,60 @@
+""" Import time of every entry point
+
+Usage: python -m bench.startup [repeats]
+
+Every entry point is imported in a fresh interpreter with -X importtime, the report shows the best total time and the
+packages whose modules took the most time in the last run.
+"""
+from collections import defaultdict
+from os import environ
+from pathlib import Path
+from subprocess import run
+from tempfile import mkdtemp
+import sys
+
+ENTRY_POINTS = {
+    'bot': 'app.bot',
+    'async bot': 'app.async_bot',
+    'refresh': 'app.refresh',
+    'notifier': 'app.notifier',
+    'worker': 'app.worker',
+    'admin': 'app.admin',
+}
+TOP = 5
+ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_time(module: str) -> (float, dict):
+    """
+    Import a module in a new interpreter
+    :param module: name of the module
+    :returns tuple with total import time in ms and dict with own import times of the modules of every package
+    """
+    workdir = mkdtemp()
+    env = dict(environ, PSNBOT_DB_URL=f'sqlite:///{workdir}/startup.sqlite', PSNBOT_METRICS='0',
+               PYTHONPATH=str(ROOT))
+    stderr = run([sys.executable, '-X', 'importtime', '-c', f'import {module}'], env=env, cwd=workdir,
+                 capture_output=True, text=True, check=True).stderr
+    total, packages = 0., defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        if not own.strip().isdigit():
+            continue
+        packages[name.strip().split('.')[0]] += int(own) / 1000
+        if name.startswith(' app') and not name.startswith('  '):
+            total += int(cumulative) / 1000
+    return total, dict(packages)
+
+
+def main(repeats: int = 3):
+    for name, module in ENTRY_POINTS.items():
+        runs = [import_time(module) for _ in range(repeats)]
+        total = min(total for total, _ in runs)
+        heaviest = sorted(runs[-1][1].items(), key=lambda item: -item[1])[:TOP]
+        print(f'{name:>10}: {total:8.1f} ms  ' + ', '.join(f'{package} {ms:.0f}' for package, ms in heaviest))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
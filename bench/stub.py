@@ -0,0 +1,124 @@
+""" Local HTTP stub of PSN store serving recorded or generated concept pages, search responses and posters """
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from json import dumps
+from pathlib import Path
+from threading import Thread
+from urllib.parse import parse_qs, unquote, urlsplit
+from zlib import crc32
+from time import sleep
+
+from PIL import Image
+
+
+def make_cache(concept_id: str, base_url: str) -> dict:
+    """ Make the smallest Apollo cache that the store page parser understands """
+    return {
+        f'Concept:{concept_id}': {
+            'name': f'Game {concept_id}',
+            'media': [{'role': 'MASTER', 'url': f'{base_url}/poster/{concept_id}.png'}],
+        },
+        f'Product:EP0000-CUSA{concept_id}': {
+            'name': f'Game {concept_id}',
+            'activeCtaId': f'{concept_id}-cta',
+            'skus': [{'__ref': f'Sku:{concept_id}-cta'}],
+            'edition': {'name': 'Standard'},
+        },
+        f'GameCTA:{concept_id}-cta': {
+            'local': {'telemetryMeta': {'skuDetail': {'skuPriceDetail': [
+                {'originalPriceValue': 399900, 'discountPriceValue': 199900 if int(concept_id) % 2 else 399900}
+            ]}}},
+            'price': {'endTime': None, 'currencyCode': 'RUB'},
+        },
+    }
+
+
+def make_page(concept_id: str, base_url: str) -> str:
+    return '<html><body><div class="pdp-cta"><script type="application/json">' + \
+           dumps({'cache': make_cache(concept_id, base_url)}) + '</script></div></body></html>'
+
+
+def make_search(query: str, base_url: str, size: int = 5) -> dict:
+    """ Make a chihiro tumbler response with `size` games matching the query """
+    return {'links': [
+        {
+            'name': f'{query} {i}',
+            'id': f'EP0000-CUSA{i:05d}_00-{query.upper()[:8]:0<8}{i:08d}',
+            'default_sku': {'display_price': '3 999 RUB', 'rewards': [{'bonus_price': 199900, 'end_date': None}]},
+            'images': [{'url': f'{base_url}/poster/{i}.png'}],
+        } for i in range(size)
+    ]}
+
+
+def make_poster() -> bytes:
+    content = BytesIO()
+    Image.new('RGB', (720, 720), (0, 55, 145)).save(content, format='PNG')
+    return content.getvalue()
+
+
+class StubStore(ThreadingHTTPServer):
+    """ Store stub running in a background thread, base_url is to be used as PSNBOT_STORE_URL """
+
+    def __init__(self, latency: float = 0., fixtures_dir: str = None):
+        """
+        :param latency: seconds to wait before every response
+        :param fixtures_dir: directory with recorded pages/<concept or product ID>.html and search/<query>.json,
+        pages that aren't recorded are generated
+        """
+        super().__init__(('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.fixtures_dir = Path(fixtures_dir) if fixtures_dir else None
+        self.base_url = f'http://127.0.0.1:{self.server_address[1]}'
+        self.poster = make_poster()
+        self.requests = 0
+
+    def start(self) -> 'StubStore':
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # headers and body are written separately, with Nagle the body waits for the ack of the headers
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.requests += 1
+        sleep(self.server.latency)
+        path = self.path.strip('/').split('/')
+        fixtures = self.server.fixtures_dir
+        if path[0] == 'poster':
+            body, content_type = self.server.poster, 'image/png'
+        elif path[0] == 'store' and 'tumbler' in path:
+            query = unquote(path[-1].split('?')[0])
+            recorded = fixtures / 'search' / f'{query}.json' if fixtures else None
+            size = int(parse_qs(urlsplit(self.path).query).get('size', ['5'])[0])
+            body = recorded.read_bytes() if recorded and recorded.exists() else \
+                dumps(make_search(query, self.server.base_url, size)).encode()
+            content_type = 'application/json'
+        elif len(path) == 3 and path[1] in ('concept', 'product'):
+            recorded = fixtures / 'pages' / f'{path[2]}.html' if fixtures else None
+            if recorded and recorded.exists():
+                body = recorded.read_bytes()
+            elif path[1] == 'concept':
+                body = make_page(path[2], self.server.base_url).encode()
+            else:
+                body = b''
+            content_type = 'text/html' if body else 'text/plain'
+        else:
+            body, content_type = b'not found', 'text/plain'
+        etag = f'"{crc32(body):08x}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200 if content_type != 'text/plain' else 404)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
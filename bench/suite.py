@@ -0,0 +1,185 @@
+""" Benchmark and regression suite of the hot paths replaying store pages from the local stub
+
+Usage: python -m bench.suite [--fixtures DIR] [--baseline FILE] [--threshold 0.2] [--update-baseline]
+
+Recorded store pages go to DIR/pages/<concept ID>.html and chihiro responses to DIR/search/<query>.json, games
+without a recording are served from generated pages. Every metric is lower-is-better, the suite exits with 1 if any
+of them is worse than the baseline by more than the threshold. The timings depend on the machine, so the baseline is
+recorded locally with --update-baseline and the suite refuses to run without one.
+
+The parser output of every page with DIR/expected/<concept ID>.json, and of the pages bundled in bench/fixtures, is
+checked against it first and the suite exits with 1 on any mismatch. valid_until is stored as a unix timestamp.
+"""
+from argparse import ArgumentParser
+from json import dumps, loads
+from os import chdir, environ
+from pathlib import Path
+from resource import RUSAGE_SELF, getrusage
+from statistics import median
+from tempfile import mkdtemp
+from time import perf_counter
+import sys
+import tracemalloc
+
+from bench.stub import StubStore, make_page
+
+BASELINE = Path(__file__).parent / 'baseline.json'
+FIXTURES = Path(__file__).parent / 'fixtures'
+GAMES = 50
+USERS = 20
+
+workdir = mkdtemp()
+
+
+def setup(fixtures_dir: str = None) -> StubStore:
+    """ Start the stub and point the bot to it and to an empty database """
+    chdir(workdir)
+    store = StubStore(fixtures_dir=fixtures_dir).start()
+    environ['PSNBOT_DB_URL'] = f'sqlite:///{workdir}/suite.sqlite'
+    environ['PSNBOT_STORE_URL'] = store.base_url
+    return store
+
+
+def concept_ids(fixtures_dir: str = None) -> list:
+    recorded = sorted(path.stem for path in Path(fixtures_dir or workdir).glob('pages/*.html'))
+    return recorded or [str(10 ** 7 + i) for i in range(GAMES)]
+
+
+def timed(func, *args, **kwargs) -> float:
+    started_at = perf_counter()
+    func(*args, **kwargs)
+    return (perf_counter() - started_at) * 1000
+
+
+def bench_parse(store: StubStore, ids: list) -> dict:
+    from app.parser import parse_game_page
+
+    pages = []
+    for concept_id in ids:
+        recorded = store.fixtures_dir / 'pages' / f'{concept_id}.html' if store.fixtures_dir else None
+        pages.append(recorded.read_text(encoding='utf-8') if recorded and recorded.exists()
+                     else make_page(concept_id, store.base_url))
+    times = [timed(parse_game_page, page) for page in pages for _ in range(3)]
+    tracemalloc.start()
+    for page in pages:
+        parse_game_page(page)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {'parse_ms': median(times), 'parse_peak_kb': peak / 1024}
+
+
+def parsed(page: str) -> dict:
+    """ Parse the page into the form of the expected output """
+    from app.parser import parse_game_page
+
+    info = parse_game_page(page)
+    for edition in info['editions'].values():
+        edition['valid_until'] = int(edition['valid_until'].timestamp())
+    return info
+
+
+def check_parse(fixtures_dirs: list) -> list:
+    """
+    Compare the parser output with the recorded expectations
+    :param fixtures_dirs: directories with pages/<concept ID>.html and expected/<concept ID>.json
+    :returns list of the concept IDs whose output differs
+    """
+    mismatches = []
+    for fixtures_dir in fixtures_dirs:
+        for expected in sorted(Path(fixtures_dir).glob('expected/*.json')):
+            page = Path(fixtures_dir) / 'pages' / f'{expected.stem}.html'
+            if parsed(page.read_text(encoding='utf-8')) != loads(expected.read_text(encoding='utf-8')):
+                mismatches.append(expected.stem)
+    return mismatches
+
+
+def bench_fetch(ids: list) -> dict:
+    from app.models import Game
+
+    return {'fetch_ms': median(timed(Game.get_game_info, concept_id=concept_id) for concept_id in ids)}
+
+
+def bench_db_write(ids: list) -> dict:
+    from app.models import Game, Price, session_scope
+
+    infos = {concept_id: Game.get_game_info(concept_id=concept_id) for concept_id in ids}
+    started_at = perf_counter()
+    with session_scope() as session:
+        for concept_id, info in infos.items():
+            game = Game(concept_id=concept_id, name=info['name'], poster_url=info['poster_url'])
+            session.add(game)
+            session.flush()
+            Price.update_price(game_id=game.id, game_info=info, session=session)
+    return {'db_write_ms': (perf_counter() - started_at) * 1000 / len(ids)}
+
+
+def bench_handlers(ids: list) -> dict:
+    from app import wishlist
+
+    add, listing, search = [], [], []
+    for user in range(USERS):
+        for concept_id in ids[user % len(ids):][:5]:
+            add.append(timed(wishlist.add_game, user_id=user, game_id=concept_id))
+        listing.append(timed(wishlist.wishlist_page, user_id=user))
+        search.append(timed(wishlist.search_upstream, f'game {user}'))
+    return {'add_ms': median(add), 'list_ms': median(listing), 'search_ms': median(search)}
+
+
+def run(fixtures_dir: str = None) -> dict:
+    store = setup(fixtures_dir)
+    from app.models import migrate
+
+    migrate()
+    ids = concept_ids(fixtures_dir)
+    results = {}
+    results.update(bench_parse(store, ids))
+    results.update(bench_fetch(ids))
+    results.update(bench_db_write(ids))
+    results.update(bench_handlers(ids))
+    results['max_rss_mb'] = getrusage(RUSAGE_SELF).ru_maxrss / 1024
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    Find the metrics that got worse than the baseline
+    :returns list of (metric, baseline value, current value) tuples
+    """
+    return [(metric, baseline[metric], value) for metric, value in results.items()
+            if metric in baseline and value > baseline[metric] * (1 + threshold)]
+
+
+def main():
+    parser = ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--fixtures', help='directory with recorded store pages and search responses')
+    parser.add_argument('--baseline', default=str(BASELINE), help='json file with the baseline metrics')
+    parser.add_argument('--threshold', type=float, default=.2, help='allowed relative regression')
+    parser.add_argument('--update-baseline', action='store_true', help='save the results as the new baseline')
+    args = parser.parse_args()
+
+    fixtures = str(Path(args.fixtures).resolve()) if args.fixtures else None
+    baseline_path = Path(args.baseline).resolve()
+    if not baseline_path.exists() and not args.update_baseline:
+        parser.error(f'no baseline at {baseline_path}, record one on this machine with --update-baseline')
+    mismatches = check_parse([FIXTURES] + ([fixtures] if fixtures else []))
+    for concept_id in mismatches:
+        print(f'MISMATCH parser output of {concept_id} differs from the expected one')
+    if mismatches:
+        sys.exit(1)
+    results = run(fixtures)
+    baseline = loads(baseline_path.read_text()) if baseline_path.exists() else {}
+    for metric, value in results.items():
+        print(f'{metric:>15}: {value:10.2f}' + (f'  (baseline {baseline[metric]:.2f})' if metric in baseline else ''))
+
+    if args.update_baseline:
+        baseline_path.write_text(dumps(results, indent=2))
+        print(f'baseline saved to {baseline_path}')
+        return
+    regressions = compare(results, baseline, args.threshold)
+    for metric, expected, value in regressions:
+        print(f'REGRESSION {metric}: {expected:.2f} -> {value:.2f}')
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
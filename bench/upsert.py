@@ -0,0 +1,81 @@
+""" Write throughput of the per-row ORM path against the bulk upsert
+
+Usage: python -m bench.upsert [number of rows]
+"""
+from datetime import date
+from os import environ
+from tempfile import mkdtemp
+from time import perf_counter
+import sys
+
+environ['PSNBOT_DB_URL'] = f'sqlite:///{mkdtemp()}/upsert.sqlite'
+
+from app.models import Game, Price, User, Wish, migrate, session_scope  # noqa: E402
+
+
+def price_row(game: int, check_date: date, sale_price: int) -> dict:
+    return {'game_id': str(game), 'check_date': check_date, 'locale': 'ru-ru', 'edition': 'Standard',
+            'original_price': 4000, 'sale_price': sale_price, 'currency': 'RUB'}
+
+
+def orm_prices(rows: list):
+    """ The per-row path: a SELECT by the unique constraint and then an INSERT or an UPDATE """
+    with session_scope() as session:
+        for row in rows:
+            price = Price.get(session, game_id=row['game_id'], check_date=row['check_date'], locale=row['locale'],
+                              edition=row['edition'])
+            if price is None:
+                session.add(Price(**row))
+            else:
+                price.sale_price = row['sale_price']
+            session.flush()
+
+
+def upsert_prices(rows: list):
+    with session_scope() as session:
+        Price.upsert(session, rows, index_elements=('game_id', 'check_date', 'locale', 'edition'),
+                     update=('original_price', 'sale_price', 'currency'))
+
+
+def orm_wishes(rows: list):
+    with session_scope() as session:
+        for row in rows:
+            Wish.create(session, **row)
+            session.flush()
+
+
+def upsert_wishes(rows: list):
+    with session_scope() as session:
+        Wish.upsert(session, rows, index_elements=('game_id', 'user_id'))
+
+
+def rows_per_sec(write, rows: list) -> float:
+    started_at = perf_counter()
+    write(rows)
+    return len(rows) / (perf_counter() - started_at)
+
+
+def main(rows: int = 20000):
+    migrate()
+    with session_scope() as session:
+        session.add_all(Game(id=str(game), name=f'Game {game}', concept_id=str(10 ** 7 + game))
+                        for game in range(rows))
+        session.add_all(User(id=str(user)) for user in range(2))
+    cases = {
+        'prices, new': (orm_prices, upsert_prices,
+                        lambda day: [price_row(game, date(2020, 1, day), 4000) for game in range(rows)]),
+        'prices, conflicting': (orm_prices, upsert_prices,
+                                lambda day: [price_row(game, date(2020, 1, day), 1999) for game in range(rows)]),
+        'wishes, new': (orm_wishes, upsert_wishes,
+                        lambda day: [{'user_id': str(day % 2), 'game_id': str(game)} for game in range(rows)]),
+    }
+    print(f'{rows} rows per case')
+    for name, (orm, upsert, make_rows) in cases.items():
+        # different days and users so that each path conflicts only with its own rows
+        before = rows_per_sec(orm, make_rows(3))
+        after = rows_per_sec(upsert, make_rows(4))
+        print(f'{name:>20}: {before:10.0f} -> {after:10.0f} rows/sec ({after / before:.1f}x)')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,63 @@
+""" The fast marker extraction gives the same game info as the soup parser """
+from pathlib import Path
+
+import pytest
+
+from app import parser
+from bench.stub import make_page
+
+FIXTURES = Path(__file__).parent.parent / 'bench' / 'fixtures' / 'pages'
+PAGES = {path.stem: path.read_text(encoding='utf-8') for path in sorted(FIXTURES.glob('*.html'))}
+PAGES['stub'] = make_page('10000001', 'http://127.0.0.1')
+
+
+@pytest.fixture
+def fallbacks(monkeypatch):
+    """ Count the pages parsed with the soup """
+    calls = []
+    soup = parser.soup
+
+    def counted(markup):
+        calls.append(markup)
+        return soup(markup)
+
+    monkeypatch.setattr(parser, 'soup', counted)
+    return calls
+
+
+@pytest.mark.parametrize('page', PAGES.values(), ids=PAGES.keys())
+def test_fast_path_matches_soup(page, fallbacks):
+    fast = parser.parse_game_page(page)
+    assert not fallbacks
+    assert fast == parser.parse_game_page(page, fast=False)
+    assert fast['editions']
+
+
+def test_escaped_upsells():
+    info = parser.parse_game_page(PAGES['10000238'])
+    assert info['name'] == 'Tom Clancy\'s "Siege" & <Friends>'
+    assert info['poster_url'].endswith('?w=720&h=720')
+
+
+def test_background_poster_from_next_data():
+    page = PAGES['10000239']
+    assert 'media' not in parser.extract_cache(page)['Concept:10000239']
+    assert parser.parse_game_page(page)['poster_url'].endswith('/bg.png')
+
+
+@pytest.mark.parametrize('concept_id', ['10000237', 'stub'])
+def test_missing_markers_fall_back_to_soup(concept_id, fallbacks):
+    page = PAGES[concept_id]
+    unmarked = page.replace(parser.CTA_MARKER, "class='pdp-cta'")
+    assert parser.extract_cache(unmarked) is None
+    assert parser.parse_game_page(unmarked) == parser.parse_game_page(page)
+    assert len(fallbacks) == 1
+
+
+def test_missing_next_data_marker_falls_back_to_soup(fallbacks):
+    page = PAGES['10000239']
+    unmarked = page.replace(parser.NEXT_DATA_MARKER, "id='__NEXT_DATA__'")
+    assert parser.extract_background_cache(unmarked) is None
+    assert parser.parse_game_page(unmarked) == parser.parse_game_page(page)
+    # the page and then the batarang inside it
+    assert len(fallbacks) == 2
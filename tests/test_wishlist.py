@@ -0,0 +1,70 @@
+""" The wishlist is loaded with a fixed number of statements whatever its size """
+from contextlib import contextmanager
+from os import environ
+from tempfile import mkdtemp
+
+import pytest
+
+workdir = mkdtemp()
+environ['PSNBOT_DB_URL'] = f'sqlite:///{workdir}/test.sqlite'
+environ['PSNBOT_METRICS'] = '0'
+
+from sqlalchemy import event  # noqa: E402
+
+from app import wishlist  # noqa: E402
+from app.models import Game, PriceStats, User, Wish, db, migrate, session_scope  # noqa: E402
+
+SIZES = (1, 30, 1000)
+
+
+@pytest.fixture(scope='module', autouse=True)
+def wishlists():
+    """ One user per size with that many wished games, every game has the prices of two editions """
+    migrate()
+    games = max(SIZES)
+    with session_scope() as session:
+        session.add_all(Game(id=str(game), concept_id=str(10 ** 7 + game), name=f'Game {game}')
+                        for game in range(games))
+        session.add_all(User(id=str(size)) for size in SIZES)
+        PriceStats.upsert(session, [
+            {'game_id': str(game), 'locale': 'ru-ru', 'edition': edition, 'original_price': 4000,
+             'current_price': 1999, 'lowest_price': 1999, 'low_30d_price': 1999}
+            for game in range(games) for edition in ('Standard', 'Deluxe')
+        ], index_elements=('game_id', 'locale', 'edition'))
+        Wish.upsert(session, [{'user_id': str(size), 'game_id': str(game)} for size in SIZES for game in range(size)],
+                    index_elements=('game_id', 'user_id'))
+
+
+@contextmanager
+def count_statements():
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db, 'before_cursor_execute', count)
+    try:
+        yield statements
+    finally:
+        event.remove(db, 'before_cursor_execute', count)
+
+
+def get_games(user_id: str) -> list:
+    with session_scope() as session:
+        return Wish.get_games(session, user_id=user_id, with_prices=True)
+
+
+@pytest.mark.parametrize('load', [get_games, wishlist.wishlist_page])
+def test_statement_count_does_not_grow_with_wishlist(load):
+    counts = {}
+    for size in SIZES:
+        with count_statements() as statements:
+            load(str(size))
+        counts[size] = len(statements)
+    assert len(set(counts.values())) == 1, counts
+
+
+def test_games_come_with_prices():
+    games = get_games(str(max(SIZES)))
+    assert len(games) == max(SIZES)
+    assert all(len(prices) == 2 for _, prices in games)